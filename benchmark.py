@@ -0,0 +1,301 @@
+"""
+Микробенчмарки горячих путей обработки сообщения
+Анализ настроения, шаблоны речи, определение языка, сборка промптов, оценка
+качества ответа и операции A/B тестирования на временной базе. Результаты можно
+сохранить как базовые и сравнивать с ними после изменений.
+
+Пример:
+    python benchmark.py --save-baseline          # на исходной версии
+    python benchmark.py --fail-on-regression     # после изменений
+    python benchmark.py -k sentiment --repeat 11
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import random
+import logging
+import argparse
+import platform
+import statistics
+import tempfile
+import itertools
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+DEFAULT_BASELINE_PATH = "benchmark_baseline.json"
+
+@dataclass
+class BenchmarkResult:
+    """Результат одного бенчмарка"""
+    name: str
+    ns_per_op: float  # медиана по повторам
+    ns_min: float
+    stdev_pct: float  # разброс между повторами, % от медианы
+    loops: int  # вызовов в одном повторе
+    repeat: int
+
+def measure(func: Callable[[], object], repeat: int = 7, min_time: float = 0.2) -> BenchmarkResult:
+    """Замерить время вызова func: число вызовов подбирается под min_time на повтор"""
+    timer = timeit.Timer(func)
+    loops = 1
+    while True:
+        elapsed = timer.timeit(loops)
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+
+    # timeit отключает сборщик мусора на время замера
+    times = [timer.timeit(loops) / loops * 1e9 for _ in range(repeat)]
+    median = statistics.median(times)
+    return BenchmarkResult(
+        name="",
+        ns_per_op=median,
+        ns_min=min(times),
+        stdev_pct=statistics.stdev(times) / median * 100 if len(times) > 1 and median else 0.0,
+        loops=loops,
+        repeat=repeat,
+    )
+
+# Тексты
+
+SHORT_TEXT = "Мне грустно и тревожно"
+
+MEDIUM_TEXT = (
+    "Последние полгода я чувствую себя выгоревшим: работа не приносит радости, "
+    "начальник постоянно критикует, а коллеги не замечают моих достижений. "
+    "Хочу сменить профессию, но боюсь, что не справлюсь и разочарую семью. "
+    "Иногда мечтаю открыть свое дело, но не знаю, с чего начать."
+)
+
+LONG_TEXT = " ".join([
+    "В детстве я много времени проводил с бабушкой, она научила меня терпению и вниманию к людям.",
+    "Сейчас мне тридцать пять, я работаю аналитиком в большой компании, и каждый день похож на предыдущий.",
+    "Меня мотивирует ощущение, что работа кому-то помогает, но здесь я этого не чувствую.",
+    "Со стрессом справляюсь плохо: замыкаюсь в себе, плохо сплю, потом долго восстанавливаюсь.",
+    "Боюсь ошибиться и разочаровать близких, поэтому откладываю важные решения месяцами.",
+    "Иногда бывает радостно и спокойно, когда рисую или гуляю с собакой, но это быстро проходит.",
+    "Коллеги говорят, что у меня хорошо получается объяснять сложное простыми словами.",
+    "Через пять лет хотел бы руководить небольшой командой и заниматься обучением людей.",
+] * 6)
+
+AI_RESPONSE = (
+    "Понимаю ваши чувства 💙 Выгорание - частая реакция на долгую работу без признания.\n\n"
+    "**Что можно сделать:**\n"
+    "• Попробуйте выделить задачи, которые приносят вам удовольствие\n"
+    "• Рекомендую обсудить с руководителем ваши достижения и цели\n"
+    "• Стоит присмотреться к профессиям, где важны объяснение и обучение\n\n"
+    "Расскажите, что вас радовало на работе раньше? Это поможет понять ваш путь."
+)
+
+FULL_ANALYSIS_ANSWERS = [
+    "В детстве я много времени проводил с бабушкой, она научила меня терпению",
+    "Меня мотивирует ощущение, что моя работа кому-то действительно помогает",
+    "Со стрессом справляюсь плохо: замыкаюсь в себе, потом долго восстанавливаюсь",
+    "Лучше всего работаю один, но с возможностью обсудить задачу с коллегами",
+    "Боюсь ошибиться и разочаровать близких, поэтому долго откладываю решения",
+    "Через пять лет вижу себя руководителем небольшой команды в любимой сфере",
+    "Хотел бы стать смелее и меньше зависеть от чужого мнения о себе",
+]
+
+def prepare_environment(workdir: str) -> None:
+    """Модуль бота читает настройки при импорте: базы - во временном каталоге"""
+    os.environ.update({
+        'BOT_TOKEN': os.environ.get('BOT_TOKEN') or '123456:BENCHMARK',
+        'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY') or 'benchmark',
+        'DATABASE_PATH': os.path.join(workdir, 'psychoanalyst.db'),
+        'SESSION_DB_PATH': os.path.join(workdir, 'sessions.db'),
+        'RESPONSE_CACHE_PATH': '',
+    })
+
+def build_benchmarks(workdir: str) -> Dict[str, Callable[[], object]]:
+    """Набор бенчмарков: имя -> функция без аргументов"""
+    prepare_environment(workdir)
+    import hr_psychoanalyst_bot as bot
+    from prompt_ab_testing import PromptABTesting, PromptType
+    from sentiment_analyzer import RussianSentimentAnalyzer
+
+    random.seed(0)
+    benchmarks: Dict[str, Callable[[], object]] = {}
+
+    # Анализ настроения без кэша - стоимость первого появления текста
+    analyzer = RussianSentimentAnalyzer(cache_size=0)
+    benchmarks['sentiment.analyze_text.short'] = lambda: analyzer.analyze_text(SHORT_TEXT)
+    benchmarks['sentiment.analyze_text.medium'] = lambda: analyzer.analyze_text(MEDIUM_TEXT)
+    benchmarks['sentiment.analyze_text.long'] = lambda: analyzer.analyze_text(LONG_TEXT)
+    cached_analyzer = RussianSentimentAnalyzer()
+    benchmarks['sentiment.analyze_text.cached'] = lambda: cached_analyzer.analyze_text(MEDIUM_TEXT)
+
+    benchmarks['bot.analyze_speech_patterns'] = lambda: bot.analyze_speech_patterns(MEDIUM_TEXT)
+    benchmarks['bot.detect_language'] = lambda: bot.detect_language(MEDIUM_TEXT)
+
+    # Сборка промптов: сессия с полной историей и эмоциональной динамикой
+    user_id = 424242
+    session = bot.sessions.get_or_create(user_id)
+    for message in (SHORT_TEXT, MEDIUM_TEXT, LONG_TEXT[:400]) * 5:
+        bot.sessions.append_message(user_id, message)
+        bot.update_emotional_trend(user_id, message)
+    conversation = "\n".join(session.history)
+
+    benchmarks['prompt.psychology_consultation'] = (
+        lambda: bot.get_psychology_consultation_prompt(MEDIUM_TEXT, user_id, session)
+    )
+    benchmarks['prompt.express_analysis'] = (
+        lambda: bot.get_express_analysis_prompt(conversation, session.message_count, user_id)
+    )
+    benchmarks['prompt.full_analysis'] = lambda: bot.get_full_analysis_prompt(FULL_ANALYSIS_ANSWERS)
+
+    # A/B тестирование на отдельной временной базе
+    ab = PromptABTesting(os.path.join(workdir, 'ab_benchmark.db'), batch_size=100, flush_interval=60)
+    benchmarks['ab.evaluate_response_quality'] = lambda: ab.evaluate_response_quality(MEDIUM_TEXT, AI_RESPONSE)
+
+    ab.get_compiled_prompt_for_user(1, PromptType.PSYCHOLOGY_CONSULTATION)
+    benchmarks['ab.prompt_for_user.cached'] = (
+        lambda: ab.get_compiled_prompt_for_user(1, PromptType.PSYCHOLOGY_CONSULTATION)
+    )
+    new_users = itertools.count(1_000_000)
+    benchmarks['ab.prompt_for_user.new_user'] = (
+        lambda: ab.get_compiled_prompt_for_user(next(new_users), PromptType.PSYCHOLOGY_CONSULTATION)
+    )
+
+    def record_and_flush_100() -> None:
+        for index in range(100):
+            ab.record_test_result(
+                user_id=index,
+                prompt_variant_id='psychology_consultation_a' if index % 2 else 'psychology_consultation_b',
+                prompt_type=PromptType.PSYCHOLOGY_CONSULTATION,
+                response_quality=0.5 + (index % 5) / 10,
+                conversion=index % 7 == 0,
+            )
+        ab.flush_results()
+    benchmarks['ab.record_and_flush_100'] = record_and_flush_100
+
+    # Статистика по заполненной таблице результатов
+    stats_ab = PromptABTesting(os.path.join(workdir, 'ab_stats.db'), batch_size=1000, flush_interval=60)
+    for _ in range(100):
+        for index in range(100):
+            stats_ab.record_test_result(
+                user_id=index,
+                prompt_variant_id='psychology_consultation_a' if index % 2 else 'psychology_consultation_b',
+                prompt_type=PromptType.PSYCHOLOGY_CONSULTATION,
+                response_quality=0.5 + (index % 5) / 10,
+                conversion=index % 7 == 0,
+            )
+    stats_ab.flush_results()
+    benchmarks['ab.get_test_statistics.10k'] = (
+        lambda: stats_ab.get_test_statistics(PromptType.PSYCHOLOGY_CONSULTATION)
+    )
+    benchmarks['ab.get_winning_variant.10k'] = (
+        lambda: stats_ab.get_winning_variant(PromptType.PSYCHOLOGY_CONSULTATION)
+    )
+
+    return benchmarks
+
+def run_benchmarks(
+    benchmarks: Dict[str, Callable[[], object]],
+    pattern: Optional[str] = None,
+    repeat: int = 7,
+    min_time: float = 0.2,
+) -> List[BenchmarkResult]:
+    results = []
+    for name, func in benchmarks.items():
+        if pattern and pattern not in name:
+            continue
+        func()  # прогрев: кэши, подготовленные выражения, ленивые импорты
+        result = measure(func, repeat=repeat, min_time=min_time)
+        result.name = name
+        results.append(result)
+        print(format_result(result), flush=True)
+    return results
+
+def format_duration(ns: float) -> str:
+    if ns >= 1e6:
+        return f"{ns / 1e6:8.2f} мс"
+    if ns >= 1e3:
+        return f"{ns / 1e3:8.2f} мкс"
+    return f"{ns:8.0f} нс"
+
+def format_result(result: BenchmarkResult, baseline: Optional[float] = None, threshold: float = 0.1) -> str:
+    line = (
+        f"{result.name:<36} {format_duration(result.ns_per_op)}  "
+        f"(мин {format_duration(result.ns_min).strip()}, ±{result.stdev_pct:.1f}%)"
+    )
+    if baseline:
+        change = result.ns_per_op / baseline - 1
+        marker = "  РЕГРЕССИЯ" if change > threshold else ("  быстрее" if change < -threshold else "")
+        line += f"  {change:+7.1%} к базовому{marker}"
+    return line
+
+def load_baseline(path: str) -> Dict[str, float]:
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return {name: entry['ns_per_op'] for name, entry in data['results'].items()}
+
+def save_baseline(path: str, results: List[BenchmarkResult]) -> None:
+    """Сохранить результаты как базовые (с описанием окружения)"""
+    data = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'results': {result.name: asdict(result) for result in results},
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+def compare(results: List[BenchmarkResult], baseline: Dict[str, float], threshold: float) -> List[str]:
+    """Вывести сравнение с базовыми результатами; возвращает имена регрессий"""
+    regressions = []
+    print(f"\nСравнение с базовыми результатами (порог {threshold:.0%}):")
+    for result in results:
+        reference = baseline.get(result.name)
+        print(format_result(result, reference, threshold) + ("" if reference else "  (нет в базовых)"))
+        if reference and result.ns_per_op / reference - 1 > threshold:
+            regressions.append(result.name)
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки HR-Психоаналитика")
+    parser.add_argument('-k', dest='pattern', help="запускать только бенчмарки, имя которых содержит строку")
+    parser.add_argument('--repeat', type=int, default=7, help="повторов замера")
+    parser.add_argument('--min-time', type=float, default=0.2, help="минимальная длительность повтора, с")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help="файл базовых результатов")
+    parser.add_argument('--save-baseline', action='store_true', help="сохранить результаты как базовые")
+    parser.add_argument('--threshold', type=float, default=0.1, help="допустимое замедление (0.1 = 10%%)")
+    parser.add_argument('--fail-on-regression', action='store_true', help="код выхода 1 при регрессии")
+    parser.add_argument('--json', dest='json_path', help="сохранить результаты в JSON")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="hr-bot-bench-") as workdir:
+        benchmarks = build_benchmarks(workdir)
+        results = run_benchmarks(benchmarks, args.pattern, args.repeat, args.min_time)
+
+        import hr_psychoanalyst_bot as bot
+        bot.ab_testing_manager.close()
+        bot.sessions.close()
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump([asdict(result) for result in results], f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"\nБазовые результаты сохранены в {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nБазовых результатов нет ({args.baseline}): сохраните их флагом --save-baseline")
+        return 0
+
+    regressions = compare(results, load_baseline(args.baseline), args.threshold)
+    if regressions:
+        print(f"\nРегрессии: {', '.join(regressions)}")
+        return 1 if args.fail_on_regression else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Модуль сборки контекста разговора для промптов
+Сообщения добавляются от новых к старым, пока не исчерпан бюджет токенов.
+Токены считаются локально: tiktoken, если установлен, иначе оценка по символам,
+которая подстраивается под фактический расход из ответов OpenAI
+"""
+
+import re
+import logging
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence
+
+try:
+    import tiktoken
+except ImportError:  # необязательная зависимость
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Сколько символов в среднем приходится на токен (cl100k, GPT-4)
+CHARS_PER_TOKEN = {
+    'cyrillic': 2.4,
+    'latin': 4.0,
+    'digit': 3.0,
+}
+
+# Токены разметки одного сообщения в chat completions
+MESSAGE_OVERHEAD_TOKENS = 7
+
+_CYRILLIC = re.compile(r'[а-яёА-ЯЁ]')
+_LATIN = re.compile(r'[a-zA-Z]')
+_DIGIT = re.compile(r'\d')
+_OTHER = re.compile(r'[^\w\s]')
+
+class TokenCounter:
+    """Подсчет токенов: точный через tiktoken или калиброванная оценка"""
+
+    def __init__(self, model: str = "gpt-4", smoothing: float = 0.1):
+        self.model = model
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+
+        # Поправочный коэффициент оценки по фактическому расходу токенов
+        self.correction = 1.0
+        self.observations = 0
+
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+
+        # Сообщения истории повторяются из хода в ход - считаем их один раз
+        self._count_cached = lru_cache(maxsize=4096)(self._count)
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    @staticmethod
+    def estimate(text: str) -> float:
+        """Оценка числа токенов по классам символов"""
+        cyrillic = len(_CYRILLIC.findall(text))
+        latin = len(_LATIN.findall(text))
+        digits = len(_DIGIT.findall(text))
+        punctuation = len(_OTHER.findall(text))
+        words = len(text.split())
+
+        return (
+            cyrillic / CHARS_PER_TOKEN['cyrillic']
+            + latin / CHARS_PER_TOKEN['latin']
+            + digits / CHARS_PER_TOKEN['digit']
+            + punctuation
+            # Граница слова обычно начинает новый токен
+            + words * 0.3
+        )
+
+    def _count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return max(int(round(self.estimate(text) * self.correction)), 1 if text else 0)
+
+    def count(self, text: str) -> int:
+        """Число токенов в тексте"""
+        return self._count_cached(text)
+
+    def observe(self, prompt: str, actual_tokens: Optional[int]) -> None:
+        """Уточнить оценку по фактическому числу токенов промпта (usage.prompt_tokens)"""
+        if self._encoding is not None or not actual_tokens or not prompt:
+            return
+
+        estimated = self.estimate(prompt) + MESSAGE_OVERHEAD_TOKENS
+        if estimated <= 0:
+            return
+
+        with self._lock:
+            ratio = actual_tokens / estimated
+            if self.observations == 0:
+                self.correction = ratio
+            else:
+                self.correction += self.smoothing * (ratio - self.correction)
+            self.observations += 1
+            # Закэшированные значения посчитаны со старым коэффициентом
+            if self.observations % 50 == 1:
+                self._count_cached.cache_clear()
+
+@dataclass
+class ContextWindow:
+    """Собранный контекст"""
+    messages: List[str]  # в хронологическом порядке
+    text: str
+    tokens: int
+    dropped: int  # сколько старых сообщений не вошло в бюджет
+    truncated: bool = False  # самое новое сообщение пришлось обрезать
+
+@dataclass
+class _BudgetStats:
+    builds: int = 0
+    tokens_total: int = 0
+    tokens_max: int = 0
+    dropped_total: int = 0
+    truncated: int = 0
+
+class ContextBuilder:
+    """Сборка контекста разговора в пределах бюджета токенов"""
+
+    def __init__(self, counter: TokenCounter, budgets: Dict[str, int]):
+        self.counter = counter
+        self.budgets = dict(budgets)
+        self._stats: Dict[str, _BudgetStats] = {}
+
+    def build(
+        self,
+        kind: str,
+        messages: Sequence[str],
+        separator: str = "\n",
+        format_message: Callable[[str], str] = str,
+        budget: Optional[int] = None,
+    ) -> ContextWindow:
+        """Взять самые новые сообщения, которые помещаются в бюджет kind"""
+        if budget is None:
+            budget = self.budgets[kind]
+
+        separator_tokens = self.counter.count(separator) if separator.strip() else 0
+        selected: List[str] = []
+        used = 0
+        truncated = False
+
+        for message in reversed(messages):
+            line = format_message(message)
+            tokens = self.counter.count(line) + (separator_tokens if selected else 0)
+
+            if used + tokens > budget:
+                if not selected and budget > 0:
+                    # Даже самое новое сообщение не помещается - берем его конец
+                    line = self._truncate(line, budget)
+                    selected.append(line)
+                    used = self.counter.count(line)
+                    truncated = True
+                break
+
+            selected.append(line)
+            used += tokens
+
+        selected.reverse()
+        window = ContextWindow(
+            messages=selected,
+            text=separator.join(selected),
+            tokens=used,
+            dropped=len(messages) - len(selected),
+            truncated=truncated,
+        )
+        self._record(kind, window)
+        return window
+
+    def _truncate(self, line: str, budget: int) -> str:
+        """Оставить конец строки, укладывающийся в budget токенов"""
+        low, high = 0, len(line)
+        # Бинарный поиск по длине суффикса
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.counter.count("…" + line[len(line) - middle:]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return "…" + line[len(line) - low:] if low < len(line) else line
+
+    def _record(self, kind: str, window: ContextWindow) -> None:
+        logger.debug(f"Context {kind}: {window.tokens} tokens, {len(window.messages)} messages, dropped {window.dropped}")
+        stats = self._stats.setdefault(kind, _BudgetStats())
+        stats.builds += 1
+        stats.tokens_total += window.tokens
+        stats.tokens_max = max(stats.tokens_max, window.tokens)
+        stats.dropped_total += window.dropped
+        stats.truncated += int(window.truncated)
+
+    def get_stats(self) -> Dict:
+        """Статистика использования бюджетов"""
+        return {
+            'exact': self.counter.exact,
+            'correction': self.counter.correction,
+            'budgets': {
+                kind: {
+                    'budget': self.budgets.get(kind, 0),
+                    'builds': stats.builds,
+                    'tokens_avg': stats.tokens_total / stats.builds if stats.builds else 0.0,
+                    'tokens_max': stats.tokens_max,
+                    'dropped_avg': stats.dropped_total / stats.builds if stats.builds else 0.0,
+                    'truncated': stats.truncated,
+                }
+                for kind, stats in self._stats.items()
+            },
+        }
+
+def get_context_builder(model: str = "gpt-4", budgets: Optional[Dict[str, int]] = None) -> ContextBuilder:
+    """Фабричная функция для получения сборщика контекста"""
+    return ContextBuilder(TokenCounter(model), budgets or {})
@@ -0,0 +1,116 @@
+"""
+Модуль кратких содержаний разговора
+Вместо полной истории промпты получают краткое содержание и несколько последних
+сообщений. Содержание обновляется инкрементально (старое содержание + новые
+сообщения) фоновой задачей, не задерживая ответ пользователю
+"""
+
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from prompt_templates import CompiledTemplate
+from session_store import UserSession
+
+logger = logging.getLogger(__name__)
+
+class ConversationSummarizer:
+    """Планировщик фонового обновления краткого содержания разговора"""
+
+    def __init__(
+        self,
+        complete: Callable[[str], Awaitable[Optional[str]]],
+        template: CompiledTemplate,
+        every: int = 6,
+        keep_raw: int = 4,
+        on_update: Optional[Callable[[UserSession], None]] = None,
+    ):
+        self.complete = complete  # запрос к LLM; None - ответ не получен
+        self.template = template  # поля: summary, messages
+        self.every = every
+        self.keep_raw = keep_raw
+        self.on_update = on_update
+
+        self._in_flight: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+        # Метрики
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.lost_messages = 0  # вытеснены из истории, не попав в содержание
+        self.latency_avg = 0.0
+
+    def maybe_schedule(self, session: UserSession) -> bool:
+        """Запустить обновление, если накопилось every новых сообщений сверх keep_raw"""
+        if session.user_id in self._in_flight:
+            return False
+
+        pending = session.unsummarized_messages(skip_last=self.keep_raw)
+        if len(pending) < self.every:
+            return False
+
+        upto = session.message_count - self.keep_raw
+        # Сообщения старше кольцевого буфера истории уже не восстановить: они
+        # считаются обработанными, но учитываются как потерянные
+        lost = upto - session.summary_upto - len(pending)
+        prompt = self.template.render(
+            summary=session.summary or "Пока нет.",
+            messages="\n".join(f"- {message}" for message in pending),
+        )
+
+        self._in_flight.add(session.user_id)
+        task = asyncio.get_running_loop().create_task(self._run(session, prompt, upto, lost))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.scheduled += 1
+        return True
+
+    async def _run(self, session: UserSession, prompt: str, upto: int, lost: int = 0) -> None:
+        """Получить новое содержание и сохранить его в сессии"""
+        started_at = time.monotonic()
+        try:
+            summary = await self.complete(prompt)
+        except Exception as e:
+            logger.error(f"Error summarizing conversation for {session.user_id}: {e}")
+            summary = None
+        finally:
+            self._in_flight.discard(session.user_id)
+
+        if not summary:
+            self.failed += 1
+            return
+
+        # Пока шел запрос, сессию могли сбросить (/start) - не откатываем ее назад
+        if upto <= session.summary_upto or upto > session.message_count:
+            return
+
+        if lost > 0:
+            self.lost_messages += lost
+            logger.warning(f"{lost} messages of {session.user_id} left the history before being summarized")
+
+        session.summary = summary.strip()
+        session.summary_upto = upto
+        if self.on_update is not None:
+            self.on_update(session)
+
+        elapsed = time.monotonic() - started_at
+        self.completed += 1
+        self.latency_avg = elapsed if self.completed == 1 else self.latency_avg + 0.2 * (elapsed - self.latency_avg)
+
+    async def drain(self, timeout: float = 10.0) -> None:
+        """Дождаться незавершенных обновлений (при остановке бота)"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def get_stats(self) -> Dict:
+        """Статистика фоновых обновлений"""
+        return {
+            'in_flight': len(self._in_flight),
+            'scheduled': self.scheduled,
+            'completed': self.completed,
+            'failed': self.failed,
+            'lost_messages': self.lost_messages,
+            'latency_avg': self.latency_avg,
+        }
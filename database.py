@@ -0,0 +1,311 @@
+"""
+Модуль работы с базой данных SQLite
+Общий слой для бота и A/B тестирования: долгоживущие соединения в режиме WAL
+с настроенными PRAGMA и кэшем подготовленных выражений.
+В многопроцессном режиме запись идет через один процесс (DatabaseWriter),
+остальные процессы читают базу напрямую и пересылают ему изменения
+"""
+
+import os
+import queue
+import asyncio
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.getenv("DATABASE_PATH", "psychoanalyst.db")
+
+class Database:
+    """Пул долгоживущих соединений к одному файлу SQLite (по одному на поток)"""
+
+    def __init__(
+        self,
+        path: str = DEFAULT_DB_PATH,
+        cache_size_kib: int = 16384,
+        mmap_size: int = 128 * 1024 * 1024,
+        busy_timeout_ms: int = 5000,
+        cached_statements: int = 256,
+    ):
+        self.path = path
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открыть соединение и настроить PRAGMA"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,  # транзакции управляются явно через transaction()
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kib)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Выполнить несколько операций в одной транзакции"""
+        if _write_forwarder is not None:
+            # Операции накапливаются и уходят процессу-писателю одной транзакцией
+            cursor = _RecordingCursor()
+            yield cursor
+            _write_forwarder.submit(self.path, cursor.statements, wait=not _in_event_loop())
+            return
+
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        else:
+            cursor.execute('COMMIT')
+        finally:
+            cursor.close()
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """Выполнить изменяющий запрос; возвращает число затронутых строк"""
+        if _write_forwarder is not None:
+            return _write_forwarder.submit(self.path, [('execute', sql, tuple(params))], wait=not _in_event_loop())
+        with self.transaction() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        """Выполнить запрос для набора параметров в одной транзакции"""
+        if _write_forwarder is not None:
+            return _write_forwarder.submit(
+                self.path, [('executemany', sql, [tuple(p) for p in seq_of_params])], wait=not _in_event_loop()
+            )
+        with self.transaction() as cursor:
+            cursor.executemany(sql, seq_of_params)
+            return cursor.rowcount
+
+    def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        """Прочитать одну строку"""
+        return self.connection().execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        """Прочитать все строки"""
+        return self.connection().execute(sql, params).fetchall()
+
+    def close(self) -> None:
+        """Закрыть все соединения"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+
+        for conn in connections:
+            try:
+                conn.execute('PRAGMA optimize')
+                conn.close()
+            except sqlite3.Error as e:
+                logger.error(f"Error closing database connection: {e}")
+
+        self._local = threading.local()
+
+    def _forget_connections(self) -> None:
+        """Забыть соединения, унаследованные от родительского процесса при fork"""
+        # Закрывать их в дочернем процессе нельзя: они принадлежат родителю
+        _inherited_connections.extend(self._connections)
+        self._connections = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+Statement = Tuple[str, str, Any]  # (execute | executemany, sql, параметры)
+
+def _in_event_loop() -> bool:
+    """Вызов из потока цикла событий (ожидать ответа писателя там нельзя)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+class _RecordingCursor:
+    """Курсор-заглушка: запоминает изменяющие запросы транзакции для пересылки"""
+
+    rowcount = -1  # становится известно только после выполнения писателем
+
+    def __init__(self):
+        self.statements: List[Statement] = []
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> '_RecordingCursor':
+        self.statements.append(('execute', sql, tuple(params)))
+        return self
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> '_RecordingCursor':
+        self.statements.append(('executemany', sql, [tuple(p) for p in seq_of_params]))
+        return self
+
+class WriteForwarder:
+    """Пересылка изменяющих запросов процессу-писателю (сторона воркера)"""
+
+    def __init__(self, worker_id: int, requests, responses, timeout: float = 30.0):
+        self.worker_id = worker_id
+        self.requests = requests  # общая очередь запросов к писателю
+        self.responses = responses  # очередь ответов этого воркера
+        self.timeout = timeout  # интервал предупреждений о долгом ожидании ответа
+        self.writer_pid = os.getpid()  # создается в процессе-писателе до fork
+
+        # Ответы приходят в одну очередь - запросы из разных потоков идут по одному
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def submit(self, path: str, statements: List[Statement], wait: bool = True) -> int:
+        """Выполнить запросы одной транзакцией у писателя; возвращает число затронутых строк
+
+        wait=False - только поставить в очередь (из цикла событий): писатель не
+        отвечает на такой запрос и сам журналирует ошибку, результат -1
+        """
+        if not statements:
+            return 0
+
+        if not wait:
+            self.requests.put((self.worker_id, None, os.path.abspath(path), statements))
+            return -1
+
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self.requests.put((self.worker_id, request_id, os.path.abspath(path), statements))
+            # Запрос из очереди писатель выполнит в любом случае: ошибка по таймауту
+            # привела бы к повторной отправке уже записанных строк. Поэтому ответа
+            # ждем, пока жив процесс-писатель
+            waited = 0.0
+            while True:
+                try:
+                    response_id, rowcount, error = self.responses.get(timeout=self.timeout)
+                except queue.Empty:
+                    if os.getppid() != self.writer_pid:
+                        raise sqlite3.OperationalError("database writer process is gone")
+                    waited += self.timeout
+                    logger.warning(f"Database writer has not responded for {waited:.0f}s (worker {self.worker_id})")
+                    continue
+                if response_id == request_id:
+                    break
+
+        if error is not None:
+            error_type, message = error
+            raise getattr(sqlite3, error_type, sqlite3.DatabaseError)(message)
+        return rowcount
+
+class DatabaseWriter:
+    """Единственный писатель в базы: выполняет запросы, пересланные воркерами"""
+
+    def __init__(self, requests, responses: Sequence):
+        self.requests = requests
+        self.responses = responses
+        self._thread: Optional[threading.Thread] = None
+
+        # Метрики
+        self.transactions = 0
+        self.statements = 0
+        self.failures = 0
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="database-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            worker_id, request_id, path, statements = request
+            result = self._execute(path, statements)
+            if request_id is not None:
+                self.responses[worker_id].put((request_id, *result))
+
+    def _execute(self, path: str, statements: List[Statement]) -> Tuple[int, Optional[Tuple[str, str]]]:
+        try:
+            rowcount = 0
+            with get_database(path).transaction() as cursor:
+                for method, sql, params in statements:
+                    getattr(cursor, method)(sql, params)
+                    rowcount = cursor.rowcount
+            self.transactions += 1
+            self.statements += len(statements)
+            return rowcount, None
+        except sqlite3.Error as e:
+            self.failures += 1
+            logger.error(f"Forwarded write to {path} failed: {e}")
+            return -1, (type(e).__name__, str(e))
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Дописать принятые запросы и остановить поток"""
+        if self._thread is not None and self._thread.is_alive():
+            self.requests.put(None)
+            self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def get_stats(self) -> Dict:
+        return {
+            'transactions': self.transactions,
+            'statements': self.statements,
+            'failures': self.failures,
+        }
+
+_write_forwarder: Optional[WriteForwarder] = None
+_inherited_connections: List[sqlite3.Connection] = []
+
+def set_write_forwarder(forwarder: Optional[WriteForwarder]) -> None:
+    """Направлять все изменяющие запросы процесса через писателя (None - писать напрямую)"""
+    global _write_forwarder
+    _write_forwarder = forwarder
+
+_databases: Dict[str, Database] = {}
+_databases_lock = threading.Lock()
+
+def get_database(path: str = DEFAULT_DB_PATH) -> Database:
+    """Фабричная функция: один объект Database на файл базы в процессе"""
+    key = os.path.abspath(path)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = Database(path)
+        return _databases[key]
+
+def close_all_databases() -> None:
+    """Закрыть соединения всех баз данных (при остановке бота)"""
+    with _databases_lock:
+        databases = list(_databases.values())
+        _databases.clear()
+
+    for database in databases:
+        database.close()
+
+def _after_fork_in_child() -> None:
+    global _databases_lock
+    _databases_lock = threading.Lock()
+    for database in list(_databases.values()):
+        database._forget_connections()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,32 +1,166 @@
 import os
 import re
 import json
-import sqlite3
+import time
+# Отсчет времени запуска начинается до импорта тяжелых модулей
+PROCESS_STARTED_AT = time.perf_counter()
+import signal
+import asyncio
 import logging
+import secrets
+from contextlib import aclosing, asynccontextmanager
 from datetime import datetime
-from typing import Tuple
+from typing import AsyncIterator, Optional, Tuple
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Bot, Message, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
     filters,
 )
+import httpx
 import openai
 
 # Новые модули для ИИ-улучшений
-from sentiment_analyzer import get_sentiment_analyzer
+from sentiment_analyzer import EmotionalTrend, get_sentiment_analyzer
 from prompt_ab_testing import get_ab_testing_manager, PromptType
+from database import DEFAULT_DB_PATH, get_database, close_all_databases
+from prompt_templates import compile_template
+from keyword_matcher import KeywordMatcher
+from stream_renderer import StreamingMessageRenderer, TELEGRAM_MESSAGE_LIMIT
+from llm_scheduler import get_llm_scheduler, LLMPriority, LLMSchedulerError
+from response_cache import get_response_cache
+from session_store import UserSession, get_session_backend, get_session_store
+from context_builder import ContextWindow, get_context_builder
+from conversation_summarizer import ConversationSummarizer
+from http_server import HTTPServer, create_ssl_context
+from webhook_server import UpdateDispatcher, WebhookServer
+from profiler import ProfilerError, get_profiler
+from metrics import (
+    GaugeSample,
+    InstrumentedRequest,
+    MetricsRegistry,
+    StartupTimer,
+    create_metrics_server,
+    get_bot_metrics,
+)
+from supervisor import WorkerContext, WorkerPool, broadcast_clear, consume_updates, get_worker_context, poll_updates
+
+startup = StartupTimer(PROCESS_STARTED_AT)
+startup.mark('imports')
 
 # ENV
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PAYMENT_TOKEN = os.getenv("PAYMENT_TOKEN")  # Для оплаты
+# Telegram ID администраторов через запятую (/stats, /clear, /profile)
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "123456789").split(",") if admin_id.strip()}
+
+# Настройки OpenAI клиента и пула HTTP-соединений
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "120"))
+
+# Потоковый вывод ответов (редактирование одного сообщения по мере генерации)
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "20"))
+
+# Ограничение одновременных запросов к LLM
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "100"))
+
+# Отложенная пакетная запись результатов A/B тестов
+AB_FLUSH_BATCH_SIZE = int(os.getenv("AB_FLUSH_BATCH_SIZE", "100"))
+AB_FLUSH_INTERVAL_MS = int(os.getenv("AB_FLUSH_INTERVAL_MS", "500"))
+AB_MAX_PENDING = int(os.getenv("AB_MAX_PENDING", "10000"))
+
+# Семантический кэш ответов на первые сообщения (без истории разговора)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.8"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH") or None
+
+# Кэш результатов анализа настроения (повторные короткие сообщения)
+SENTIMENT_CACHE_SIZE = int(os.getenv("SENTIMENT_CACHE_SIZE", "2048"))
+SENTIMENT_CACHE_TTL = float(os.getenv("SENTIMENT_CACHE_TTL", "3600"))
+# Вес нового сообщения в скользящем среднем эмоционального состояния
+EMOTIONAL_TREND_ALPHA = float(os.getenv("EMOTIONAL_TREND_ALPHA", "0.3"))
+
+# Сессии пользователей в памяти
+SESSION_MAX_HISTORY = int(os.getenv("SESSION_MAX_HISTORY", "15"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(24 * 3600)))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+SESSION_MAX_MEMORY_MB = int(os.getenv("SESSION_MAX_MEMORY_MB", "64"))
+
+# Бюджеты токенов на историю разговора в промптах
+CONTEXT_BUDGET_CONSULTATION = int(os.getenv("CONTEXT_BUDGET_CONSULTATION", "600"))
+CONTEXT_BUDGET_SMALL_TALK = int(os.getenv("CONTEXT_BUDGET_SMALL_TALK", "400"))
+CONTEXT_BUDGET_EXPRESS = int(os.getenv("CONTEXT_BUDGET_EXPRESS", "1500"))
+
+# Краткое содержание разговора вместо полной истории (обновляется в фоне)
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+SUMMARY_EVERY = int(os.getenv("SUMMARY_EVERY", "6"))
+SUMMARY_KEEP_RAW = int(os.getenv("SUMMARY_KEEP_RAW", "4"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "250"))
+
+# Сохранение сессий в SQLite (переживают перезапуск и деплой)
+SESSION_PERSIST = os.getenv("SESSION_PERSIST", "true").lower() in ("1", "true", "yes")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH") or os.path.join(os.path.dirname(DEFAULT_DB_PATH), "sessions.db")
+SESSION_FLUSH_INTERVAL_MS = int(os.getenv("SESSION_FLUSH_INTERVAL_MS", "1000"))
+SESSION_PERSIST_TTL = float(os.getenv("SESSION_PERSIST_TTL", str(30 * 24 * 3600)))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8080")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+# Число процессов-воркеров (auto - по числу ядер); больше 1 - режим supervisor
+_bot_processes = os.getenv("BOT_PROCESSES", "1").lower()
+BOT_PROCESSES = (os.cpu_count() or 1) if _bot_processes == "auto" else int(_bot_processes)
+
+# Метрики в формате Prometheus (0 - не поднимать HTTP-сервер метрик)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+
+# Загрузить отложенные модули (VADER, scikit-learn) и данные сразу после запуска, а не на первом сообщении
+WARM_UP = os.getenv("WARM_UP", "true").lower() in ("1", "true", "yes")
+
+# Профилирование по команде /profile
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+AI_ERROR_MESSAGE = "Извините, произошла ошибка при обработке запроса. Попробуйте позже."
+AI_BUSY_MESSAGE = "Сейчас очень много обращений, я не успеваю ответить. Пожалуйста, напишите чуть позже. 💙"
+
+class AIResponseError(Exception):
+    """Ответ ИИ не получен или оборван; message - текст для пользователя"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден в переменных окружения")
@@ -43,12 +177,68 @@ logger = logging.getLogger(__name__)
 (WAITING_MESSAGE, IN_EXPRESS_ANALYSIS, IN_FULL_ANALYSIS, Q1, Q2, Q3, Q4, Q5, Q6, Q7) = range(10)
 
 # Storage
-user_data = {}
-conversation_history = {}
+sessions = get_session_store(
+    max_history=SESSION_MAX_HISTORY,
+    idle_ttl=SESSION_IDLE_TTL,
+    max_entries=SESSION_MAX_ENTRIES,
+    max_memory_bytes=SESSION_MAX_MEMORY_MB * 1024 * 1024,
+    backend=get_session_backend(
+        SESSION_DB_PATH,
+        flush_interval=SESSION_FLUSH_INTERVAL_MS / 1000,
+        ttl=SESSION_PERSIST_TTL,
+    ) if SESSION_PERSIST else None,
+)
+
+# База данных (общие долгоживущие соединения)
+db = get_database()
+startup.mark('storage')
 
 # ИИ модули
-sentiment_analyzer = get_sentiment_analyzer()
-ab_testing_manager = get_ab_testing_manager()
+sentiment_analyzer = get_sentiment_analyzer(cache_size=SENTIMENT_CACHE_SIZE, cache_ttl=SENTIMENT_CACHE_TTL)
+ab_testing_manager = get_ab_testing_manager(
+    batch_size=AB_FLUSH_BATCH_SIZE,
+    flush_interval=AB_FLUSH_INTERVAL_MS / 1000,
+    max_pending=AB_MAX_PENDING,
+)
+startup.mark('ab_testing')
+context_builder = get_context_builder(OPENAI_MODEL, {
+    'consultation': CONTEXT_BUDGET_CONSULTATION,
+    'small_talk': CONTEXT_BUDGET_SMALL_TALK,
+    'express': CONTEXT_BUDGET_EXPRESS,
+})
+summarizer = ConversationSummarizer(
+    complete=lambda prompt: complete_summary(prompt),
+    template=compile_template("""
+Ты ведешь рабочие заметки психолога о разговоре с клиентом.
+
+ТЕКУЩИЕ ЗАМЕТКИ:
+{summary}
+
+НОВЫЕ СООБЩЕНИЯ КЛИЕНТА:
+{messages}
+
+Обнови заметки с учетом новых сообщений: ситуация клиента, факты о нем, чувства,
+запросы и цели. Сохрани важное из текущих заметок. Не более 120 слов,
+без вступлений - только текст заметок.
+"""),
+    every=SUMMARY_EVERY,
+    keep_raw=SUMMARY_KEEP_RAW,
+    on_update=sessions.update,
+)
+llm_scheduler = get_llm_scheduler(max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE)
+response_cache = get_response_cache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    threshold=RESPONSE_CACHE_THRESHOLD,
+    persist_path=RESPONSE_CACHE_PATH,
+)
+metrics = get_bot_metrics()
+metrics_server: Optional[HTTPServer] = None
+profiler = get_profiler(interval=PROFILE_INTERVAL_MS / 1000, output_dir=PROFILE_DIR)
+# Обновление с командой /profile не входит в N профилируемых обновлений
+profile_command_update_id: Optional[int] = None
+profile_report_task: Optional[asyncio.Task] = None
+startup.mark('services')
 
 # Professional 7 questions for full analysis
 PROFESSIONAL_QUESTIONS = [
@@ -63,9 +253,7 @@ PROFESSIONAL_QUESTIONS = [
 
 # Database functions
 def init_database():
-    conn = sqlite3.connect('psychoanalyst.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS clients (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             telegram_id INTEGER UNIQUE,
@@ -76,27 +264,16 @@ def init_database():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
 
 def save_analysis(telegram_id: int, name: str, analysis_type: str, analysis_data: dict, payment_status: str = 'free'):
-    conn = sqlite3.connect('psychoanalyst.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+    db.execute('''
         INSERT OR REPLACE INTO clients 
         (telegram_id, name, analysis_type, analysis_data, payment_status, created_at)
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (telegram_id, name, analysis_type, json.dumps(analysis_data), payment_status, datetime.now()))
-    conn.commit()
-    conn.close()
 
 def get_user_analyses(telegram_id: int):
-    conn = sqlite3.connect('psychoanalyst.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM clients WHERE telegram_id = ? ORDER BY created_at DESC', (telegram_id,))
-    analyses = cursor.fetchall()
-    conn.close()
-    return analyses
+    return db.fetchall('SELECT * FROM clients WHERE telegram_id = ? ORDER BY created_at DESC', (telegram_id,))
 
 # Language detection
 def detect_language(text: str) -> str:
@@ -113,71 +290,40 @@ def detect_language(text: str) -> str:
     return 'ru'
 
 # Speech pattern analysis
-def analyze_speech_patterns(text: str) -> dict:
-    """Анализ паттернов речи для определения роли ИИ"""
-    text_lower = text.lower()
-    
-    patterns = {
-        'psychology_need': False,
-        'career_need': False,
-        'emotional_support': False,
-        'cancellation': False,
-        'provocative': False,
-        'topic_change': False,
-        'self_introduction_request': False,
-        'dream_expression': False
-    }
-    
+# Словари намерений: все фразы компилируются в один автомат поиска
+INTENT_LEXICONS = {
     # Психологическая помощь
-    psychology_keywords = ['сон', 'сны', 'депрессия', 'тревога', 'стресс', 'паника', 'страх', 'грусть', 'одиночество', 'отношения', 'семья', 'родители', 'дети', 'любовь', 'развод', 'смерть', 'потеря', 'плохо', 'больно', 'страшно']
-    if any(keyword in text_lower for keyword in psychology_keywords):
-        patterns['psychology_need'] = True
-    
+    'psychology_need': ['сон', 'сны', 'депрессия', 'тревога', 'стресс', 'паника', 'страх', 'грусть', 'одиночество', 'отношения', 'семья', 'родители', 'дети', 'любовь', 'развод', 'смерть', 'потеря', 'плохо', 'больно', 'страшно'],
     # Карьерные вопросы
-    career_keywords = ['работа', 'карьера', 'профессия', 'зарплата', 'деньги', 'учеба', 'образование', 'навыки', 'опыт', 'компания', 'начальник', 'коллеги']
-    if any(keyword in text_lower for keyword in career_keywords):
-        patterns['career_need'] = True
-    
+    'career_need': ['работа', 'карьера', 'профессия', 'зарплата', 'деньги', 'учеба', 'образование', 'навыки', 'опыт', 'компания', 'начальник', 'коллеги'],
     # Эмоциональная поддержка
-    emotional_keywords = ['одинок', 'грустно', 'плохо', 'устал', 'устала', 'сложно', 'трудно', 'помоги', 'поддержка', 'понимаю', 'понимаешь']
-    if any(keyword in text_lower for keyword in emotional_keywords):
-        patterns['emotional_support'] = True
-    
+    'emotional_support': ['одинок', 'грустно', 'плохо', 'устал', 'устала', 'сложно', 'трудно', 'помоги', 'поддержка', 'понимаю', 'понимаешь'],
     # Отмена/прекращение
-    cancellation_keywords = ['не хочу', 'хватит', 'достаточно', 'стоп', 'прекрати', 'остановись', 'не буду', 'не буду говорить', 'не хочу говорить', 'хватит говорить']
-    if any(keyword in text_lower for keyword in cancellation_keywords):
-        patterns['cancellation'] = True
-    
+    'cancellation': ['не хочу', 'хватит', 'достаточно', 'стоп', 'прекрати', 'остановись', 'не буду', 'не буду говорить', 'не хочу говорить', 'хватит говорить'],
+    # Провокационные вопросы и непонимание
+    'provocative': ['глупый', 'тупой', 'бесполезный', 'не понимаешь', 'не слушаешь', 'плохой', 'ужасный', 'ненавижу', 'ненавидишь', 'не понял', 'не поняла', 'не понимаешь меня'],
     # Смена темы
-    topic_change_keywords = ['другое', 'другая тема', 'давай о', 'поговорим о', 'хочу поговорить о', 'смени тему', 'не об этом']
-    if any(keyword in text_lower for keyword in topic_change_keywords):
-        patterns['topic_change'] = True
-    
+    'topic_change': ['другое', 'другая тема', 'давай о', 'поговорим о', 'хочу поговорить о', 'смени тему', 'не об этом'],
     # Запрос рассказать о себе
-    self_intro_keywords = ['расскажи о себе', 'расскажи о тебе', 'кто ты', 'что ты', 'как ты работаешь', 'твоя история', 'твоя работа', 'что ты умеешь', 'что умеешь']
-    if any(keyword in text_lower for keyword in self_intro_keywords):
-        patterns['self_introduction_request'] = True
-    
+    'self_introduction_request': ['расскажи о себе', 'расскажи о тебе', 'кто ты', 'что ты', 'как ты работаешь', 'твоя история', 'твоя работа', 'что ты умеешь', 'что умеешь'],
     # Мечты и цели
-    dream_keywords = ['хочу стать', 'мечтаю', 'мечта', 'цель', 'планирую', 'буду', 'стану']
-    if any(keyword in text_lower for keyword in dream_keywords):
-        patterns['dream_expression'] = True
-    
-    # Провокационные вопросы и непонимание
-    provocative_keywords = ['глупый', 'тупой', 'бесполезный', 'не понимаешь', 'не слушаешь', 'плохой', 'ужасный', 'ненавижу', 'ненавидишь', 'не понял', 'не поняла', 'не понимаешь меня']
-    if any(keyword in text_lower for keyword in provocative_keywords):
-        patterns['provocative'] = True
-    
-    return patterns
+    'dream_expression': ['хочу стать', 'мечтаю', 'мечта', 'цель', 'планирую', 'буду', 'стану'],
+    # Ссылки на предыдущий разговор
+    'reference_previous': ['мы говорили', 'говорили об этом', 'смотри выше', 'выше', 'раньше говорил', 'раньше сказал', 'об этом', 'это то что'],
+    # Запрос полного анализа
+    'full_analysis_request': ['полный анализ', 'детальный анализ', 'платный анализ'],
+}
+
+intent_matcher = KeywordMatcher(INTENT_LEXICONS)
+
+def analyze_speech_patterns(text: str) -> dict:
+    """Анализ паттернов речи для определения роли ИИ (один проход по тексту)"""
+    found = intent_matcher.match_categories(text)
+    return {category: category in found for category in INTENT_LEXICONS}
 
 # Professional prompts with A/B testing
-def get_express_analysis_prompt(conversation: str, message_count: int, user_id: int) -> Tuple[str, str]:
-    """Получить промпт для экспресс-анализа с учетом A/B тестирования"""
-    template, variant_id = ab_testing_manager.get_prompt_for_user(user_id, PromptType.EXPRESS_ANALYSIS)
-    
-    if not template:
-        # Fallback к стандартному промпту
-        template = """
+# Встроенные шаблоны компилируются один раз при загрузке модуля
+EXPRESS_ANALYSIS_TEMPLATE = compile_template("""
 Ты — профессиональный HR-психоаналитик и карьерный консультант. 
 
 ДИАЛОГ КЛИЕНТА ({message_count} сообщений):
@@ -201,16 +347,11 @@ def get_express_analysis_prompt(conversation: str, message_count: int, user_id:
 ⚠️ Зоны развития: [что стоит развивать]
 
 СТИЛЬ: Профессиональный, эмпатичный, конкретный. Максимум 300 слов.
-"""
-        variant_id = "default"
-    
-    prompt = template.format(conversation=conversation, message_count=message_count)
-    return prompt, variant_id
+""")
 
-def get_full_analysis_prompt(answers: list) -> str:
-    answers_text = "\n".join([f"{i+1}. {q}\nОтвет: {a}\n" for i, (q, a) in enumerate(zip(PROFESSIONAL_QUESTIONS, answers))])
-    
-    return f"""
+FULL_ANALYSIS_ANSWER_TEMPLATE = compile_template("{number}. {question}\nОтвет: {answer}\n")
+
+FULL_ANALYSIS_TEMPLATE = compile_template("""
 Ты — ведущий психоаналитик и HR-эксперт с 20-летним опытом.
 
 ДЕТАЛЬНЫЕ ОТВЕТЫ КЛИЕНТА:
@@ -254,18 +395,9 @@ def get_full_analysis_prompt(answers: list) -> str:
 - Рекомендации по саморазвитию
 
 СТИЛЬ: Профессиональный, детальный, практичный. 800-1200 слов.
-"""
+""")
 
-def get_psychology_consultation_prompt(user_message: str, user_id: int, conversation_history: list = None) -> Tuple[str, str]:
-    """Получить промпт для психологической консультации с учетом A/B тестирования и анализа настроения"""
-    # Анализ настроения пользователя
-    sentiment_result = sentiment_analyzer.analyze_text(user_message)
-    
-    template, variant_id = ab_testing_manager.get_prompt_for_user(user_id, PromptType.PSYCHOLOGY_CONSULTATION)
-    
-    if not template:
-        # Fallback к стандартному промпту с контекстом
-        template = """
+PSYCHOLOGY_CONSULTATION_TEMPLATE = compile_template("""
 Ты — опытный психолог с большим сердцем. Твоя главная задача - ПОДДЕРЖАТЬ и ПОНИМАТЬ.
 
 ИСТОРИЯ РАЗГОВОРА:
@@ -292,62 +424,333 @@ def get_psychology_consultation_prompt(user_message: str, user_id: int, conversa
 💡 Мягкие рекомендации (если уместно)
 
 СТИЛЬ: Теплый, понимающий, как разговор с близким другом, который помнит всё. 150-300 слов.
-"""
+""")
+
+SMALL_TALK_TEMPLATE = compile_template("""
+Ты — HR-психоаналитик и карьерный консультант. 
+
+КОНТЕКСТ РАЗГОВОРА:
+{previous_context}
+
+ТЕКУЩЕЕ СООБЩЕНИЕ:
+{text}
+
+ВАЖНО: Если пользователь ссылается на предыдущие части разговора, обязательно учитывай контекст выше.
+
+АНАЛИЗ ПОЛЬЗОВАТЕЛЯ:
+- Основная потребность: {focus}
+- Роль: {primary_role}
+- Эмоциональный фон разговора: {emotional_trend}
+
+ТВОИ РОЛИ (адаптивные):
+1. ПСИХОЛОГ - эмпатия, поддержка, понимание эмоций
+2. HR-СПЕЦИАЛИСТ - анализ личности, карьерные рекомендации  
+3. КОНСУЛЬТАНТ - помощь с выбором профессии и развитием
+
+ПРИНЦИПЫ:
+- СНАЧАЛА прояви эмпатию и понимание
+- ПОМНИ весь контекст разговора
+- Адаптируйся к потребностям пользователя
+- Поддерживай эмоционально
+- Мягко подводи к самоанализу
+- Если пользователь ссылается на предыдущее - обратись к контексту
+
+ФОРМАТ: Эмпатичный ответ (1-2 предложения) + релевантный вопрос.
+
+СТИЛЬ: Теплый, профессиональный, адаптивный к ситуации, помнящий контекст.
+""")
+
+def update_emotional_trend(user_id: int, text: str) -> EmotionalTrend:
+    """Учесть новое сообщение в эмоциональной динамике пользователя (O(1) на сообщение)"""
+    session = sessions.get_or_create(user_id)
+    if session.emotional_trend is None:
+        session.emotional_trend = EmotionalTrend(EMOTIONAL_TREND_ALPHA)
+    session.emotional_trend.update(sentiment_analyzer.analyze_text(text))
+    sessions.update(session)
+    return session.emotional_trend
+
+def describe_emotional_trend(user_id: int) -> str:
+    """Эмоциональная динамика разговора для подстановки в промпт"""
+    session = sessions.get(user_id)
+    trend = session.emotional_trend if session else None
+    return (trend or EmotionalTrend(EMOTIONAL_TREND_ALPHA)).describe()
+
+def build_conversation_context(
+    kind: str, session: UserSession, skip_last: int = 1, separator: str = "\n", format_message=str
+) -> Tuple[str, ContextWindow]:
+    """Краткое содержание разговора и самые новые сообщения, которые в него еще не вошли"""
+    summary = session.summary
+    budget = context_builder.budgets[kind]
+    if summary:
+        budget = max(budget - context_builder.counter.count(summary), 0)
+    
+    window = context_builder.build(
+        kind, session.unsummarized_messages(skip_last), separator, format_message, budget
+    )
+    return summary, window
+
+def format_conversation_context(summary: str, window: ContextWindow, header: str) -> str:
+    """Текст контекста для промпта: краткое содержание + последние сообщения"""
+    parts = []
+    if summary:
+        parts.append("Краткое содержание разговора:\n" + summary)
+    if window.messages:
+        parts.append(header + "\n" + window.text)
+    return "\n\n".join(parts)
+
+def get_express_analysis_prompt(conversation: str, message_count: int, user_id: int) -> Tuple[str, str]:
+    """Получить промпт для экспресс-анализа с учетом A/B тестирования"""
+    with metrics.stage('ab_lookup'):
+        template, variant_id = ab_testing_manager.get_compiled_prompt_for_user(user_id, PromptType.EXPRESS_ANALYSIS)
+    
+    if template is None:
+        # Fallback к стандартному промпту
+        template = EXPRESS_ANALYSIS_TEMPLATE
+        variant_id = "default"
+    
+    values = {'conversation': conversation, 'message_count': message_count}
+    if 'emotional_trend' in template.fields:
+        values['emotional_trend'] = describe_emotional_trend(user_id)
+    
+    prompt = template.render(**values)
+    return prompt, variant_id
+
+def get_full_analysis_prompt(answers: list) -> str:
+    answers_text = "\n".join([
+        FULL_ANALYSIS_ANSWER_TEMPLATE.render(number=i + 1, question=q, answer=a)
+        for i, (q, a) in enumerate(zip(PROFESSIONAL_QUESTIONS, answers))
+    ])
+    
+    return FULL_ANALYSIS_TEMPLATE.render(answers_text=answers_text)
+
+def get_psychology_consultation_prompt(user_message: str, user_id: int, session: Optional[UserSession] = None) -> Tuple[str, str]:
+    """Получить промпт для психологической консультации с учетом A/B тестирования и анализа настроения"""
+    with metrics.stage('ab_lookup'):
+        template, variant_id = ab_testing_manager.get_compiled_prompt_for_user(user_id, PromptType.PSYCHOLOGY_CONSULTATION)
+    
+    if template is None:
+        # Fallback к стандартному промпту с контекстом
+        template = PSYCHOLOGY_CONSULTATION_TEMPLATE
         variant_id = "default"
     
+    values = {'user_message': user_message}
+    
     # Подготавливаем контекст разговора
-    conversation_context = ""
-    if conversation_history and len(conversation_history) > 1:
-        # Берем последние 10 сообщений для контекста
-        recent_messages = conversation_history[-10:] if len(conversation_history) > 10 else conversation_history[:-1]  # исключаем текущее сообщение
-        conversation_context = "Предыдущие сообщения:\n" + "\n".join([f"- {msg}" for msg in recent_messages])
-    else:
-        conversation_context = "Это первое сообщение в разговоре."
+    if 'conversation_context' in template.fields:
+        if session is not None and len(session.history) > 1:
+            # Краткое содержание и самые новые сообщения в пределах бюджета токенов (текущее исключаем)
+            summary, window = build_conversation_context(
+                'consultation', session, format_message=lambda msg: f"- {msg}"
+            )
+            values['conversation_context'] = format_conversation_context(summary, window, "Предыдущие сообщения:")
+        else:
+            values['conversation_context'] = "Это первое сообщение в разговоре."
     
-    # Форматируем промпт с учетом анализа настроения
-    sentiment_info = f"""Настроение: {sentiment_result.overall_sentiment} (уверенность: {sentiment_result.confidence:.2f})
+    # Анализ настроения нужен только шаблонам, которые его используют
+    if 'sentiment_analysis' in template.fields:
+        sentiment_result = sentiment_analyzer.analyze_text(user_message)
+        values['sentiment_analysis'] = f"""Настроение: {sentiment_result.overall_sentiment} (уверенность: {sentiment_result.confidence:.2f})
 Рекомендуемый стиль ответа: {sentiment_result.recommendation}
 Психологические показатели: стресс={sentiment_result.psychological_indicators.get('stress_level', 0):.2f}, тревога={sentiment_result.psychological_indicators.get('anxiety_level', 0):.2f}"""
     
-    if '{sentiment_analysis}' in template:
-        prompt = template.format(
-            user_message=user_message, 
-            conversation_context=conversation_context,
-            sentiment_analysis=sentiment_info
-        )
-    elif '{conversation_context}' in template:
-        prompt = template.format(
-            user_message=user_message,
-            conversation_context=conversation_context
-        )
-    else:
-        prompt = template.format(user_message=user_message)
+    if 'emotional_trend' in template.fields:
+        values['emotional_trend'] = describe_emotional_trend(user_id)
     
+    prompt = template.render(**values)
     return prompt, variant_id
 
 # OpenAI client
-async def get_ai_response(prompt: str, max_tokens: int = 1000) -> str:
+openai_client: Optional[openai.AsyncOpenAI] = None
+
+def create_openai_client() -> openai.AsyncOpenAI:
+    """Создать асинхронный клиент OpenAI с общим пулом keep-alive соединений"""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    )
+    return openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=http_client,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=OPENAI_TIMEOUT,
+    )
+
+def get_openai_client() -> openai.AsyncOpenAI:
+    """Получить общий клиент OpenAI (создается один раз на процесс)"""
+    global openai_client
+    if openai_client is None:
+        openai_client = create_openai_client()
+    return openai_client
+
+async def close_openai_client() -> None:
+    """Закрыть клиент OpenAI и освободить соединения пула"""
+    global openai_client
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
+
+async def get_ai_response(
+    prompt: str,
+    max_tokens: int = 1000,
+    priority: LLMPriority = LLMPriority.SMALL_TALK,
+) -> str:
+    """Ответ ИИ целиком; при ошибке - AIResponseError с текстом для пользователя"""
+    lane = priority.name.lower()
+    started_at = None
     try:
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=max_tokens,
-            temperature=0.7,
-            timeout=60,
+        client = get_openai_client()
+        async with llm_scheduler.slot(priority):
+            started_at = time.perf_counter()
+            response = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=0.7,
+            )
+        usage = response.usage
+        metrics.observe_llm(
+            lane, 'ok', time.perf_counter() - started_at,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
         )
+        # Фактический расход токенов уточняет локальную оценку
+        context_builder.counter.observe(prompt, usage.prompt_tokens if usage else None)
         return response.choices[0].message.content.strip()
+    except LLMSchedulerError as e:
+        metrics.observe_llm(lane, 'rejected')
+        logger.warning(f"LLM request rejected: {e}")
+        raise AIResponseError(AI_BUSY_MESSAGE) from e
     except Exception as e:
+        metrics.observe_llm(lane, 'error', time.perf_counter() - started_at if started_at else None)
         logger.error(f"OpenAI error: {e}")
-        return "Извините, произошла ошибка при обработке запроса. Попробуйте позже."
+        raise AIResponseError(AI_ERROR_MESSAGE) from e
+
+async def complete_summary(prompt: str) -> Optional[str]:
+    """Запрос краткого содержания разговора (низший приоритет)"""
+    try:
+        return await get_ai_response(prompt, max_tokens=SUMMARY_MAX_TOKENS, priority=LLMPriority.BACKGROUND)
+    except AIResponseError:
+        return None
+
+async def stream_ai_response(
+    prompt: str,
+    max_tokens: int = 1000,
+    priority: LLMPriority = LLMPriority.SMALL_TALK,
+) -> AsyncIterator[str]:
+    """Потоковая генерация ответа: отдает токены по мере их получения
+
+    Если ответ не получен или оборвался после первых токенов - AIResponseError
+    """
+    yielded = False
+    lane = priority.name.lower()
+    started_at = None
+    parts = []
+    try:
+        client = get_openai_client()
+        async with llm_scheduler.slot(priority):
+            started_at = time.perf_counter()
+            stream = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=0.7,
+                stream=True,
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not yielded:
+                        metrics.llm_first_token_seconds.observe(time.perf_counter() - started_at, priority=lane)
+                    yielded = True
+                    parts.append(delta)
+                    yield delta
+        # В потоке usage не приходит - токены считаем локально
+        metrics.observe_llm(
+            lane, 'ok', time.perf_counter() - started_at, mode='stream',
+            prompt_tokens=context_builder.counter.count(prompt),
+            completion_tokens=context_builder.counter.count("".join(parts)),
+        )
+    except LLMSchedulerError as e:
+        metrics.observe_llm(lane, 'rejected')
+        logger.warning(f"LLM request rejected: {e}")
+        raise AIResponseError(AI_BUSY_MESSAGE) from e
+    except Exception as e:
+        metrics.observe_llm(lane, 'error', time.perf_counter() - started_at if started_at else None, mode='stream')
+        logger.error(f"OpenAI streaming error: {e}")
+        raise AIResponseError(AI_ERROR_MESSAGE) from e
+
+async def respond_with_ai(
+    update: Update,
+    thinking_msg: Message,
+    prompt: str,
+    max_tokens: int,
+    priority: LLMPriority = LLMPriority.SMALL_TALK,
+    parse_mode: Optional[str] = None,
+    part_prefix: str = "",
+) -> Tuple[str, bool]:
+    """Ответить пользователю ответом ИИ вместо сообщения-заглушки
+
+    Возвращает показанный текст и признак того, что ответ получен полностью
+    """
+    if STREAM_RESPONSES:
+        renderer = StreamingMessageRenderer(
+            thinking_msg,
+            send_message=update.message.reply_text,
+            error_message=AI_ERROR_MESSAGE,
+            parse_mode=parse_mode,
+            min_interval=STREAM_EDIT_INTERVAL,
+            min_chars=STREAM_MIN_CHARS,
+            part_prefix=part_prefix,
+        )
+        try:
+            # aclosing: при ошибке Telegram генератор закрывается сразу и освобождает
+            # слот LLM и HTTP-поток, не дожидаясь сборки мусора
+            async with aclosing(stream_ai_response(prompt, max_tokens=max_tokens, priority=priority)) as stream:
+                async for delta in stream:
+                    await renderer.feed(delta)
+        except AIResponseError as e:
+            return await renderer.finish(error=e.message), False
+        completed = bool(renderer.text.strip())
+        return await renderer.finish(), completed
+
+    try:
+        response = await get_ai_response(prompt, max_tokens=max_tokens, priority=priority)
+        completed = True
+    except AIResponseError as e:
+        response = e.message
+        completed = False
+    if not response.strip():
+        # Пустое сообщение Telegram не отправит
+        response, completed = AI_ERROR_MESSAGE, False
+    await thinking_msg.delete()
+
+    # Split long response
+    max_length = TELEGRAM_MESSAGE_LIMIT
+    parts = [response[i:i+max_length] for i in range(0, len(response), max_length)] or [response]
+    for i, part in enumerate(parts):
+        prefix = part_prefix.format(part=i + 1) if i > 0 else ""
+        await update.message.reply_text(prefix + part, parse_mode=parse_mode)
+    return response, completed
+
+async def reply_markdown(update: Update, text: str) -> None:
+    """Отправить ответ с Markdown, при ошибке разметки - простым текстом"""
+    try:
+        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    except BadRequest:
+        await update.message.reply_text(text)
 
 # Main handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     
     # Clear previous data
-    user_data.pop(user.id, None)
-    conversation_history.pop(user.id, None)
+    sessions.discard(user.id)
     
     welcome_text = """
 🤗 **HR-Психоаналитик | Карьерный консультант**
@@ -392,6 +795,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 /cancel - отменить текущий процесс
 /reset - сбросить бота
 /stats - статистика (только админ)
+/profile - профилирование (только админ)
 
 **🤖 ИИ-возможности:**
 • Анализ эмоций и настроения в реальном времени
@@ -404,36 +808,47 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    user_data.pop(user.id, None)
-    conversation_history.pop(user.id, None)
+    sessions.discard(user.id)
     
     await update.message.reply_text(
         "Анализ отменен. Для нового анализа используйте /start"
     )
     return ConversationHandler.END
 
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_IDS
+
+def clear_local_caches() -> None:
+    """Сбросить сессии и кэши этого процесса"""
+    sessions.clear()
+    response_cache.clear()
+    sentiment_analyzer.cache.clear()
+    ab_testing_manager.clear_assignments()
+
+def clear_database() -> None:
+    """Удалить клиентов и данные A/B тестов одной транзакцией"""
+    ab_testing_manager.flush_results()
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM clients')
+        ab_testing_manager.reset_test_data(cursor)
+
 async def clear_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Очистить память бота (только для админов)"""
     user = update.effective_user
     
-    # Проверка на админа (можно настроить)
-    if user.id != 123456789:  # Замените на ваш Telegram ID
+    # Проверка на админа (ADMIN_IDS)
+    if not is_admin(user.id):
         await update.message.reply_text("❌ У вас нет прав для этой команды")
         return
     
-    # Очистка памяти
-    user_data.clear()
-    conversation_history.clear()
+    # Очистка памяти (в многопроцессном режиме - во всех воркерах)
+    clear_local_caches()
+    broadcast_clear()
     
     # Очистка базы данных
     try:
-        conn = sqlite3.connect('psychoanalyst.db')
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM clients')
-        cursor.execute('DELETE FROM user_variant_assignments')  # Очищаем A/B назначения
-        cursor.execute('DELETE FROM ab_test_results')  # Очищаем результаты тестов
-        conn.commit()
-        conn.close()
+        # В потоке: в многопроцессном режиме запись ждет ответа процесса-писателя
+        await asyncio.to_thread(clear_database)
         
         await update.message.reply_text(
             "✅ Память бота полностью очищена:\n"
@@ -451,8 +866,7 @@ async def reset_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     
     # Очистка данных пользователя
-    user_data.pop(user.id, None)
-    conversation_history.pop(user.id, None)
+    sessions.discard(user.id)
     
     await update.message.reply_text(
         "🔄 Бот сброшен!\n\n"
@@ -463,8 +877,8 @@ async def show_ab_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     """Показать статистику A/B тестирования (только для админов)"""
     user = update.effective_user
     
-    # Проверка на админа (можно настроить)
-    if user.id != 123456789:  # Замените на ваш Telegram ID
+    # Проверка на админа (ADMIN_IDS)
+    if not is_admin(user.id):
         await update.message.reply_text("❌ У вас нет прав для этой команды")
         return
     
@@ -472,7 +886,10 @@ async def show_ab_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         stats = ab_testing_manager.get_test_statistics()
         
         if not stats:
-            await update.message.reply_text("📊 Пока нет данных для A/B тестирования")
+            await update.message.reply_text(
+                "📊 Пока нет данных для A/B тестирования\n\n" + format_runtime_stats(),
+                parse_mode=ParseMode.MARKDOWN
+            )
             return
         
         message = "📊 **Статистика A/B тестирования:**\n\n"
@@ -494,52 +911,283 @@ async def show_ab_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         if psych_winner:
             message += f"• Психологическая консультация: `{psych_winner}`\n"
         
+        message += "\n" + format_runtime_stats()
+        
         await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
         
     except Exception as e:
         logger.error(f"Error showing AB stats: {e}")
         await update.message.reply_text(f"❌ Ошибка при получении статистики: {e}")
 
+def parse_profile_args(args) -> Tuple[Optional[int], float]:
+    """Аргументы /profile: N - обновлений, Ns - секунд (по умолчанию 30 секунд)"""
+    if not args:
+        return None, 30.0
+    value = args[0].lower()
+    if value.endswith('s'):
+        return None, min(float(value[:-1]), PROFILE_MAX_SECONDS)
+    return max(int(value), 1), PROFILE_MAX_SECONDS
+
+def format_profile_report(report) -> str:
+    """Топ функций по накопленному времени"""
+    message = (
+        f"🔬 **Профиль:** {report.duration:.1f} с, обновлений {report.updates}, "
+        f"выборок {report.samples} (загрузка цикла событий {report.busy_share:.0%})\n"
+    )
+    if not report.samples:
+        return message + "Цикл событий простаивал, выборок с работой нет\n"
+    
+    message += "\n**Функции по накопленному времени:**\n"
+    for function in report.top(15):
+        message += (
+            f"• {function.cumulative / report.samples:.0%} "
+            f"(своих {function.own / report.samples:.0%}) `{function.name}`\n"
+        )
+    message += "\n**Задачи asyncio:**\n"
+    for task, count in list(report.tasks.items())[:5]:
+        message += f"• {count / report.samples:.0%} `{task}`\n"
+    if report.path:
+        message += f"\nСтеки (collapsed): `{report.path}`\n"
+    return message
+
+async def reply_profile_report(message: Message) -> None:
+    """Дождаться конца профилирования и отправить отчет"""
+    report = await profiler.wait()
+    try:
+        await message.reply_text(format_profile_report(report), parse_mode=ParseMode.MARKDOWN)
+    except BadRequest:
+        await message.reply_text(format_profile_report(report))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Профилировать следующие N обновлений или T секунд (только для админов)
+    
+    /profile 100 - 100 обновлений, /profile 30s - 30 секунд, /profile stop - завершить
+    """
+    global profile_command_update_id, profile_report_task
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ У вас нет прав для этой команды")
+        return
+    
+    if context.args and context.args[0].lower() == 'stop':
+        try:
+            profiler.stop()
+        except ProfilerError as e:
+            await update.message.reply_text(f"❌ {e}")
+        return
+    
+    try:
+        max_updates, max_seconds = parse_profile_args(context.args)
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [N | Ns | stop]")
+        return
+    
+    try:
+        profiler.start(max_updates=max_updates, max_seconds=max_seconds)
+    except ProfilerError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    profile_command_update_id = update.update_id
+    
+    target = f"{max_updates} обновлений (не дольше {max_seconds:g} с)" if max_updates else f"{max_seconds:g} с"
+    await update.message.reply_text(f"🔬 Профилирование запущено: {target}")
+    # Отчет отправляется отдельной задачей, обработка обновлений не ждет
+    profile_report_task = asyncio.create_task(reply_profile_report(update.message))
+
+async def after_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обновление обработано (группа после основных обработчиков): время запуска, /profile N"""
+    if startup.update_handled():
+        logger.info(f"Startup: {startup.format()}")
+    if profiler.running and getattr(update, 'update_id', None) != profile_command_update_id:
+        profiler.record_update()
+
+def format_runtime_stats() -> str:
+    """Сводка по внутренним очередям и кэшам для админов"""
+    worker = get_worker_context()
+    header = []
+    if worker is not None:
+        # В режиме supervisor у каждого процесса свои очереди и кэши
+        header.append(f"🧩 **Процесс-воркер {worker.index + 1} из {worker.processes}** (данные этого процесса)\n")
+    
+    return "\n".join(header + [
+        format_llm_queue_stats(),
+        format_response_cache_stats(),
+        format_sentiment_cache_stats(),
+        format_session_stats(),
+        format_context_stats(),
+        format_summary_stats(),
+        format_ab_writer_stats(),
+        format_metrics_stats(),
+        format_startup_stats(),
+    ])
+
+def format_llm_queue_stats() -> str:
+    """Сводка по очереди запросов к LLM для админов"""
+    stats = llm_scheduler.get_stats()
+    
+    message = "⚙️ **Очередь LLM:**\n"
+    message += f"• Активных запросов: {stats['active']}/{stats['max_concurrency']}\n"
+    message += f"• В очереди: {stats['queue_depth']}/{stats['max_queue']}\n"
+    
+    for lane_name, lane in stats['lanes'].items():
+        message += (
+            f"• `{lane_name}`: в очереди {lane['queued']}, "
+            f"допущено {lane['admitted']}, отклонено {lane['rejected']}, "
+            f"просрочено {lane['expired']}, "
+            f"ожидание {lane['wait_avg']:.1f}с (макс {lane['wait_max']:.1f}с)\n"
+        )
+    
+    return message
+
+def format_response_cache_stats() -> str:
+    """Сводка по кэшу ответов для админов"""
+    stats = response_cache.get_stats()
+    
+    return (
+        "🗂 **Кэш ответов:**\n"
+        f"• Записей: {stats['entries']}/{stats['max_entries']}\n"
+        f"• Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate']:.1%})\n"
+        f"• Вытеснено: {stats['evictions']}\n"
+    )
+
+def format_sentiment_cache_stats() -> str:
+    """Сводка по кэшу анализа настроения для админов"""
+    stats = sentiment_analyzer.cache.get_stats()
+    
+    return (
+        "🧠 **Кэш анализа настроения:**\n"
+        f"• Записей: {stats['entries']}/{stats['max_entries']}\n"
+        f"• Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate']:.1%})\n"
+        f"• Вытеснено: {stats['evictions']}\n"
+    )
+
+def format_session_stats() -> str:
+    """Сводка по сессиям пользователей для админов"""
+    stats = sessions.get_stats()
+    
+    return (
+        "👥 **Сессии:**\n"
+        f"• Активных: {stats['entries']}/{stats['max_entries']}\n"
+        f"• Память: {stats['memory_bytes'] / 1024 / 1024:.1f}/{stats['max_memory_bytes'] / 1024 / 1024:.0f} МБ\n"
+        f"• Создано: {stats['created']}, загружено из базы: {stats['loaded']}, "
+        f"удалено по простою: {stats['evicted_idle']}, вытеснено: {stats['evicted_lru']}\n"
+    )
+
+def format_context_stats() -> str:
+    """Сводка по расходу токенов на контекст разговора"""
+    stats = context_builder.get_stats()
+    counter = "tiktoken" if stats['exact'] else f"оценка (поправка {stats['correction']:.2f})"
+    
+    message = f"🧾 **Контекст промптов** ({counter}):\n"
+    for kind, data in stats['budgets'].items():
+        message += (
+            f"• {kind}: {data['tokens_avg']:.0f} ток. в среднем (макс {data['tokens_max']}/{data['budget']}), "
+            f"отброшено сообщений {data['dropped_avg']:.1f}\n"
+        )
+    return message
+
+def format_summary_stats() -> str:
+    """Сводка по фоновому обновлению кратких содержаний"""
+    stats = summarizer.get_stats()
+    
+    return (
+        "📝 **Краткие содержания:**\n"
+        f"• Обновлений: {stats['completed']} из {stats['scheduled']} (ошибок {stats['failed']}), "
+        f"выполняется: {stats['in_flight']}\n"
+        f"• Потеряно сообщений (вытеснены до обновления): {stats['lost_messages']}\n"
+        f"• Среднее время: {stats['latency_avg']:.1f} с\n"
+    )
+
+def format_ab_writer_stats() -> str:
+    """Сводка по отложенной записи результатов A/B тестов"""
+    stats = ab_testing_manager.result_writer.get_stats()
+    
+    return (
+        "💾 **Запись результатов A/B:**\n"
+        f"• В очереди: {stats['queue_depth']}\n"
+        f"• Записано: {stats['flushed_rows']} строк за {stats['flushes']} транзакций\n"
+        f"• Время записи: {stats['avg_flush_ms']:.1f} мс (макс {stats['max_flush_ms']:.1f} мс)\n"
+        f"• Ошибок: {stats['failures']}, отброшено строк: {stats['dropped']}\n"
+    )
+
+def format_startup_stats() -> str:
+    """Время запуска по этапам"""
+    phases = ", ".join(f"{phase} {seconds:.2f} с" for phase, seconds in startup.phases.items())
+    message = f"🚀 **Запуск:** {phases}\n"
+    if 'warm_up' in startup.background:
+        message += f"• Прогрев (в фоне): {startup.background['warm_up']:.2f} с\n"
+    if startup.first_update is not None:
+        message += f"• Первое обновление обработано через {startup.first_update:.2f} с после старта\n"
+    return message
+
+def format_metrics_stats() -> str:
+    """Сводка по времени обработки: маршруты, этапы, запросы к LLM"""
+    stats = metrics.get_stats()
+    
+    message = "⏱ **Время обработки:**\n"
+    for route, data in sorted(stats['routes'].items(), key=lambda item: -item[1]['count']):
+        message += (
+            f"• `{route}`: {data['count']} сообщ., "
+            f"p50 {data['p50'] * 1000:.0f} мс, p95 {data['p95'] * 1000:.0f} мс\n"
+        )
+    for stage, data in stats['stages'].items():
+        message += f"• этап {stage}: в среднем {data['avg'] * 1000:.3f} мс, p95 {data['p95'] * 1000:.3f} мс\n"
+    for lane, data in stats['llm'].items():
+        message += (
+            f"• LLM `{lane}`: успешно {data.get('ok', 0):.0f}, ошибок {data.get('error', 0):.0f}, "
+            f"отклонено {data.get('rejected', 0):.0f}, токенов {data.get('prompt_tokens', 0):.0f}"
+            f"+{data.get('completion_tokens', 0):.0f}\n"
+        )
+    message += f"• Ошибок обработчиков: {stats['handler_errors']:.0f}, ошибок Bot API: {stats['telegram_errors']:.0f}\n"
+    return message
+
+@metrics.instrument_handler('handle_message', default_route='small_talk')
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     text = update.message.text.strip()
     
     if not text:
+        metrics.set_route('empty')
         await update.message.reply_text("Пожалуйста, напишите что-то конкретное.")
         return WAITING_MESSAGE
     
     # Detect language
-    language = detect_language(text)
+    with metrics.stage('language'):
+        language = detect_language(text)
     if language != 'ru':
+        metrics.set_route('non_russian')
         await update.message.reply_text("Я работаю только на русском языке. Пожалуйста, напишите на русском.")
         return WAITING_MESSAGE
     
     # Analyze speech patterns
-    patterns = analyze_speech_patterns(text)
+    with metrics.stage('patterns'):
+        patterns = analyze_speech_patterns(text)
     
-    # Store conversation
-    if user.id not in conversation_history:
-        conversation_history[user.id] = []
+    # Store conversation (сессия хранит только последние SESSION_MAX_HISTORY сообщений)
+    with metrics.stage('session'):
+        session = sessions.append_message(user.id, text)
     
-    conversation_history[user.id].append(text)
+    # Эмоциональная динамика разговора (скользящее среднее)
+    with metrics.stage('sentiment'):
+        update_emotional_trend(user.id, text)
     
-    # Keep only last 15 messages
-    if len(conversation_history[user.id]) > 15:
-        conversation_history[user.id] = conversation_history[user.id][-15:]
+    # Краткое содержание обновляется в фоне, ответ пользователю его не ждет
+    if SUMMARY_ENABLED:
+        summarizer.maybe_schedule(session)
     
     # Handle cancellation
     if patterns['cancellation']:
+        metrics.set_route('cancellation')
         await update.message.reply_text(
             "Понял. Если захотите поговорить снова - просто напишите. "
             "Я всегда готов выслушать и поддержать. 💙"
         )
         # Clear user data
-        user_data.pop(user.id, None)
-        conversation_history.pop(user.id, None)
+        sessions.discard(user.id)
         return ConversationHandler.END
     
     # Handle topic change
     if patterns['topic_change']:
+        metrics.set_route('topic_change')
         await update.message.reply_text(
             "Конечно! О чем бы вы хотели поговорить? "
             "Я готов обсудить любую тему, которая вас интересует. 😊"
@@ -548,6 +1196,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Handle dream expression
     if patterns['dream_expression']:
+        metrics.set_route('dream')
         await update.message.reply_text(
             "🌟 Какая замечательная мечта! Это очень вдохновляюще. "
             "Расскажите, что именно вас привлекает в этом? "
@@ -557,6 +1206,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Handle self introduction request
     if patterns['self_introduction_request']:
+        metrics.set_route('self_introduction')
         await update.message.reply_text(
             "Конечно! Я HR-психоаналитик и карьерный консультант. "
             "Моя работа - помогать людям понять себя, найти свой путь в жизни и карьере. "
@@ -566,15 +1216,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return WAITING_MESSAGE
     
     # Handle references to previous conversation
-    reference_keywords = ['мы говорили', 'говорили об этом', 'смотри выше', 'выше', 'раньше говорил', 'раньше сказал', 'об этом', 'это то что']
-    is_referencing_previous = any(keyword in text.lower() for keyword in reference_keywords)
-    
-    if is_referencing_previous or patterns['provocative']:
+    if patterns['reference_previous'] or patterns['provocative']:
+        metrics.set_route('reference')
         thinking_msg = await update.message.reply_text("🤔 Вспоминаю наш разговор...")
         
         # Используем полный контекст для понимания ссылки
-        prompt, variant_id = get_psychology_consultation_prompt(text, user.id, conversation_history.get(user.id, []))
-        response = await get_ai_response(prompt, max_tokens=300)
+        prompt, variant_id = get_psychology_consultation_prompt(text, user.id, session)
+        response, _ = await respond_with_ai(
+            update, thinking_msg, prompt, max_tokens=300,
+            priority=LLMPriority.CONSULTATION, parse_mode=ParseMode.MARKDOWN,
+        )
         
         # Записываем результат A/B теста
         quality_score = ab_testing_manager.evaluate_response_quality(text, response)
@@ -584,13 +1235,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             prompt_type=PromptType.PSYCHOLOGY_CONSULTATION,
             response_quality=quality_score
         )
-        
-        await thinking_msg.delete()
-        await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
         return WAITING_MESSAGE
     
     # Check for full analysis request
-    if 'полный анализ' in text.lower() or 'детальный анализ' in text.lower() or 'платный анализ' in text.lower():
+    if patterns['full_analysis_request']:
+        metrics.set_route('full_analysis_request')
         # Check if user already has full analysis
         analyses = get_user_analyses(user.id)
         has_full_analysis = any(analysis[3] == 'full' for analysis in analyses)
@@ -602,11 +1251,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return WAITING_MESSAGE
         
         # Start full analysis
-        user_data[user.id] = {
-            'state': 'full_analysis',
-            'answers': [],
-            'current_question': 0
-        }
+        session.start_full_analysis()
+        sessions.update(session)
         
         await update.message.reply_text(
             "💎 **Полный психоанализ**\n\n"
@@ -620,10 +1266,33 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Handle psychology-related questions
     if patterns['psychology_need'] or patterns['emotional_support']:
+        metrics.set_route('consultation')
+        prompt, variant_id = get_psychology_consultation_prompt(text, user.id, session)
+        
+        # Первое сообщение без контекста - пробуем ответить из кэша
+        use_cache = RESPONSE_CACHE_ENABLED and len(session.history) <= 1
+        cached_response = response_cache.get(text, variant_id) if use_cache else None
+        
+        if cached_response:
+            metrics.set_route('consultation_cached')
+            await reply_markdown(update, cached_response)
+            ab_testing_manager.record_test_result(
+                user_id=user.id,
+                prompt_variant_id=variant_id,
+                prompt_type=PromptType.PSYCHOLOGY_CONSULTATION,
+                response_quality=ab_testing_manager.evaluate_response_quality(text, cached_response)
+            )
+            return WAITING_MESSAGE
+        
         thinking_msg = await update.message.reply_text("🤔 Анализирую вашу ситуацию...")
+        response, completed = await respond_with_ai(
+            update, thinking_msg, prompt, max_tokens=300,
+            priority=LLMPriority.CONSULTATION, parse_mode=ParseMode.MARKDOWN,
+        )
         
-        prompt, variant_id = get_psychology_consultation_prompt(text, user.id, conversation_history.get(user.id, []))
-        response = await get_ai_response(prompt, max_tokens=300)
+        # Кэшируем только полностью полученный ответ
+        if use_cache and completed:
+            response_cache.put(text, variant_id, response)
         
         # Записываем результат A/B теста
         quality_score = ab_testing_manager.evaluate_response_quality(text, response)
@@ -633,24 +1302,27 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             prompt_type=PromptType.PSYCHOLOGY_CONSULTATION,
             response_quality=quality_score
         )
-        
-        await thinking_msg.delete()
-        await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
         return WAITING_MESSAGE
     
     # Check message count for express analysis
-    message_count = len(conversation_history[user.id])
+    message_count = len(session.history)
     
     if message_count >= 10:
+        metrics.set_route('express_analysis')
         # Trigger express analysis
         thinking_msg = await update.message.reply_text(
             "🎯 Отлично! У меня достаточно информации для экспресс-анализа. "
             "Провожу анализ вашей личности..."
         )
         
-        conversation_text = " ".join(conversation_history[user.id])
-        prompt, variant_id = get_express_analysis_prompt(conversation_text, message_count, user.id)
-        response = await get_ai_response(prompt, max_tokens=400)
+        conversation_text = " ".join(session.history)
+        summary, window = build_conversation_context('express', session, skip_last=0, separator=" ")
+        conversation = f"Краткое содержание: {summary}\n\nПоследние сообщения: {window.text}" if summary else window.text
+        prompt, variant_id = get_express_analysis_prompt(conversation, message_count, user.id)
+        response, _ = await respond_with_ai(
+            update, thinking_msg, prompt, max_tokens=400,
+            priority=LLMPriority.EXPRESS_ANALYSIS, parse_mode=ParseMode.MARKDOWN,
+        )
         
         # Записываем результат A/B теста
         quality_score = ab_testing_manager.evaluate_response_quality(conversation_text, response)
@@ -661,9 +1333,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             response_quality=quality_score
         )
         
-        await thinking_msg.delete()  # Удаляем сообщение "Провожу анализ..."
-        await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
-        
         # Offer full analysis
         await update.message.reply_text(
             "💎 **Хотите детальный анализ?**\n\n"
@@ -683,12 +1352,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             'analysis': response,
             'message_count': message_count
         }
-        save_analysis(user.id, user.first_name or f"User_{user.id}", 'express', analysis_data)
+        with metrics.stage('save'):
+            save_analysis(user.id, user.first_name or f"User_{user.id}", 'express', analysis_data)
         
         return WAITING_MESSAGE
     
     # Continue conversation with smart questions
     if message_count in [3, 6, 8]:
+        metrics.set_route('guiding_question')
         # Ask professional questions to guide conversation
         questions = [
             "Расскажите о ваших главных целях в жизни. Что для вас важно?",
@@ -706,7 +1377,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     thinking_msg = await update.message.reply_text("🤔 Думаю...")
     
     # Generate intelligent response based on patterns with full context
-    conversation_text = " ".join(conversation_history[user.id][-10:])  # Last 10 messages for better context
+    conversation_text = " ".join(session.recent_messages(10))  # Last 10 messages for better context
     
     # Determine primary role based on patterns
     if patterns['dream_expression']:
@@ -724,74 +1395,57 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Подготавливаем контекст предыдущих сообщений
     previous_context = ""
-    if len(conversation_history[user.id]) > 1:
-        recent_messages = conversation_history[user.id][:-1]  # все кроме текущего
-        if len(recent_messages) > 8:
-            recent_messages = recent_messages[-8:]  # последние 8 сообщений
-        previous_context = "Предыдущие сообщения в разговоре:\n" + "\n".join([f"- {msg}" for msg in recent_messages])
+    if len(session.history) > 1:
+        # Самые новые сообщения в пределах бюджета токенов, кроме текущего
+        summary, window = build_conversation_context(
+            'small_talk', session, format_message=lambda msg: f"- {msg}"
+        )
+        previous_context = format_conversation_context(summary, window, "Предыдущие сообщения в разговоре:")
+    
+    prompt = SMALL_TALK_TEMPLATE.render(
+        previous_context=previous_context,
+        text=text,
+        focus=focus,
+        primary_role=primary_role,
+        emotional_trend=describe_emotional_trend(user.id),
+    )
     
-    prompt = f"""
-Ты — HR-психоаналитик и карьерный консультант. 
-
-КОНТЕКСТ РАЗГОВОРА:
-{previous_context}
-
-ТЕКУЩЕЕ СООБЩЕНИЕ:
-{text}
-
-ВАЖНО: Если пользователь ссылается на предыдущие части разговора, обязательно учитывай контекст выше.
-
-АНАЛИЗ ПОЛЬЗОВАТЕЛЯ:
-- Основная потребность: {focus}
-- Роль: {primary_role}
-
-ТВОИ РОЛИ (адаптивные):
-1. ПСИХОЛОГ - эмпатия, поддержка, понимание эмоций
-2. HR-СПЕЦИАЛИСТ - анализ личности, карьерные рекомендации  
-3. КОНСУЛЬТАНТ - помощь с выбором профессии и развитием
-
-ПРИНЦИПЫ:
-- СНАЧАЛА прояви эмпатию и понимание
-- ПОМНИ весь контекст разговора
-- Адаптируйся к потребностям пользователя
-- Поддерживай эмоционально
-- Мягко подводи к самоанализу
-- Если пользователь ссылается на предыдущее - обратись к контексту
+    await respond_with_ai(update, thinking_msg, prompt, max_tokens=200, priority=LLMPriority.SMALL_TALK)
+    return WAITING_MESSAGE
 
-ФОРМАТ: Эмпатичный ответ (1-2 предложения) + релевантный вопрос.
 
-СТИЛЬ: Теплый, профессиональный, адаптивный к ситуации, помнящий контекст.
-"""
+async def route_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Точка входа для текстовых сообщений
     
-    response = await get_ai_response(prompt, max_tokens=200)
-    await thinking_msg.delete()
-    await update.message.reply_text(response)
-    return WAITING_MESSAGE
-
+    Состояние берется из сессии, а не из памяти ConversationHandler, поэтому после
+    перезапуска бота незавершенный полный анализ продолжается с того же вопроса.
+    """
+    session = sessions.get(update.effective_user.id)
+    if session is not None and session.state == 'full_analysis':
+        return await handle_full_analysis_answer(update, context)
+    return await handle_message(update, context)
 
+@metrics.instrument_handler('handle_full_analysis_answer', default_route='answer')
 async def handle_full_analysis_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     text = update.message.text.strip()
     
     if not text or len(text) < 20:
+        metrics.set_route('too_short')
         await update.message.reply_text(
             "Пожалуйста, дайте развернутый ответ (минимум 20 символов). "
             "Это важно для качественного анализа."
         )
         return context.user_data.get('current_question', Q1)
     
-    user_info = user_data.get(user.id, {})
-    answers = user_info.get('answers', [])
-    current_q = user_info.get('current_question', 0)
+    session = sessions.get_or_create(user.id)
+    session.state = 'full_analysis'
+    session.answers.append(text)
+    session.current_question += 1
+    sessions.update(session)
     
-    answers.append(text)
-    current_q += 1
-    
-    user_data[user.id] = {
-        'state': 'full_analysis',
-        'answers': answers,
-        'current_question': current_q
-    }
+    answers = session.answers
+    current_q = session.current_question
     
     if current_q < 7:
         await update.message.reply_text(
@@ -801,25 +1455,22 @@ async def handle_full_analysis_answer(update: Update, context: ContextTypes.DEFA
         return Q1 + current_q
     else:
         # All questions answered, conduct full analysis
+        metrics.set_route('full_analysis')
         thinking_msg = await update.message.reply_text(
             "🎯 Отлично! Все ответы получены. "
             "Провожу детальный психоанализ... Это займет несколько минут."
         )
         
         prompt = get_full_analysis_prompt(answers)
-        response = await get_ai_response(prompt, max_tokens=1500)
-        
-        await thinking_msg.delete()  # Удаляем сообщение "Провожу анализ..."
-        
-        # Split long response
-        max_length = 4000
-        if len(response) <= max_length:
-            await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
-        else:
-            parts = [response[i:i+max_length] for i in range(0, len(response), max_length)]
-            for i, part in enumerate(parts):
-                prefix = f"**Анализ (часть {i+1}):**\n\n" if i > 0 else ""
-                await update.message.reply_text(prefix + part, parse_mode=ParseMode.MARKDOWN)
+        response, _ = await respond_with_ai(
+            update,
+            thinking_msg,
+            prompt,
+            max_tokens=1500,
+            priority=LLMPriority.FULL_ANALYSIS,
+            parse_mode=ParseMode.MARKDOWN,
+            part_prefix="**Анализ (часть {part}):**\n\n",
+        )
         
         # Save full analysis
         analysis_data = {
@@ -827,7 +1478,8 @@ async def handle_full_analysis_answer(update: Update, context: ContextTypes.DEFA
             'answers': answers,
             'analysis': response
         }
-        save_analysis(user.id, user.first_name or f"User_{user.id}", 'full', analysis_data, 'paid')
+        with metrics.stage('save'):
+            save_analysis(user.id, user.first_name or f"User_{user.id}", 'full', analysis_data, 'paid')
         
         await update.message.reply_text(
             "✅ **Анализ завершен!**\n\n"
@@ -836,19 +1488,302 @@ async def handle_full_analysis_answer(update: Update, context: ContextTypes.DEFA
         )
         
         # Clear user data
-        user_data.pop(user.id, None)
+        session.reset_full_analysis()
+        sessions.update(session)
         return ConversationHandler.END
 
-def main():
-    # Initialize database
-    init_database()
+def collect_runtime_gauges():
+    """Текущие значения очередей и кэшей для выгрузки метрик"""
+    llm_stats = llm_scheduler.get_stats()
+    session_stats = sessions.get_stats()
+    cache_stats = response_cache.get_stats()
+    return [
+        GaugeSample('bot_llm_queue_depth', "Запросов к LLM в очереди", llm_stats['queue_depth']),
+        GaugeSample('bot_llm_active_requests', "Выполняющихся запросов к LLM", llm_stats['active']),
+        GaugeSample('bot_sessions', "Сессий в памяти", session_stats['entries']),
+        GaugeSample('bot_sessions_memory_bytes', "Оценка памяти сессий", session_stats['memory_bytes']),
+        GaugeSample('bot_response_cache_entries', "Записей в кэше ответов", cache_stats['entries']),
+        GaugeSample('bot_response_cache_hits', "Попаданий в кэш ответов", cache_stats['hits']),
+        GaugeSample('bot_response_cache_misses', "Промахов кэша ответов", cache_stats['misses']),
+    ]
+
+metrics.registry.add_collector(collect_runtime_gauges)
+metrics.registry.add_collector(startup.collect)
+
+def warm_up() -> None:
+    """Загрузить отложенные модули и данные до первого сообщения"""
+    started_at = time.perf_counter()
+    try:
+        sentiment_analyzer.warm_up()
+        if RESPONSE_CACHE_ENABLED:
+            response_cache.warm_up()
+        ab_testing_manager.warm_up()
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}")
+    startup.record_background('warm_up', time.perf_counter() - started_at)
+
+def get_metrics_port() -> int:
+    """Порт метрик процесса: воркеры занимают порты следом за главным процессом"""
+    worker = get_worker_context()
+    if worker is None:
+        return METRICS_PORT
+    return METRICS_PORT + 1 + worker.index
+
+async def post_init(application) -> None:
+    """Инициализация ресурсов после запуска приложения"""
+    global metrics_server
+    get_openai_client()
+    logger.info("OpenAI клиент инициализирован")
+    
+    if METRICS_PORT:
+        metrics_server = create_metrics_server(metrics.registry, METRICS_LISTEN, get_metrics_port())
+        await metrics_server.start()
+    
+    if WARM_UP and 'warm_up' not in startup.background:
+        # В отдельном потоке: прием обновлений не ждет прогрева
+        asyncio.get_running_loop().run_in_executor(None, warm_up)
+    startup.mark('post_init')
+    logger.info(f"Startup: {startup.format()}")
+
+async def post_shutdown(application) -> None:
+    """Освобождение ресурсов при остановке приложения"""
+    global metrics_server
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
+    
+    if profiler.running:
+        # Незавершенный профиль сохраняется, отчет уходит админу до закрытия бота
+        profiler.stop()
+        await asyncio.wait({profile_report_task}, timeout=10)
+    
+    await summarizer.drain()
+    await close_openai_client()
+    logger.info("OpenAI клиент закрыт")
+    
+    response_cache.save()
+    ab_testing_manager.close()
+    sessions.close()
+    close_all_databases()
+
+def install_stop_signals(stop_event: asyncio.Event) -> None:
+    """SIGINT/SIGTERM устанавливают stop_event"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+
+@asynccontextmanager
+async def running_application(application) -> AsyncIterator[None]:
+    """Запуск и остановка приложения без run_polling/run_webhook"""
+    # post_init/post_shutdown вызывает только run_polling/run_webhook, здесь - вручную
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        yield
+    finally:
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+def create_webhook_server(dispatcher, parse, secret_token: str) -> WebhookServer:
+    """HTTP-сервер вебхука по настройкам из окружения"""
+    server = HTTPServer(
+        WEBHOOK_LISTEN, WEBHOOK_PORT,
+        ssl_context=create_ssl_context(WEBHOOK_CERT, WEBHOOK_KEY),
+    )
+    return WebhookServer(
+        server, dispatcher, parse,
+        path=WEBHOOK_PATH,
+        secret_token=secret_token,
+    )
+
+def get_webhook_secret() -> str:
+    """Секретный токен вебхука
+    
+    Без проверки токена любой, кто видит порт, может прислать поддельное обновление
+    от имени админа, поэтому без токена вебхук не запускается. Если вебхук регистрирует
+    сам бот (WEBHOOK_URL), токен генерируется.
+    """
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    if WEBHOOK_URL:
+        return secrets.token_urlsafe(32)
+    raise ValueError("WEBHOOK_SECRET не найден: задайте его или WEBHOOK_URL для режима webhook")
+
+async def register_webhook(bot, secret_token: str) -> None:
+    """Зарегистрировать вебхук в Telegram, если задан WEBHOOK_URL"""
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    else:
+        logger.warning("WEBHOOK_URL не задан: вебхук в Telegram не регистрируется")
+
+async def run_webhook(application) -> None:
+    """Работа через вебхук: встроенный HTTP-сервер, ограниченная очередь и плавная остановка"""
+    secret_token = get_webhook_secret()
+    dispatcher = UpdateDispatcher(
+        application.process_update,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+        workers=WEBHOOK_WORKERS,
+    )
+    webhook = create_webhook_server(
+        dispatcher, lambda data: Update.de_json(data, application.bot), secret_token
+    )
     
-    # Create application
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    stop_event = asyncio.Event()
+    install_stop_signals(stop_event)
+    
+    async with running_application(application):
+        try:
+            await webhook.start()
+            await register_webhook(application.bot, secret_token)
+            await stop_event.wait()
+            logger.info("Остановка: дообрабатываем принятые обновления")
+        finally:
+            await webhook.stop(WEBHOOK_DRAIN_TIMEOUT)
+
+async def run_worker(application, worker: WorkerContext) -> None:
+    """Процесс-воркер режима supervisor: обрабатывает обновления своей доли пользователей"""
+    dispatcher = UpdateDispatcher(
+        application.process_update,
+        queue_size=max(WEBHOOK_QUEUE_SIZE // worker.processes, 1),
+        workers=WEBHOOK_WORKERS,
+    )
+    
+    async def handle(data: dict) -> None:
+        update = Update.de_json(data, application.bot)
+        if update is not None:
+            await dispatcher.put(update)
+    
+    async with running_application(application):
+        dispatcher.start()
+        try:
+            await consume_updates(worker, handle, on_clear=clear_local_caches)
+        finally:
+            await dispatcher.drain(WEBHOOK_DRAIN_TIMEOUT)
+            await dispatcher.stop()
+    logger.info(f"Процесс-воркер {worker.index} остановлен")
+
+def worker_main(worker: WorkerContext) -> None:
+    """Точка входа процесса-воркера (после fork)"""
+    # Кэш ответов у каждого процесса свой, на диск его сохраняет один процесс
+    if worker.index != 0:
+        response_cache.persist_path = None
+    # Лимиты LLM_MAX_CONCURRENCY и LLM_MAX_QUEUE общие на все процессы
+    llm_scheduler.max_concurrency = max(LLM_MAX_CONCURRENCY // worker.processes, 1)
+    llm_scheduler.max_queue = max(LLM_MAX_QUEUE // worker.processes, 1)
+    application = build_application()
+    startup.mark('application')
+    asyncio.run(run_worker(application, worker))
+
+async def run_supervisor(pool: WorkerPool) -> int:
+    """Главный процесс режима supervisor: прием обновлений и запись в базу"""
+    stop_event = asyncio.Event()
+    install_stop_signals(stop_event)
+    exit_code = 0
+    
+    supervisor_metrics = None
+    if METRICS_PORT:
+        # Метрики приема и записи; метрики обработки отдают сами воркеры
+        registry = MetricsRegistry()
+        registry.add_collector(lambda: collect_pool_gauges(pool))
+        supervisor_metrics = create_metrics_server(registry, METRICS_LISTEN, METRICS_PORT)
+        await supervisor_metrics.start()
+    
+    bot = Bot(BOT_TOKEN)
+    async with bot:
+        if BOT_MODE == "webhook":
+            secret_token = get_webhook_secret()
+            
+            def parse(data):
+                return data if isinstance(data, dict) and 'update_id' in data else None
+            
+            receiver = create_webhook_server(pool, parse, secret_token)
+            await receiver.start()
+            await register_webhook(bot, secret_token)
+            polling = None
+        else:
+            receiver = None
+            pool.start()
+            polling = asyncio.create_task(poll_updates(bot, pool, stop_event))
+        
+        failed = asyncio.create_task(pool.wait_failed())
+        stopped = asyncio.create_task(stop_event.wait())
+        try:
+            await asyncio.wait({failed, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if failed.done():
+                # Состояние упавшего воркера потеряно - перезапуск целиком доверяем платформе
+                exit_code = 1
+            stop_event.set()
+            logger.info("Остановка: дообрабатываем принятые обновления")
+        finally:
+            failed.cancel()
+            stopped.cancel()
+            if polling is not None:
+                try:
+                    await asyncio.wait_for(polling, timeout=WEBHOOK_DRAIN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+            if receiver is not None:
+                await receiver.stop(WEBHOOK_DRAIN_TIMEOUT)
+            else:
+                await pool.drain(WEBHOOK_DRAIN_TIMEOUT)
+                await pool.stop()
+    
+    if supervisor_metrics is not None:
+        await supervisor_metrics.stop()
+    return exit_code
+
+def collect_pool_gauges(pool: WorkerPool):
+    """Состояние процессов-воркеров и писателя базы для выгрузки метрик"""
+    stats = pool.get_stats()
+    samples = [
+        GaugeSample('bot_workers_alive', "Работающих процессов-воркеров", stats['alive']),
+        GaugeSample('bot_update_queue_depth', "Обновлений в очередях воркеров", stats['queue_depth']),
+        GaugeSample('bot_updates_rejected', "Обновлений отклонено из-за заполненной очереди", stats['rejected']),
+    ]
+    for index, received in enumerate(stats['received_per_worker']):
+        samples.append(GaugeSample(
+            'bot_updates_received', "Обновлений передано воркеру", received, {'worker': str(index)}
+        ))
+    writer = stats['writer']
+    samples += [
+        GaugeSample('bot_db_writer_transactions', "Транзакций записано писателем базы", writer['transactions']),
+        GaugeSample('bot_db_writer_failures', "Ошибок писателя базы", writer['failures']),
+    ]
+    return samples
+
+def build_application(request: Optional[BaseRequest] = None):
+    """Приложение Telegram с обработчиками бота
+    
+    request - свой транспорт Bot API (например, заглушка в нагрузочном тесте)
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # Время и ошибки запросов к Bot API попадают в метрики
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256), metrics))
+    application = builder.build()
     
     # Conversation handler
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[
+            CommandHandler('start', start),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, route_message),
+        ],
         states={
             WAITING_MESSAGE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message),
@@ -871,9 +1806,33 @@ def main():
     application.add_handler(CommandHandler('clear', clear_memory))
     application.add_handler(CommandHandler('reset', reset_bot))
     application.add_handler(CommandHandler('stats', show_ab_stats))
-    
-    logger.info("HR-Психоаналитик запущен")
-    application.run_polling()
+    application.add_handler(CommandHandler('profile', profile_command))
+    application.add_handler(TypeHandler(Update, after_update), group=1)
+    return application
+
+def main():
+    # Initialize database
+    init_database()
+    startup.mark('database')
+    
+    if BOT_PROCESSES > 1:
+        if WARM_UP:
+            # Прогрев до fork: воркеры получают загруженные модули готовыми
+            warm_up()
+        # Воркеры создаются fork до запуска потоков и цикла событий
+        pool = WorkerPool(worker_main, BOT_PROCESSES, queue_size=WEBHOOK_QUEUE_SIZE)
+        pool.fork()
+        logger.info(f"HR-Психоаналитик запущен ({BOT_MODE}, процессов: {BOT_PROCESSES})")
+        raise SystemExit(asyncio.run(run_supervisor(pool)))
+    
+    application = build_application()
+    startup.mark('application')
+    if BOT_MODE == "webhook":
+        logger.info("HR-Психоаналитик запущен (webhook)")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("HR-Психоаналитик запущен")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,234 @@
+"""
+Модуль минимального HTTP-сервера на asyncio
+Достаточен для приема вебхуков Telegram и проверок работоспособности:
+HTTP/1.1 с keep-alive, тело по Content-Length, опционально TLS
+"""
+
+import ssl
+import json
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+@dataclass
+class Request:
+    """Входящий HTTP-запрос"""
+    method: str
+    path: str
+    headers: Dict[str, str]  # имена в нижнем регистре
+    body: bytes = b""
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+@dataclass
+class Response:
+    """HTTP-ответ"""
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def json(cls, data, status: int = 200) -> 'Response':
+        return cls(status, json.dumps(data, ensure_ascii=False).encode('utf-8'), "application/json")
+
+    @classmethod
+    def text(cls, text: str, status: int = 200) -> 'Response':
+        return cls(status, text.encode('utf-8'))
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+class HTTPError(Exception):
+    """Ошибка разбора запроса"""
+
+    def __init__(self, status: int):
+        super().__init__(REASONS.get(status, str(status)))
+        self.status = status
+
+class HTTPServer:
+    """HTTP-сервер с таблицей маршрутов (метод, путь) -> обработчик"""
+
+    def __init__(
+        self,
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        ssl_context: Optional[ssl.SSLContext] = None,
+        max_body_size: int = 1024 * 1024,
+        read_timeout: float = 30.0,
+        max_headers: int = 100,
+    ):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.max_body_size = max_body_size
+        self.read_timeout = read_timeout
+        self.max_headers = max_headers
+
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+        # Соединения keep-alive, ожидающие следующего запроса
+        self._idle: Set[asyncio.Task] = set()
+
+    def add_route(self, method: str, path: str, handler: Handler) -> None:
+        """Зарегистрировать обработчик"""
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self) -> None:
+        """Начать принимать соединения"""
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, ssl=self.ssl_context
+        )
+        sockets = self._server.sockets or []
+        if sockets:
+            # При port=0 система выбирает свободный порт
+            self.port = sockets[0].getsockname()[1]
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Перестать принимать соединения и закрыть открытые"""
+        server, self._server = self._server, None
+        if server is not None:
+            server.close()
+
+        # Простаивающие соединения закрываем сразу, остальным даем завершить запрос
+        for task in list(self._idle):
+            task.cancel()
+
+        if self._connections:
+            _, pending = await asyncio.wait(set(self._connections), timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+        if server is not None:
+            await server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            keep_alive = True
+            while keep_alive:
+                self._idle.add(task)
+                try:
+                    request_line = await asyncio.wait_for(self._readline(reader, 400), self.read_timeout)
+                except (asyncio.TimeoutError, ConnectionError):
+                    break
+                except HTTPError as e:
+                    await self._write_response(writer, Response.text(str(e), e.status), keep_alive=False)
+                    break
+                finally:
+                    self._idle.discard(task)
+                if not request_line:
+                    break
+
+                try:
+                    request = await asyncio.wait_for(self._read_request(request_line, reader), self.read_timeout)
+                except HTTPError as e:
+                    await self._write_response(writer, Response.text(str(e), e.status), keep_alive=False)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                response = await self._dispatch(request)
+                await self._write_response(writer, response, keep_alive)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+    @staticmethod
+    async def _readline(reader: asyncio.StreamReader, status: int) -> bytes:
+        """Прочитать строку; строка длиннее буфера потока - ошибка status"""
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HTTPError(status)
+
+    async def _read_request(self, request_line: bytes, reader: asyncio.StreamReader) -> Request:
+        """Прочитать заголовки и тело запроса"""
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(400)
+
+        headers: Dict[str, str] = {}
+        while True:
+            line = await self._readline(reader, 431)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= self.max_headers:
+                raise HTTPError(431)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            raise HTTPError(400)
+        if length < 0:
+            raise HTTPError(400)
+        if length > self.max_body_size:
+            raise HTTPError(413)
+
+        body = await reader.readexactly(length) if length else b""
+        path = target.split('?', 1)[0]
+        return Request(method.upper(), path, headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self._routes)
+            return Response.text(REASONS[405] if known_path else REASONS[404], 405 if known_path else 404)
+
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Error handling {request.method} {request.path}: {e}")
+            return Response.text(REASONS[500], 500)
+
+    @staticmethod
+    async def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool) -> None:
+        headers = {
+            'Content-Type': response.content_type,
+            'Content-Length': str(len(response.body)),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+        }
+        headers.update(response.headers)
+
+        head = f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b"\r\n" + response.body)
+        await writer.drain()
+
+def create_ssl_context(cert_path: Optional[str], key_path: Optional[str]) -> Optional[ssl.SSLContext]:
+    """TLS-контекст для сервера (None - без TLS, например за балансировщиком)"""
+    if not cert_path:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    return context
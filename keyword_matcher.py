@@ -0,0 +1,111 @@
+"""
+Модуль поиска ключевых фраз (алгоритм Ахо-Корасик)
+Все словари намерений компилируются в один автомат, и текст сообщения
+просматривается за один проход независимо от числа фраз
+"""
+
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
+
+@dataclass(frozen=True)
+class KeywordMatch:
+    """Найденная ключевая фраза"""
+    category: str
+    keyword: str
+    start: int  # позиция в тексте (включительно)
+    end: int  # позиция в тексте (не включительно)
+
+class KeywordMatcher:
+    """Автомат Ахо-Корасик для многих словарей одновременно"""
+
+    def __init__(self, lexicons: Dict[str, Iterable[str]]):
+        self.categories: Tuple[str, ...] = tuple(lexicons)
+
+        # Состояние 0 - корень бора
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._outputs: List[Tuple[Tuple[str, str], ...]] = [()]
+        self._categories: List[FrozenSet[str]] = [frozenset()]
+
+        for category, keywords in lexicons.items():
+            for keyword in keywords:
+                self._add(keyword.lower(), category)
+
+        self._build_failure_links()
+
+    def _add(self, keyword: str, category: str) -> None:
+        """Добавить фразу в бор"""
+        if not keyword:
+            return
+
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+                self._categories.append(frozenset())
+                self._goto[state][char] = next_state
+            state = next_state
+
+        if (category, keyword) not in self._outputs[state]:
+            self._outputs[state] += ((category, keyword),)
+            self._categories[state] = self._categories[state] | {category}
+
+    def _build_failure_links(self) -> None:
+        """Построить суффиксные ссылки обходом в ширину и объединить выходы"""
+        queue = list(self._goto[0].values())
+        position = 0
+
+        while position < len(queue):
+            state = queue[position]
+            position += 1
+
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail_target = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail_target if fail_target != next_state else 0
+
+                # Фразы, оканчивающиеся в суффиксе, тоже найдены в этом состоянии
+                inherited = self._fail[next_state]
+                self._outputs[next_state] += self._outputs[inherited]
+                self._categories[next_state] = self._categories[next_state] | self._categories[inherited]
+
+        # Полная таблица переходов (ДКА) по алфавиту словарей: при поиске
+        # не нужно ходить по суффиксным ссылкам, один словарный lookup на символ.
+        # Символы вне алфавита всегда ведут в корень.
+        self._delta: List[Dict[str, int]] = [{} for _ in self._goto]
+        self._delta[0] = dict(self._goto[0])
+        for state in queue:
+            # Суффиксное состояние ближе к корню и уже обработано при обходе в ширину
+            transitions = dict(self._delta[self._fail[state]])
+            transitions.update(self._goto[state])
+            self._delta[state] = transitions
+
+    def find_all(self, text: str) -> List[KeywordMatch]:
+        """Все вхождения всех фраз с позициями (один проход по тексту)"""
+        matches = []
+        delta, outputs = self._delta, self._outputs
+        state = 0
+        for index, char in enumerate(text.lower()):
+            state = delta[state].get(char, 0)
+            for category, keyword in outputs[state]:
+                matches.append(KeywordMatch(category, keyword, index - len(keyword) + 1, index + 1))
+        return matches
+
+    def match_categories(self, text: str) -> Set[str]:
+        """Категории, фразы которых встречаются в тексте"""
+        found: Set[str] = set()
+        delta, categories = self._delta, self._categories
+        state = 0
+        for char in text.lower():
+            state = delta[state].get(char, 0)
+            if categories[state]:
+                found |= categories[state]
+        return found
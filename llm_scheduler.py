@@ -0,0 +1,233 @@
+"""
+Модуль управления доступом к LLM (admission control)
+Ограничивает число одновременных запросов к OpenAI и обслуживает очередь по приоритетам:
+платный полный анализ -> экспресс-анализ -> консультации -> small talk -> фоновые задачи
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class LLMPriority(IntEnum):
+    """Классы приоритета запросов к LLM (меньше - важнее)"""
+    FULL_ANALYSIS = 0
+    EXPRESS_ANALYSIS = 1
+    CONSULTATION = 2
+    SMALL_TALK = 3
+    BACKGROUND = 4  # краткие содержания разговора и другая работа вне ответа пользователю
+
+# Сколько секунд запрос каждого класса готов ждать ответа целиком
+DEFAULT_DEADLINES = {
+    LLMPriority.FULL_ANALYSIS: 300.0,
+    LLMPriority.EXPRESS_ANALYSIS: 120.0,
+    LLMPriority.CONSULTATION: 60.0,
+    LLMPriority.SMALL_TALK: 45.0,
+    LLMPriority.BACKGROUND: 600.0,
+}
+
+# Сколько секунд запрос готов ждать в очереди: меньше дедлайна,
+# чтобы после ожидания оставалось время на сам ответ модели
+DEFAULT_QUEUE_TIMEOUTS = {
+    LLMPriority.FULL_ANALYSIS: 120.0,
+    LLMPriority.EXPRESS_ANALYSIS: 45.0,
+    LLMPriority.CONSULTATION: 20.0,
+    LLMPriority.SMALL_TALK: 10.0,
+    LLMPriority.BACKGROUND: 300.0,
+}
+
+class LLMSchedulerError(Exception):
+    """Запрос к LLM не был допущен к выполнению"""
+
+class LLMQueueFullError(LLMSchedulerError):
+    """Очередь переполнена"""
+
+class LLMDeadlineExceededError(LLMSchedulerError):
+    """Запрос не успевает выполниться до своего дедлайна"""
+
+@dataclass(order=True)
+class _Ticket:
+    """Запись в очереди ожидания"""
+    priority: int
+    seq: int
+    deadline: float = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+@dataclass
+class _LaneStats:
+    """Статистика по одному классу приоритета"""
+    admitted: int = 0
+    rejected: int = 0
+    expired: int = 0
+    wait_avg: float = 0.0
+    wait_max: float = 0.0
+    service_avg: float = 0.0
+
+class LLMScheduler:
+    """Глобальный планировщик запросов к LLM с приоритетами и дедлайнами"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        max_queue: int = 100,
+        deadlines: Optional[Dict[LLMPriority, float]] = None,
+        queue_timeouts: Optional[Dict[LLMPriority, float]] = None,
+        smoothing: float = 0.2,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        if deadlines:
+            self.deadlines.update(deadlines)
+        self.queue_timeouts = dict(DEFAULT_QUEUE_TIMEOUTS)
+        if queue_timeouts:
+            self.queue_timeouts.update(queue_timeouts)
+        self.smoothing = smoothing
+
+        self._active = 0
+        self._queue: List[_Ticket] = []
+        self._seq = itertools.count()
+        self._stats = {priority: _LaneStats() for priority in LLMPriority}
+
+    @asynccontextmanager
+    async def slot(self, priority: LLMPriority, deadline: Optional[float] = None) -> AsyncIterator[float]:
+        """Занять слот для запроса к LLM; возвращает время ожидания в очереди"""
+        now = time.monotonic()
+        if deadline is None:
+            deadline = now + self.deadlines[priority]
+
+        wait_time = await self._acquire(priority, deadline, now)
+        started_at = time.monotonic()
+        try:
+            yield wait_time
+        finally:
+            self._record_service(priority, time.monotonic() - started_at)
+            self._release()
+
+    async def _acquire(self, priority: LLMPriority, deadline: float, now: float) -> float:
+        """Дождаться разрешения на выполнение запроса"""
+        lane = self._stats[priority]
+
+        if self._active < self.max_concurrency and not self._queue:
+            self._active += 1
+            self._record_wait(priority, 0.0)
+            return 0.0
+
+        if not self._can_meet_deadline(priority, deadline, now):
+            lane.expired += 1
+            raise LLMDeadlineExceededError(f"{priority.name}: дедлайн недостижим")
+
+        if len(self._queue) >= self.max_queue:
+            self._make_room(priority)
+
+        future = asyncio.get_running_loop().create_future()
+        ticket = _Ticket(priority, next(self._seq), deadline, now, future)
+        heapq.heappush(self._queue, ticket)
+
+        timeout = min(self.queue_timeouts[priority], deadline - now)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            self._abandon(ticket)
+            lane.expired += 1
+            raise LLMDeadlineExceededError(f"{priority.name}: истекло время ожидания в очереди")
+        except asyncio.CancelledError:
+            self._abandon(ticket)
+            raise
+
+        wait_time = time.monotonic() - now
+        self._record_wait(priority, wait_time)
+        return wait_time
+
+    def _make_room(self, priority: LLMPriority) -> None:
+        """Освободить место в полной очереди, вытеснив менее важный запрос"""
+        worst = max(self._queue)
+        if worst.priority <= priority:
+            self._stats[priority].rejected += 1
+            raise LLMQueueFullError(f"{priority.name}: очередь переполнена")
+
+        self._queue.remove(worst)
+        heapq.heapify(self._queue)
+        self._stats[LLMPriority(worst.priority)].rejected += 1
+        worst.future.set_exception(LLMQueueFullError("вытеснен более приоритетным запросом"))
+
+    def _abandon(self, ticket: _Ticket) -> None:
+        """Убрать запрос из очереди (таймаут или отмена)"""
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+        elif ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+            # Слот уже был выдан, но ожидающий не успел его забрать
+            self._release()
+
+    def _release(self) -> None:
+        """Освободить слот и передать его следующему запросу из очереди"""
+        self._active -= 1
+        now = time.monotonic()
+
+        while self._queue and self._active < self.max_concurrency:
+            ticket = heapq.heappop(self._queue)
+            if ticket.future.done():
+                continue
+
+            if not self._can_meet_deadline(LLMPriority(ticket.priority), ticket.deadline, now):
+                self._stats[LLMPriority(ticket.priority)].expired += 1
+                ticket.future.set_exception(LLMDeadlineExceededError("дедлайн недостижим"))
+                continue
+
+            self._active += 1
+            ticket.future.set_result(None)
+
+    def _can_meet_deadline(self, priority: LLMPriority, deadline: float, now: float) -> bool:
+        """Успеет ли запрос выполниться с учетом среднего времени обслуживания"""
+        return now + self._stats[priority].service_avg <= deadline
+
+    def _record_wait(self, priority: LLMPriority, wait_time: float) -> None:
+        lane = self._stats[priority]
+        lane.admitted += 1
+        lane.wait_avg += self.smoothing * (wait_time - lane.wait_avg)
+        lane.wait_max = max(lane.wait_max, wait_time)
+
+    def _record_service(self, priority: LLMPriority, service_time: float) -> None:
+        lane = self._stats[priority]
+        if lane.service_avg == 0.0:
+            lane.service_avg = service_time
+        else:
+            lane.service_avg += self.smoothing * (service_time - lane.service_avg)
+
+    def get_stats(self) -> Dict:
+        """Статистика планировщика для администраторов"""
+        depth = {priority.name: 0 for priority in LLMPriority}
+        for ticket in self._queue:
+            depth[LLMPriority(ticket.priority).name] += 1
+
+        return {
+            'active': self._active,
+            'max_concurrency': self.max_concurrency,
+            'queue_depth': len(self._queue),
+            'max_queue': self.max_queue,
+            'lanes': {
+                priority.name: {
+                    'queued': depth[priority.name],
+                    'admitted': lane.admitted,
+                    'rejected': lane.rejected,
+                    'expired': lane.expired,
+                    'wait_avg': lane.wait_avg,
+                    'wait_max': lane.wait_max,
+                    'service_avg': lane.service_avg,
+                }
+                for priority, lane in self._stats.items()
+            },
+        }
+
+def get_llm_scheduler(max_concurrency: int = 8, max_queue: int = 100) -> LLMScheduler:
+    """Фабричная функция для получения планировщика запросов к LLM"""
+    return LLMScheduler(max_concurrency=max_concurrency, max_queue=max_queue)
@@ -0,0 +1,576 @@
+"""
+Нагрузочное тестирование бота
+Записанные или синтетические обновления Telegram подаются в обработчики бота
+с заданной частотой. OpenAI заменяется локальным сервером-заглушкой с настраиваемой
+задержкой и долей ошибок, Bot API - заглушкой транспорта. Отчет: задержки
+обработчиков (p50/p95/p99), пропускная способность, ожидание в очереди, рост памяти.
+
+Пример:
+    python load_test.py --users 200 --rate 20 --llm-latency lognormal:1.5,0.5 --llm-error-rate 0.02
+    python load_test.py --updates recorded.jsonl --rate 50 --json report.json
+"""
+
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from http_server import HTTPServer, Request, Response
+
+logger = logging.getLogger("load_test")
+
+Distribution = Callable[[random.Random], float]
+
+def parse_distribution(spec: str) -> Distribution:
+    """Распределение задержки из строки, секунды
+
+    fixed:1.0 | uniform:0.5,2 | normal:1.2,0.3 | lognormal:медиана,sigma | exp:среднее
+    """
+    name, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',')] if args else []
+    name = name.lower()
+
+    if name == 'fixed':
+        return lambda rng: values[0]
+    if name == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == 'normal':
+        return lambda rng: max(rng.gauss(values[0], values[1]), 0.0)
+    if name == 'lognormal':
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if name == 'exp':
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"Unknown distribution: {spec}")
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0), len(ordered) - 1)
+    return ordered[index]
+
+def rss_bytes() -> int:
+    """Текущий размер резидентной памяти процесса"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Заглушка OpenAI
+
+MOCK_WORDS = (
+    "Понимаю ваши чувства. Давайте разберемся, что стоит за этой ситуацией и "
+    "какие сильные стороны помогут вам двигаться дальше в карьере и жизни."
+).split()
+
+class MockOpenAIServer:
+    """Локальный сервер /v1/chat/completions с заданной задержкой и долей ошибок"""
+
+    def __init__(
+        self,
+        latency: Distribution,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        completion_tokens: int = 120,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.completion_tokens = completion_tokens
+        self._rng = random.Random(seed)
+        self._ids = itertools.count(1)
+
+        self.server = HTTPServer("127.0.0.1", 0, max_body_size=16 * 1024 * 1024)
+        self.server.add_route('POST', '/v1/chat/completions', self.handle_completion)
+
+        # Метрики
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.in_flight_max = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.port}/v1"
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def stop(self) -> None:
+        await self.server.stop()
+
+    async def handle_completion(self, request: Request) -> Response:
+        body = request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.in_flight_max = max(self.in_flight_max, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency(self._rng))
+        finally:
+            self.in_flight -= 1
+
+        if self._rng.random() < self.error_rate:
+            self.errors += 1
+            return Response.json({'error': {'message': 'mock error', 'type': 'server_error'}}, self.error_status)
+
+        tokens = min(int(body.get('max_tokens') or self.completion_tokens), self.completion_tokens)
+        words = [MOCK_WORDS[i % len(MOCK_WORDS)] for i in range(tokens)]
+        prompt_tokens = sum(len(message.get('content', '')) for message in body.get('messages', [])) // 3
+        completion_id = f"chatcmpl-mock-{next(self._ids)}"
+        created = int(time.time())
+        model = body.get('model', 'mock')
+
+        if not body.get('stream'):
+            return Response.json({
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': " ".join(words)},
+                    'finish_reason': 'stop',
+                }],
+                'usage': {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': tokens,
+                    'total_tokens': prompt_tokens + tokens,
+                },
+            })
+
+        # Потоковый ответ отдается одним телом: задержка уже учтена выше
+        events = []
+        for index, word in enumerate(words):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'delta': {'content': word if index == 0 else " " + word},
+                    'finish_reason': None,
+                }],
+            }
+            events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+        events.append("data: [DONE]\n\n")
+        return Response(200, "".join(events).encode('utf-8'), "text/event-stream")
+
+    def get_stats(self) -> Dict:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight_max': self.in_flight_max,
+        }
+
+# Заглушка Bot API
+
+class MockTelegramRequest(BaseRequest):
+    """Транспорт Bot API без сети: отвечает как Telegram с заданной задержкой"""
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+
+    def __init__(self, latency: Distribution, seed: int = 0):
+        self.latency = latency
+        self._rng = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self.calls: Dict[str, int] = {}
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data is not None else {}
+
+        delay = self.latency(self._rng)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if api_method == 'getMe':
+            result: Any = self.BOT_USER
+        elif api_method in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': params.get('message_id') or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id'), 'type': 'private'},
+                'from': self.BOT_USER,
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+# Обновления
+
+FREE_MESSAGES = [
+    "Я устал на работе и не понимаю, куда двигаться дальше",
+    "Мне кажется, я выгорел. Каждый день одно и то же",
+    "Хочу сменить профессию, но боюсь, что не справлюсь",
+    "Начальник постоянно критикует, и я теряю уверенность в себе",
+    "Мечтаю открыть свое дело, но не знаю, с чего начать",
+    "Какие профессии подходят интроверту?",
+    "Меня тревожит будущее, не могу уснуть по ночам",
+    "Коллеги не воспринимают меня всерьез, что делать?",
+    "Я люблю рисовать и программировать, как это совместить?",
+    "Стоит ли идти на курсы аналитики данных в тридцать пять лет?",
+]
+
+FULL_ANALYSIS_ANSWERS = [
+    "В детстве я много времени проводил с бабушкой, она научила меня терпению",
+    "Меня мотивирует ощущение, что моя работа кому-то действительно помогает",
+    "Со стрессом справляюсь плохо: замыкаюсь в себе, потом долго восстанавливаюсь",
+    "Лучше всего работаю один, но с возможностью обсудить задачу с коллегами",
+    "Боюсь ошибиться и разочаровать близких, поэтому долго откладываю решения",
+    "Через пять лет вижу себя руководителем небольшой команды в любимой сфере",
+    "Хотел бы стать смелее и меньше зависеть от чужого мнения о себе",
+]
+
+def make_update(update_id: int, user_id: int, text: str) -> Dict:
+    """JSON обновления с текстовым сообщением (как его присылает Telegram)"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'language_code': 'ru'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+def synthetic_updates(users: int, messages: int, full_analysis_share: float, seed: int = 0) -> List[Dict]:
+    """Сценарии пользователей, перемешанные с сохранением порядка внутри сценария"""
+    rng = random.Random(seed)
+    scripts: List[List[str]] = []
+    for _ in range(users):
+        script = ["/start"] + [rng.choice(FREE_MESSAGES) for _ in range(messages)]
+        if rng.random() < full_analysis_share:
+            script += ["Хочу полный анализ"] + FULL_ANALYSIS_ANSWERS
+        scripts.append(script)
+
+    positions = [0] * users
+    active = list(range(users))
+    updates: List[Dict] = []
+    while active:
+        index = rng.randrange(len(active))
+        user = active[index]
+        updates.append(make_update(len(updates) + 1, 100000 + user, scripts[user][positions[user]]))
+        positions[user] += 1
+        if positions[user] == len(scripts[user]):
+            active.pop(index)
+    return updates
+
+def load_updates(path: str) -> List[Dict]:
+    """Записанные обновления: JSON-массив или JSON Lines"""
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+# Прогон
+
+@dataclass
+class Sample:
+    """Одно обработанное обновление"""
+    route: str
+    queued: float  # ожидание в очереди, с
+    handler: float  # время обработки, с
+
+@dataclass
+class _Item:
+    update: Update
+    arrived_at: float
+
+@dataclass
+class LoadTestResult:
+    samples: List[Sample] = field(default_factory=list)
+    offered: int = 0
+    rejected: int = 0
+    handler_errors: int = 0
+    elapsed: float = 0.0
+    queue_depth_max: int = 0
+    rss_samples: List[int] = field(default_factory=list)
+
+class LoadTestRunner:
+    """Подача обновлений в приложение бота с заданной частотой"""
+
+    def __init__(self, bot_module, application, rate: float, poisson: bool, queue_size: int, workers: int, seed: int = 0):
+        self.bot = bot_module
+        self.application = application
+        self.rate = rate
+        self.poisson = poisson
+        self._rng = random.Random(seed)
+        self.result = LoadTestResult()
+
+        # Та же очередь с разбиением по пользователю, что и в режиме вебхука
+        from webhook_server import UpdateDispatcher, update_key
+        self.dispatcher = UpdateDispatcher(
+            self._process, queue_size=queue_size, workers=workers, key=lambda item: update_key(item.update),
+        )
+        application.add_error_handler(self._on_error)
+
+    async def _on_error(self, update, context) -> None:
+        self.result.handler_errors += 1
+        logger.debug(f"Handler error: {context.error}")
+
+    def _route(self, update: Update) -> str:
+        """Какой обработчик получит обновление"""
+        text = update.message.text if update.message else ''
+        if text.startswith('/'):
+            return 'command'
+        session = self.bot.sessions.get(update.effective_user.id)
+        if session is not None and session.state == 'full_analysis':
+            return 'handle_full_analysis_answer'
+        return 'handle_message'
+
+    async def _process(self, item: _Item) -> None:
+        started_at = time.perf_counter()
+        route = self._route(item.update)
+        await self.application.process_update(item.update)
+        finished_at = time.perf_counter()
+        self.result.samples.append(Sample(route, started_at - item.arrived_at, finished_at - started_at))
+
+    async def _monitor(self, interval: float = 0.5) -> None:
+        while True:
+            self.result.rss_samples.append(rss_bytes())
+            self.result.queue_depth_max = max(self.result.queue_depth_max, self.dispatcher.queue_depth)
+            await asyncio.sleep(interval)
+
+    async def run(self, updates: List[Dict], drain_timeout: float = 300.0) -> LoadTestResult:
+        self.dispatcher.start()
+        monitor = asyncio.create_task(self._monitor())
+        started_at = time.perf_counter()
+        next_at = started_at
+
+        for data in updates:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at += self._rng.expovariate(self.rate) if self.poisson else 1 / self.rate
+
+            update = Update.de_json(data, self.application.bot)
+            if update is None or update.message is None:
+                continue
+            self.result.offered += 1
+            if not self.dispatcher.submit(_Item(update, time.perf_counter())):
+                self.result.rejected += 1
+
+        await self.dispatcher.drain(drain_timeout)
+        self.result.elapsed = time.perf_counter() - started_at
+        await self.dispatcher.stop()
+
+        monitor.cancel()
+        self.result.rss_samples.append(rss_bytes())
+        return self.result
+
+# Отчет
+
+def _latency_summary(values: List[float]) -> Dict:
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000 if values else 0.0,
+    }
+
+def build_report(result: LoadTestResult, rate: float, mock_openai: MockOpenAIServer,
+                 telegram: MockTelegramRequest, bot_module) -> Dict:
+    """Сводка прогона"""
+    routes: Dict[str, List[Sample]] = {}
+    for sample in result.samples:
+        routes.setdefault(sample.route, []).append(sample)
+
+    rss = result.rss_samples or [0]
+    return {
+        'offered_rate': rate,
+        'offered': result.offered,
+        'completed': len(result.samples),
+        'rejected': result.rejected,
+        'handler_errors': result.handler_errors,
+        'elapsed_s': result.elapsed,
+        'throughput_per_s': len(result.samples) / result.elapsed if result.elapsed else 0.0,
+        'handler_latency': _latency_summary([sample.handler for sample in result.samples]),
+        'end_to_end_latency': _latency_summary([sample.queued + sample.handler for sample in result.samples]),
+        'queue_wait': _latency_summary([sample.queued for sample in result.samples]),
+        'queue_depth_max': result.queue_depth_max,
+        'routes': {
+            route: _latency_summary([sample.handler for sample in samples])
+            for route, samples in sorted(routes.items())
+        },
+        'memory': {
+            'rss_start_mb': rss[0] / 1024 / 1024,
+            'rss_end_mb': rss[-1] / 1024 / 1024,
+            'rss_peak_mb': max(rss) / 1024 / 1024,
+            'rss_growth_mb': (rss[-1] - rss[0]) / 1024 / 1024,
+            'sessions_mb': bot_module.sessions.get_stats()['memory_bytes'] / 1024 / 1024,
+        },
+        'llm_mock': mock_openai.get_stats(),
+        'llm_scheduler': bot_module.llm_scheduler.get_stats(),
+        'telegram_calls': dict(sorted(telegram.calls.items())),
+        'bot_metrics': bot_module.metrics.get_stats(),
+    }
+
+def format_report(report: Dict) -> str:
+    """Отчет для терминала"""
+    def latency_line(name: str, data: Dict) -> str:
+        return (
+            f"  {name:<28} n={data['count']:<6} p50={data['p50_ms']:8.1f}  p95={data['p95_ms']:8.1f}  "
+            f"p99={data['p99_ms']:8.1f}  max={data['max_ms']:8.1f} мс"
+        )
+
+    memory = report['memory']
+    llm = report['llm_mock']
+    lines = [
+        f"Подано: {report['offered']} обновлений ({report['offered_rate']:.1f}/с), "
+        f"обработано: {report['completed']}, отклонено (очередь полна): {report['rejected']}, "
+        f"ошибок обработчиков: {report['handler_errors']}",
+        f"Пропускная способность: {report['throughput_per_s']:.1f} обновлений/с за {report['elapsed_s']:.1f} с",
+        "Задержки:",
+        latency_line("обработчик", report['handler_latency']),
+        latency_line("очередь", report['queue_wait']),
+        latency_line("всего (очередь + обработка)", report['end_to_end_latency']),
+        "По обработчикам:",
+        *(latency_line(route, data) for route, data in report['routes'].items()),
+        f"Максимальная глубина очереди: {report['queue_depth_max']}",
+        f"Память (RSS): {memory['rss_start_mb']:.1f} → {memory['rss_end_mb']:.1f} МБ "
+        f"(пик {memory['rss_peak_mb']:.1f}, рост {memory['rss_growth_mb']:+.1f}), сессии {memory['sessions_mb']:.2f} МБ",
+        f"Заглушка OpenAI: запросов {llm['requests']}, ошибок {llm['errors']}, "
+        f"одновременно до {llm['in_flight_max']}",
+        "Очередь LLM: " + ", ".join(
+            f"{lane} (отклонено {data['rejected']}, просрочено {data['expired']}, ожидание макс {data['wait_max']:.1f}с)"
+            for lane, data in report['llm_scheduler']['lanes'].items()
+        ),
+        "Bot API: " + ", ".join(f"{method} {count}" for method, count in report['telegram_calls'].items()),
+        "Этапы обработки (метрики бота):",
+        *(
+            f"  {stage:<28} n={data['count']:<6} avg={data['avg'] * 1000:8.3f}  p95={data['p95'] * 1000:8.3f} мс"
+            for stage, data in report['bot_metrics']['stages'].items()
+        ),
+    ]
+    return "\n".join(lines)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование HR-Психоаналитика")
+    source = parser.add_argument_group("обновления")
+    source.add_argument('--updates', help="файл с записанными обновлениями (JSON-массив или JSON Lines)")
+    source.add_argument('--users', type=int, default=100, help="синтетических пользователей")
+    source.add_argument('--messages', type=int, default=3, help="свободных сообщений на пользователя")
+    source.add_argument('--full-analysis-share', type=float, default=0.2,
+                        help="доля пользователей, проходящих полный анализ")
+
+    load = parser.add_argument_group("нагрузка")
+    load.add_argument('--rate', type=float, default=10.0, help="обновлений в секунду")
+    load.add_argument('--poisson', action='store_true', help="пуассоновский поток вместо равномерного")
+    load.add_argument('--queue-size', type=int, default=1000, help="емкость очереди обновлений")
+    load.add_argument('--workers', type=int, default=None, help="обработчиков (по умолчанию WEBHOOK_WORKERS)")
+    load.add_argument('--drain-timeout', type=float, default=300.0)
+
+    mocks = parser.add_argument_group("заглушки")
+    mocks.add_argument('--llm-latency', default='lognormal:1.5,0.5', help="задержка OpenAI, см. parse_distribution")
+    mocks.add_argument('--llm-error-rate', type=float, default=0.0, help="доля ответов OpenAI с ошибкой")
+    mocks.add_argument('--llm-error-status', type=int, default=500, help="HTTP-статус ошибки (500, 429, ...)")
+    mocks.add_argument('--llm-tokens', type=int, default=120, help="длина ответа заглушки, слов")
+    mocks.add_argument('--telegram-latency', default='fixed:0.03', help="задержка Bot API")
+
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path', help="сохранить отчет в JSON")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+async def run_load_test(args: argparse.Namespace) -> Dict:
+    mock_openai = MockOpenAIServer(
+        parse_distribution(args.llm_latency),
+        error_rate=args.llm_error_rate,
+        error_status=args.llm_error_status,
+        completion_tokens=args.llm_tokens,
+        seed=args.seed,
+    )
+    await mock_openai.start()
+
+    # Настройки читаются модулем бота при импорте: внешние сервисы и базы - только тестовые
+    workdir = tempfile.mkdtemp(prefix="hr-bot-load-")
+    os.environ.update({
+        'BOT_TOKEN': '123456:LOADTEST',
+        'OPENAI_API_KEY': 'load-test',
+        'OPENAI_BASE_URL': mock_openai.base_url,
+        'DATABASE_PATH': os.path.join(workdir, 'psychoanalyst.db'),
+        'SESSION_DB_PATH': os.path.join(workdir, 'sessions.db'),
+        'RESPONSE_CACHE_PATH': '',
+    })
+    import hr_psychoanalyst_bot as bot
+    logging.getLogger().setLevel(args.log_level.upper())
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    bot.init_database()
+
+    telegram = MockTelegramRequest(parse_distribution(args.telegram_latency), seed=args.seed)
+    application = bot.build_application(request=telegram)
+
+    if args.updates:
+        updates = load_updates(args.updates)
+    else:
+        updates = synthetic_updates(args.users, args.messages, args.full_analysis_share, seed=args.seed)
+
+    runner = LoadTestRunner(
+        bot, application,
+        rate=args.rate,
+        poisson=args.poisson,
+        queue_size=args.queue_size,
+        workers=args.workers or bot.WEBHOOK_WORKERS,
+        seed=args.seed,
+    )
+    try:
+        async with bot.running_application(application):
+            result = await runner.run(updates, drain_timeout=args.drain_timeout)
+            report = build_report(result, args.rate, mock_openai, telegram, bot)
+    finally:
+        await mock_openai.stop()
+    return report
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=args.log_level.upper())
+
+    report = asyncio.run(run_load_test(args))
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
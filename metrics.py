@@ -0,0 +1,446 @@
+"""
+Модуль метрик производительности
+Счетчики и гистограммы по этапам обработки сообщения, маршрутам handle_message,
+запросам к LLM (время, токены, ошибки) и Bot API. Метрики отдаются в формате
+Prometheus и сводятся в /stats
+"""
+
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+from http_server import HTTPServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды: от локальных этапов до ответа LLM
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Локальные этапы (язык, паттерны, сессия) занимают микросекунды, LLM - секунды
+STAGE_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025) + DEFAULT_BUCKETS
+
+LabelValues = Tuple[str, ...]
+
+@dataclass
+class GaugeSample:
+    """Значение, снимаемое в момент выгрузки (очереди, кэши, память)"""
+    name: str
+    help: str
+    value: float
+    labels: Optional[Dict[str, str]] = None
+
+Collector = Callable[[], Iterable[GaugeSample]]
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0.0)
+
+    def items(self) -> List[Tuple[LabelValues, float]]:
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value:g}"
+            for key, value in self.items()
+        ]
+
+@dataclass
+class HistogramSnapshot:
+    """Состояние гистограммы для одного набора меток"""
+    buckets: Tuple[float, ...]
+    counts: List[int]  # по корзинам (не накопительно), последняя - +Inf
+    count: int
+    sum: float
+
+    @property
+    def avg(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины (как histogram_quantile)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index >= len(self.buckets):
+                    # Выше последней границы значение не оценить
+                    return self.buckets[-1]
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами и метками"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, HistogramSnapshot] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = HistogramSnapshot(self.buckets, [0] * (len(self.buckets) + 1), 0, 0.0)
+            series.counts[index] += 1
+            series.count += 1
+            series.sum += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Замерить длительность блока (в том числе с await внутри)"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def snapshot(self, **labels: str) -> Optional[HistogramSnapshot]:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return None
+            return HistogramSnapshot(series.buckets, list(series.counts), series.count, series.sum)
+
+    def items(self) -> List[Tuple[LabelValues, HistogramSnapshot]]:
+        with self._lock:
+            return sorted(
+                (key, HistogramSnapshot(series.buckets, list(series.counts), series.count, series.sum))
+                for key, series in self._series.items()
+            )
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, series in self.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), series.counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series.sum:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series.count}")
+        return lines
+
+class MetricsRegistry:
+    """Набор метрик процесса и выгрузка в формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Collector) -> None:
+        """Функция, возвращающая текущие значения (gauge) при каждой выгрузке"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition 0.0.4"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+
+        described = set()
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+                continue
+            for sample in samples:
+                if sample.name not in described:
+                    described.add(sample.name)
+                    lines.append(f"# HELP {sample.name} {sample.help}")
+                    lines.append(f"# TYPE {sample.name} gauge")
+                labels = sample.labels or {}
+                lines.append(f"{sample.name}{_format_labels(list(labels), list(labels.values()))} {float(sample.value):g}")
+        return "\n".join(lines) + "\n"
+
+class _RouteHolder:
+    __slots__ = ('route',)
+
+    def __init__(self, route: str):
+        self.route = route
+
+_current_route: ContextVar[Optional[_RouteHolder]] = ContextVar('current_route', default=None)
+
+class BotMetrics:
+    """Метрики бота: этапы, маршруты, LLM и Bot API"""
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry or MetricsRegistry()
+        self.stage_seconds = self.registry.histogram(
+            'bot_stage_seconds', "Длительность этапа обработки сообщения", ('stage',), STAGE_BUCKETS,
+        )
+        self.route_seconds = self.registry.histogram(
+            'bot_route_seconds', "Полное время обработки сообщения по маршруту", ('handler', 'route'),
+        )
+        self.handler_errors = self.registry.counter(
+            'bot_handler_errors_total', "Необработанные исключения в обработчиках", ('handler',),
+        )
+        self.llm_seconds = self.registry.histogram(
+            'bot_llm_request_seconds', "Длительность запроса к OpenAI (без ожидания в очереди)", ('priority', 'mode'),
+        )
+        self.llm_first_token_seconds = self.registry.histogram(
+            'bot_llm_first_token_seconds', "Время до первого токена потокового ответа", ('priority',),
+        )
+        self.llm_requests = self.registry.counter(
+            'bot_llm_requests_total', "Запросы к OpenAI по результату (ok, error, rejected)", ('priority', 'status'),
+        )
+        self.llm_tokens = self.registry.counter(
+            'bot_llm_tokens_total', "Токены OpenAI (prompt, completion)", ('priority', 'kind'),
+        )
+        self.telegram_requests = self.registry.counter(
+            'bot_telegram_requests_total', "Запросы к Bot API", ('method', 'status'),
+        )
+
+    # Этапы и маршруты
+
+    def stage(self, name: str):
+        """Контекстный менеджер: замер этапа обработки"""
+        return self.stage_seconds.time(stage=name)
+
+    def set_route(self, route: str) -> None:
+        """Отметить маршрут текущего сообщения (учитывается по завершении обработчика)"""
+        holder = _current_route.get()
+        if holder is not None:
+            holder.route = route
+
+    def instrument_handler(self, name: str, default_route: Optional[str] = None):
+        """Декоратор обработчика: общее время по маршруту и исключения"""
+        def decorator(handler):
+            @wraps(handler)
+            async def wrapper(*args, **kwargs):
+                holder = _RouteHolder(default_route or name)
+                token = _current_route.set(holder)
+                started_at = time.perf_counter()
+                try:
+                    return await handler(*args, **kwargs)
+                except Exception:
+                    self.handler_errors.inc(handler=name)
+                    raise
+                finally:
+                    self.route_seconds.observe(time.perf_counter() - started_at, handler=name, route=holder.route)
+                    _current_route.reset(token)
+            return wrapper
+        return decorator
+
+    # LLM и Bot API
+
+    def observe_llm(
+        self,
+        priority: str,
+        status: str,
+        seconds: Optional[float] = None,
+        mode: str = 'complete',
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+    ) -> None:
+        self.llm_requests.inc(priority=priority, status=status)
+        if seconds is not None:
+            self.llm_seconds.observe(seconds, priority=priority, mode=mode)
+            # В сводке этапов запрос к OpenAI стоит рядом с локальными этапами
+            self.stage_seconds.observe(seconds, stage='llm')
+        if prompt_tokens:
+            self.llm_tokens.inc(prompt_tokens, priority=priority, kind='prompt')
+        if completion_tokens:
+            self.llm_tokens.inc(completion_tokens, priority=priority, kind='completion')
+
+    def render(self) -> str:
+        return self.registry.render()
+
+    def get_stats(self) -> Dict:
+        """Сводка для /stats: квантили по маршрутам и этапам, итоги по LLM"""
+        def summary(series: HistogramSnapshot) -> Dict:
+            return {
+                'count': series.count,
+                'avg': series.avg,
+                'p50': series.quantile(0.5),
+                'p95': series.quantile(0.95),
+                'p99': series.quantile(0.99),
+            }
+
+        llm: Dict[str, Dict[str, float]] = {}
+        for (priority, status), value in self.llm_requests.items():
+            llm.setdefault(priority, {})[status] = value
+        for (priority, kind), value in self.llm_tokens.items():
+            llm.setdefault(priority, {})[f'{kind}_tokens'] = value
+        for (priority, mode), series in self.llm_seconds.items():
+            llm.setdefault(priority, {})[f'{mode}_p95'] = series.quantile(0.95)
+
+        return {
+            'routes': {
+                f"{handler}/{route}": summary(series)
+                for (handler, route), series in self.route_seconds.items()
+            },
+            'stages': {stage: summary(series) for (stage,), series in self.stage_seconds.items()},
+            'llm': llm,
+            'handler_errors': sum(value for _, value in self.handler_errors.items()),
+            'telegram_errors': sum(
+                value for (_, status), value in self.telegram_requests.items() if status != 'ok'
+            ),
+        }
+
+class InstrumentedRequest(BaseRequest):
+    """Транспорт Bot API с замером времени запросов (обертка над другим транспортом)"""
+
+    def __init__(self, inner: BaseRequest, metrics: BotMetrics):
+        self.inner = inner
+        self.metrics = metrics
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        status = 'error'
+        try:
+            with self.metrics.stage('telegram'):
+                code, payload = await self.inner.do_request(
+                    url, method, request_data,
+                    read_timeout=read_timeout,
+                    write_timeout=write_timeout,
+                    connect_timeout=connect_timeout,
+                    pool_timeout=pool_timeout,
+                )
+            status = 'ok' if 200 <= code < 300 else str(code)
+            return code, payload
+        finally:
+            self.metrics.telegram_requests.inc(method=api_method, status=status)
+
+class StartupTimer:
+    """Время запуска по этапам: от старта процесса до первого обработанного обновления"""
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self._last_mark = self.started_at
+        self.phases: Dict[str, float] = {}  # этапы на пути к первому обновлению, по порядку
+        self.background: Dict[str, float] = {}  # работа вне этого пути (прогрев)
+        self.first_update: Optional[float] = None
+
+    def mark(self, phase: str) -> None:
+        """Завершить этап: время от предыдущей отметки"""
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last_mark
+        self._last_mark = now
+
+    def record_background(self, phase: str, seconds: float) -> None:
+        self.background[phase] = seconds
+
+    def update_handled(self) -> bool:
+        """Отметить обработанное обновление; True - первое"""
+        if self.first_update is not None:
+            return False
+        self.first_update = time.perf_counter() - self.started_at
+        return True
+
+    def format(self) -> str:
+        parts = [f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items()]
+        parts += [f"{phase} {seconds:.2f}s (background)" for phase, seconds in self.background.items()]
+        if self.first_update is not None:
+            parts.append(f"first update after {self.first_update:.2f}s")
+        return ", ".join(parts)
+
+    def collect(self) -> List[GaugeSample]:
+        samples = [
+            GaugeSample('bot_startup_phase_seconds', "Длительность этапа запуска", seconds, {'phase': phase})
+            for phase, seconds in list(self.phases.items()) + list(self.background.items())
+        ]
+        if self.first_update is not None:
+            samples.append(GaugeSample(
+                'bot_startup_first_update_seconds', "Время от старта процесса до первого обработанного обновления",
+                self.first_update,
+            ))
+        return samples
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def create_metrics_server(registry: MetricsRegistry, host: str, port: int, path: str = "/metrics") -> HTTPServer:
+    """HTTP-сервер, отдающий метрики реестра для Prometheus"""
+    server = HTTPServer(host, port)
+
+    async def handle_metrics(request: Request) -> Response:
+        return Response(200, registry.render().encode('utf-8'), PROMETHEUS_CONTENT_TYPE)
+
+    server.add_route('GET', path, handle_metrics)
+    return server
+
+_bot_metrics: Optional[BotMetrics] = None
+
+def get_bot_metrics() -> BotMetrics:
+    """Фабричная функция: метрики процесса (создаются один раз)"""
+    global _bot_metrics
+    if _bot_metrics is None:
+        _bot_metrics = BotMetrics()
+    return _bot_metrics
@@ -0,0 +1,250 @@
+"""
+Модуль профилирования по требованию
+Фоновый поток с заданным интервалом снимает стек потока цикла событий
+(sys._current_frames) и помечает выборку задачей asyncio, которая выполнялась
+в этот момент. Результат - файл в формате collapsed stacks (flamegraph.pl,
+speedscope) и топ функций по накопленному времени
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Кадры механики asyncio ниже вызова колбэка (run_forever -> _run_once -> Handle._run)
+# есть в каждой выборке и только заслоняют полезные функции
+_LOOP_FRAME = ('_run', 'events.py')
+_IDLE_FRAME = ('select', 'selectors.py')
+
+class ProfilerError(Exception):
+    """Профилирование уже идет или не запущено"""
+
+@dataclass
+class FunctionStats:
+    """Выборки одной функции"""
+    name: str
+    cumulative: int = 0  # функция была в стеке
+    own: int = 0  # функция была на вершине стека
+
+@dataclass
+class ProfileReport:
+    """Итог сеанса профилирования"""
+    duration: float
+    interval: float
+    samples: int  # выборки с работой (без простоя цикла событий)
+    idle_samples: int
+    updates: int
+    path: Optional[str]
+    functions: List[FunctionStats] = field(default_factory=list)
+    tasks: Dict[str, int] = field(default_factory=dict)
+
+    def top(self, limit: int = 15) -> List[FunctionStats]:
+        """Функции по убыванию накопленного времени"""
+        return sorted(self.functions, key=lambda item: (-item.cumulative, -item.own))[:limit]
+
+    @property
+    def busy_share(self) -> float:
+        total = self.samples + self.idle_samples
+        return self.samples / total if total else 0.0
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _is_frame(frame, marker: Tuple[str, str]) -> bool:
+    code = frame.f_code
+    return code.co_name == marker[0] and code.co_filename.endswith(marker[1])
+
+def _task_name(task: Optional[asyncio.Task]) -> str:
+    if task is None:
+        return "(event loop)"
+    name = task.get_name()
+    if name.startswith("Task-"):
+        # Безымянные задачи различаем по корутине
+        coro = task.get_coro()
+        return getattr(coro, '__qualname__', name)
+    return name
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик потока цикла событий
+
+    Целевой поток не останавливается: стек читается из фонового потока,
+    поэтому накладные расходы ограничены частотой выборок
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 128, output_dir: str = "profiles"):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.output_dir = output_dir
+
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._target_thread = 0
+        self._done: Optional[asyncio.Event] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._report: Optional[ProfileReport] = None
+
+        self._stacks: Counter = Counter()
+        self._idle = 0
+        self._started_at = 0.0
+        self.max_updates: Optional[int] = None
+        self.updates = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, max_updates: Optional[int] = None, max_seconds: float = 60.0) -> None:
+        """Начать профилирование потока, в котором работает текущий цикл событий
+
+        Сеанс завершается после max_updates обработанных обновлений (record_update)
+        или через max_seconds - что наступит раньше
+        """
+        if self.running:
+            raise ProfilerError("Профилирование уже идет")
+
+        self._loop = asyncio.get_running_loop()
+        self._target_thread = threading.get_ident()
+        self._done = asyncio.Event()
+        self._report = None
+        self._stacks = Counter()
+        self._idle = 0
+        self.max_updates = max_updates
+        self.updates = 0
+        self._started_at = time.monotonic()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        self._timer = self._loop.call_later(max_seconds, self._finish)
+        logger.info(f"Profiling started: max_updates={max_updates}, max_seconds={max_seconds}")
+
+    def record_update(self) -> None:
+        """Отметить обработанное обновление (вызывается из цикла событий)"""
+        if not self.running:
+            return
+        self.updates += 1
+        if self.max_updates and self.updates >= self.max_updates:
+            self._finish()
+
+    async def wait(self) -> ProfileReport:
+        """Дождаться завершения сеанса и получить отчет"""
+        if self._done is None:
+            raise ProfilerError("Профилирование не запускалось")
+        await self._done.wait()
+        return self._report
+
+    def stop(self) -> ProfileReport:
+        """Завершить сеанс досрочно"""
+        if not self.running:
+            raise ProfilerError("Профилирование не запущено")
+        self._finish()
+        return self._report
+
+    def _finish(self) -> None:
+        if not self.running:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        self._report = self._build_report(time.monotonic() - self._started_at)
+        try:
+            self._report.path = self._write_collapsed()
+        except OSError as e:
+            logger.error(f"Error writing profile: {e}")
+        logger.info(
+            f"Profiling finished: {self._report.samples} samples, {self.updates} updates, "
+            f"report {self._report.path}"
+        )
+        self._done.set()
+
+    # Выборки (фоновый поток)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except Exception as e:
+                logger.error(f"Profiler sample failed: {e}")
+
+    def _sample(self) -> None:
+        frame = sys._current_frames().get(self._target_thread)
+        if frame is None:
+            return
+        if _is_frame(frame, _IDLE_FRAME):
+            self._idle += 1
+            return
+
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            if _is_frame(frame, _LOOP_FRAME):
+                break
+            frames.append(_frame_name(frame))
+            frame = frame.f_back
+        frames.reverse()
+
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            task = None
+        self._stacks[(_task_name(task),) + tuple(frames)] += 1
+
+    # Отчет
+
+    def _build_report(self, duration: float) -> ProfileReport:
+        functions: Dict[str, FunctionStats] = {}
+        tasks: Counter = Counter()
+        for stack, count in self._stacks.items():
+            task, frames = stack[0], stack[1:]
+            tasks[task] += count
+            # Рекурсивная функция учитывается в выборке один раз
+            for name in set(frames):
+                functions.setdefault(name, FunctionStats(name)).cumulative += count
+            if frames:
+                functions[frames[-1]].own += count
+
+        return ProfileReport(
+            duration=duration,
+            interval=self.interval,
+            samples=sum(self._stacks.values()),
+            idle_samples=self._idle,
+            updates=self.updates,
+            path=None,
+            functions=list(functions.values()),
+            tasks=dict(tasks.most_common()),
+        )
+
+    def _write_collapsed(self) -> Optional[str]:
+        if not self._stacks:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.collapsed"
+        )
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(";".join(part.replace(";", ":") for part in stack) + f" {count}\n")
+        return path
+
+_profiler: Optional[SamplingProfiler] = None
+
+def get_profiler(interval: float = 0.005, output_dir: str = "profiles") -> SamplingProfiler:
+    """Фабричная функция: профилировщик процесса (создается один раз)"""
+    global _profiler
+    if _profiler is None:
+        _profiler = SamplingProfiler(interval=interval, output_dir=output_dir)
+    return _profiler
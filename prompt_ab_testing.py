@@ -4,14 +4,21 @@
 """
 
 import json
+import time
+import hashlib
+import atexit
 import random
-import sqlite3
 import logging
-from datetime import datetime
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass, asdict
 from enum import Enum
 
+from database import get_database, DEFAULT_DB_PATH
+from prompt_templates import compile_template, CompiledTemplate, TemplateError
+
 logger = logging.getLogger(__name__)
 
 class PromptType(Enum):
@@ -22,6 +29,19 @@ class PromptType(Enum):
     CAREER_ADVICE = "career_advice"
     EMOTIONAL_SUPPORT = "emotional_support"
 
+# Поля, которые построители промптов передают в шаблоны каждого типа
+PROMPT_FIELDS = {
+    PromptType.EXPRESS_ANALYSIS: frozenset({'conversation', 'message_count', 'emotional_trend'}),
+    PromptType.FULL_ANALYSIS: frozenset({'answers_text'}),
+    PromptType.PSYCHOLOGY_CONSULTATION: frozenset({
+        'user_message', 'conversation_context', 'sentiment_analysis', 'emotional_trend'
+    }),
+    PromptType.CAREER_ADVICE: frozenset({'user_message', 'conversation_context', 'emotional_trend'}),
+    PromptType.EMOTIONAL_SUPPORT: frozenset({
+        'user_message', 'conversation_context', 'sentiment_analysis', 'emotional_trend'
+    }),
+}
+
 @dataclass
 class PromptVariant:
     """Вариант промпта для A/B тестирования"""
@@ -45,19 +65,258 @@ class TestResult:
     conversion: bool = False  # did user convert to paid?
     timestamp: datetime = None
 
+# Метрики результата, для которых ведутся количество, сумма и сумма квадратов
+AGGREGATED_METRICS = ('feedback', 'quality', 'engagement')
+
+def _aggregate_columns() -> List[str]:
+    return [f'{metric}_{part}' for metric in AGGREGATED_METRICS for part in ('count', 'sum', 'sumsq')]
+
+class TestResultWriter:
+    """Отложенная пакетная запись результатов A/B тестов (write-behind)
+
+    Результаты копятся в памяти и записываются одной транзакцией,
+    когда набирается batch_size строк или проходит flush_interval секунд.
+    В той же транзакции обновляются агрегаты по вариантам (ab_variant_aggregates).
+    Если запись не удается, повторы идут с растущей паузой (до max_backoff), а
+    очередь ограничена max_pending строками - самые старые отбрасываются.
+    """
+    
+    def __init__(
+        self,
+        db,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        max_pending: int = 10000,
+        max_backoff: float = 30.0,
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        
+        self._pending: List[TestResult] = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._consecutive_failures = 0
+        self._drop_logged = False  # предупреждение об отбрасывании - раз до успешной записи
+        
+        # Метрики
+        self.enqueued = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+    
+    def add(self, result: TestResult):
+        """Поставить результат в очередь на запись"""
+        with self._condition:
+            self._pending.append(result)
+            self.enqueued += 1
+            self._trim_pending()
+            closed = self._closed
+            if not closed:
+                self._ensure_thread()
+                if len(self._pending) >= self.batch_size:
+                    self._condition.notify()
+        
+        # После остановки фонового потока пишем синхронно
+        if closed:
+            self.flush()
+    
+    def _trim_pending(self):
+        """Отбросить самые старые строки сверх max_pending (под self._condition)"""
+        excess = len(self._pending) - self.max_pending
+        if excess <= 0:
+            return
+        del self._pending[:excess]
+        self.dropped += excess
+        if not self._drop_logged:
+            self._drop_logged = True
+            logger.warning(f"A/B results queue is over {self.max_pending} rows, dropping the oldest")
+    
+    def _backoff(self) -> float:
+        """Пауза перед повтором после неудачных записей подряд (0 - ошибок не было)"""
+        if not self._consecutive_failures:
+            return 0.0
+        return min(self.flush_interval * 2 ** self._consecutive_failures, self.max_backoff)
+    
+    def _ensure_thread(self):
+        """Запустить фоновый поток записи при первом использовании"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="ab-result-writer", daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        """Цикл фонового потока: ждем пакет или истечения интервала"""
+        while True:
+            with self._condition:
+                if not self._pending and not self._closed:
+                    self._condition.wait()
+                
+                # После ошибки записи полный пакет не ускоряет повтор
+                backoff = self._backoff()
+                deadline = time.monotonic() + (backoff or self.flush_interval)
+                while (backoff or len(self._pending) < self.batch_size) and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                
+                closed = self._closed
+            
+            self.flush()
+            if closed:
+                return
+    
+    def flush(self) -> int:
+        """Записать накопленные результаты одной транзакцией"""
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, []
+            
+            if not batch:
+                return 0
+            
+            started_at = time.perf_counter()
+            try:
+                with self.db.transaction() as cursor:
+                    cursor.executemany('''
+                        INSERT INTO ab_test_results 
+                        (user_id, prompt_variant_id, prompt_type, user_feedback, 
+                         response_quality, user_engagement, conversion, timestamp)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', [
+                        (
+                            result.user_id, result.prompt_variant_id, result.prompt_type.value,
+                            result.user_feedback, result.response_quality, result.user_engagement,
+                            result.conversion, result.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+                        )
+                        for result in batch
+                    ])
+                    self._update_aggregates(cursor, batch)
+            except Exception as e:
+                logger.error(f"Error flushing A/B test results: {e}")
+                self.failures += 1
+                self._consecutive_failures += 1
+                with self._condition:
+                    self._pending = batch + self._pending
+                    self._trim_pending()
+                return 0
+            
+            if self._drop_logged:
+                logger.warning(f"A/B results writes recovered, {self.dropped} rows dropped in total")
+                self._drop_logged = False
+            self._consecutive_failures = 0
+            
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+            return len(batch)
+    
+    @staticmethod
+    def _update_aggregates(cursor, batch: List[TestResult]):
+        """Прибавить пакет к агрегатам вариантов (одна строка на вариант пакета)"""
+        totals: Dict[Tuple[str, str], List[float]] = {}
+        for result in batch:
+            row = totals.setdefault(
+                (result.prompt_variant_id, result.prompt_type.value), [0] * (2 + 3 * len(AGGREGATED_METRICS))
+            )
+            row[0] += 1
+            row[1] += 1 if result.conversion else 0
+            values = (result.user_feedback, result.response_quality, result.user_engagement)
+            for position, value in enumerate(values):
+                if value is None:
+                    continue
+                offset = 2 + position * 3
+                row[offset] += 1
+                row[offset + 1] += value
+                row[offset + 2] += value * value
+        
+        columns = ['uses', 'conversions'] + _aggregate_columns()
+        cursor.executemany(f'''
+            INSERT INTO ab_variant_aggregates (prompt_variant_id, prompt_type, {', '.join(columns)})
+            VALUES (?, ?, {', '.join('?' * len(columns))})
+            ON CONFLICT (prompt_variant_id, prompt_type) DO UPDATE SET
+                {', '.join(f'{column} = {column} + excluded.{column}' for column in columns)}
+        ''', [key + tuple(values) for key, values in totals.items()])
+    
+    def close(self):
+        """Остановить фоновый поток, дописав все оставшиеся результаты"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        
+        if thread is not None and thread.is_alive():
+            thread.join(timeout=10)
+        self.flush()
+    
+    def get_stats(self) -> Dict:
+        """Метрики очереди записи"""
+        return {
+            'queue_depth': len(self._pending),
+            'enqueued': self.enqueued,
+            'flushed_rows': self.flushed_rows,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': self.max_flush_ms,
+            'avg_flush_ms': self.total_flush_ms / self.flushes if self.flushes else 0.0,
+        }
+
 class PromptABTesting:
     """Система A/B тестирования промптов"""
     
-    def __init__(self, db_path: str = 'psychoanalyst.db'):
+    def __init__(
+        self,
+        db_path: str = DEFAULT_DB_PATH,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        assignment_cache_size: int = 10000,
+        version_check_interval: float = 30.0,
+        max_pending: int = 10000
+    ):
         self.db_path = db_path
+        self.db = get_database(db_path)
+        
+        # Кэш вариантов: шаблоны по id, активные варианты по типу, назначения пользователей (LRU)
+        self.assignment_cache_size = assignment_cache_size
+        self.version_check_interval = version_check_interval
+        self._templates: Dict[str, CompiledTemplate] = {}
+        self._active_variants: Dict[str, List[str]] = {}
+        self._assignments: OrderedDict = OrderedDict()
+        self._variants_version: Optional[int] = None
+        self._version_checked_at = 0.0
+        
         self.init_database()
         self.load_default_prompts()
+        
+        self.result_writer = TestResultWriter(self.db, batch_size, flush_interval, max_pending)
+        atexit.register(self.close)
 
     def init_database(self):
         """Инициализация таблиц для A/B тестирования"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        # Агрегаты появились позже результатов - для существующей базы их нужно заполнить
+        needs_backfill = self.db.fetchone(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ab_variant_aggregates'"
+        ) is None
+        with self.db.transaction() as cursor:
+            self._create_tables(cursor)
+            if needs_backfill:
+                self._rebuild_aggregates(cursor)
+
+    def _create_tables(self, cursor):
+        """Создание таблиц A/B тестирования"""
         # Таблица вариантов промптов
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS prompt_variants (
@@ -87,6 +346,19 @@ class PromptABTesting:
             )
         ''')
         
+        # Накопительные агрегаты результатов по вариантам: обновляются вместе с записью
+        # результатов, статистика читает их вместо GROUP BY по всем результатам
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS ab_variant_aggregates (
+                prompt_variant_id TEXT NOT NULL,
+                prompt_type TEXT NOT NULL,
+                uses INTEGER NOT NULL DEFAULT 0,
+                conversions INTEGER NOT NULL DEFAULT 0,
+                {', '.join(f'{column} REAL NOT NULL DEFAULT 0' for column in _aggregate_columns())},
+                PRIMARY KEY (prompt_variant_id, prompt_type)
+            )
+        ''')
+        
         # Таблица назначений пользователей к вариантам
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS user_variant_assignments (
@@ -98,11 +370,39 @@ class PromptABTesting:
             )
         ''')
         
-        conn.commit()
-        conn.close()
-
-    def load_default_prompts(self):
-        """Загрузка дефолтных вариантов промптов"""
+        # Версия таблицы вариантов: увеличивается триггерами при любом изменении,
+        # по ней процессы сбрасывают кэш шаблонов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS prompt_variants_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('INSERT OR IGNORE INTO prompt_variants_version (id, version) VALUES (1, 0)')
+        
+        # Хэш последних записанных дефолтных промптов: при совпадении запись пропускается
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS prompt_defaults_seed (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                content_hash TEXT NOT NULL
+            )
+        ''')
+        
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS prompt_variants_version_{event.lower()}
+                AFTER {event} ON prompt_variants
+                BEGIN
+                    UPDATE prompt_variants_version SET version = version + 1 WHERE id = 1;
+                END
+            ''')
+
+    def load_default_prompts(self) -> bool:
+        """Загрузка дефолтных вариантов промптов
+        
+        Промпты записываются, только если их содержимое изменилось с прошлого
+        запуска (по хэшу); возвращает True, если база была обновлена
+        """
         default_prompts = [
             # Экспресс-анализ - Вариант A (текущий)
             PromptVariant(
@@ -184,6 +484,8 @@ class PromptABTesting:
 ТЕКУЩЕЕ СООБЩЕНИЕ КЛИЕНТА:
 {user_message}
 
+ДИНАМИКА СОСТОЯНИЯ ЗА РАЗГОВОР: {emotional_trend}
+
 ВАЖНО: Если клиент ссылается на предыдущие части разговора ("мы говорили об этом", "выше", "раньше"), обязательно учитывай контекст из истории разговора.
 
 ТВОЯ РОЛЬ: Друг-психолог, который всегда на стороне человека и ПОМНИТ весь разговор.
@@ -222,6 +524,8 @@ class PromptABTesting:
 
 АНАЛИЗ НАСТРОЕНИЯ: {sentiment_analysis}
 
+ДИНАМИКА СОСТОЯНИЯ ЗА РАЗГОВОР: {emotional_trend}
+
 ВАЖНО: Если клиент ссылается на предыдущие части разговора, обязательно учитывай контекст из истории разговора.
 
 ТВОЙ ПОДХОД:
@@ -240,75 +544,160 @@ class PromptABTesting:
             )
         ]
         
-        # Сохраняем промпты в базу данных
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        for prompt in default_prompts:
-            cursor.execute('''
-                INSERT OR REPLACE INTO prompt_variants 
-                (id, type, name, template, description, active)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
+        rows = [
+            (
                 prompt.id, 
                 prompt.type.value, 
                 prompt.name, 
                 prompt.template, 
                 prompt.description, 
                 prompt.active
-            ))
+            )
+            for prompt in default_prompts
+        ]
+        content_hash = hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode('utf-8')).hexdigest()
+        stored = self.db.fetchone('SELECT content_hash FROM prompt_defaults_seed WHERE id = 1')
+        present = self.db.fetchone(
+            f"SELECT COUNT(*) FROM prompt_variants WHERE id IN ({', '.join('?' * len(rows))})",
+            [row[0] for row in rows],
+        )[0]
+        if stored is not None and stored[0] == content_hash and present == len(rows):
+            # Варианты компилируются при первом обращении или в warm_up()
+            return False
+        
+        # Сохраняем промпты в базу данных
+        with self.db.transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO prompt_variants 
+                (id, type, name, template, description, active)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            cursor.execute(
+                'INSERT OR REPLACE INTO prompt_defaults_seed (id, content_hash) VALUES (1, ?)', (content_hash,)
+            )
+        self.invalidate_cache()
+        logger.info(f"Default prompts written: {len(rows)} variants")
+        return True
+
+    def _refresh_variants(self, force: bool = False):
+        """Перечитать варианты промптов, если таблица изменилась"""
+        now = time.monotonic()
+        if not force and self._variants_version is not None and now - self._version_checked_at < self.version_check_interval:
+            return
+        
+        self._version_checked_at = now
+        version = self.db.fetchone('SELECT version FROM prompt_variants_version WHERE id = 1')[0]
+        if not force and version == self._variants_version:
+            return
+        
+        templates: Dict[str, CompiledTemplate] = {}
+        active_variants: Dict[str, List[str]] = {}
+        for variant_id, variant_type, template, active in self.db.fetchall(
+            'SELECT id, type, template, active FROM prompt_variants ORDER BY id'
+        ):
+            compiled = self._compile_variant(variant_id, variant_type, template)
+            if compiled is None:
+                continue
+            
+            templates[variant_id] = compiled
+            if active:
+                active_variants.setdefault(variant_type, []).append(variant_id)
+        
+        self._templates = templates
+        self._active_variants = active_variants
+        self._variants_version = version
+
+    def _compile_variant(self, variant_id: str, variant_type: str, template: str) -> Optional[CompiledTemplate]:
+        """Скомпилировать шаблон варианта и проверить его поля заранее"""
+        try:
+            compiled = compile_template(template)
+        except TemplateError as e:
+            logger.error(f"Prompt variant {variant_id} is invalid: {e}")
+            return None
+        
+        available = PROMPT_FIELDS.get(PromptType(variant_type), frozenset())
+        unknown = compiled.missing_fields(available)
+        if unknown:
+            logger.error(f"Prompt variant {variant_id} uses unknown fields: {', '.join(sorted(unknown))}")
+            return None
         
-        conn.commit()
-        conn.close()
+        return compiled
+
+    def invalidate_cache(self):
+        """Сбросить кэш вариантов (после изменения prompt_variants)"""
+        self._refresh_variants(force=True)
+
+    def warm_up(self):
+        """Прочитать и скомпилировать варианты промптов до первого запроса"""
+        self._refresh_variants()
+
+    def add_variant(self, variant: PromptVariant):
+        """Добавить или обновить вариант промпта"""
+        self.db.execute('''
+            INSERT OR REPLACE INTO prompt_variants 
+            (id, type, name, template, description, active)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (variant.id, variant.type.value, variant.name, variant.template, variant.description, variant.active))
+        self.invalidate_cache()
+
+    def set_variant_active(self, variant_id: str, active: bool):
+        """Включить или выключить вариант промпта"""
+        self.db.execute('UPDATE prompt_variants SET active = ? WHERE id = ?', (active, variant_id))
+        self.invalidate_cache()
+
+    def _remember_assignment(self, key: Tuple[int, PromptType], variant_id: str):
+        """Запомнить назначение в LRU-кэше"""
+        self._assignments[key] = variant_id
+        self._assignments.move_to_end(key)
+        if len(self._assignments) > self.assignment_cache_size:
+            self._assignments.popitem(last=False)
 
     def get_prompt_for_user(self, user_id: int, prompt_type: PromptType) -> Tuple[str, str]:
         """Получить промпт для пользователя (с учетом A/B тестирования)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        template, variant_id = self.get_compiled_prompt_for_user(user_id, prompt_type)
+        return (template.source if template else ""), variant_id
+
+    def get_compiled_prompt_for_user(
+        self,
+        user_id: int,
+        prompt_type: PromptType
+    ) -> Tuple[Optional[CompiledTemplate], str]:
+        """Получить скомпилированный шаблон промпта для пользователя"""
+        self._refresh_variants()
         
-        # Проверяем, есть ли уже назначенный вариант для этого пользователя
-        cursor.execute('''
-            SELECT variant_id FROM user_variant_assignments 
-            WHERE user_id = ? AND prompt_type = ?
-        ''', (user_id, prompt_type.value))
-        
-        result = cursor.fetchone()
+        key = (user_id, prompt_type)
+        variant_id = self._assignments.get(key)
         
-        if result:
-            variant_id = result[0]
+        if variant_id is not None:
+            self._assignments.move_to_end(key)
         else:
-            # Назначаем случайный активный вариант
-            cursor.execute('''
-                SELECT id FROM prompt_variants 
-                WHERE type = ? AND active = TRUE
-            ''', (prompt_type.value,))
-            
-            variants = cursor.fetchall()
-            if not variants:
-                conn.close()
-                return "", "default"
-            
-            variant_id = random.choice(variants)[0]
+            # Проверяем, есть ли уже назначенный вариант для этого пользователя
+            result = self.db.fetchone('''
+                SELECT variant_id FROM user_variant_assignments 
+                WHERE user_id = ? AND prompt_type = ?
+            ''', (user_id, prompt_type.value))
             
-            # Сохраняем назначение
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_variant_assignments 
-                (user_id, prompt_type, variant_id)
-                VALUES (?, ?, ?)
-            ''', (user_id, prompt_type.value, variant_id))
+            if result:
+                variant_id = result[0]
+            else:
+                # Назначаем случайный активный вариант
+                variants = self._active_variants.get(prompt_type.value)
+                if not variants:
+                    return None, "default"
+                
+                variant_id = random.choice(variants)
+                
+                # Сохраняем назначение
+                self.db.execute('''
+                    INSERT OR REPLACE INTO user_variant_assignments 
+                    (user_id, prompt_type, variant_id)
+                    VALUES (?, ?, ?)
+                ''', (user_id, prompt_type.value, variant_id))
             
-            conn.commit()
+            self._remember_assignment(key, variant_id)
         
-        # Получаем шаблон промпта
-        cursor.execute('''
-            SELECT template FROM prompt_variants WHERE id = ?
-        ''', (variant_id,))
-        
-        template_result = cursor.fetchone()
-        template = template_result[0] if template_result else ""
-        
-        conn.close()
-        return template, variant_id
+        # Шаблон промпта из кэша
+        return self._templates.get(variant_id), variant_id
 
     def record_test_result(
         self, 
@@ -320,65 +709,119 @@ class PromptABTesting:
         user_engagement: Optional[float] = None,
         conversion: bool = False
     ):
-        """Записать результат A/B теста"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO ab_test_results 
-            (user_id, prompt_variant_id, prompt_type, user_feedback, 
-             response_quality, user_engagement, conversion)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id, prompt_variant_id, prompt_type.value,
-            user_feedback, response_quality, user_engagement, conversion
+        """Записать результат A/B теста (запись в базу выполняется пакетами в фоне)"""
+        self.result_writer.add(TestResult(
+            user_id=user_id,
+            prompt_variant_id=prompt_variant_id,
+            prompt_type=prompt_type,
+            user_feedback=user_feedback,
+            response_quality=response_quality,
+            user_engagement=user_engagement,
+            conversion=conversion,
+            timestamp=datetime.now(timezone.utc)
         ))
-        
-        conn.commit()
-        conn.close()
+
+    def reset_test_data(self, cursor=None):
+        """Удалить назначения пользователей и результаты тестов
+
+        cursor - транзакция вызывающего кода, в которой выполнить удаление; очередь
+        записи результатов тогда нужно сбросить заранее (flush_results)
+        """
+        if cursor is None:
+            self.flush_results()
+            with self.db.transaction() as cursor:
+                self._delete_test_data(cursor)
+        else:
+            self._delete_test_data(cursor)
+        self.clear_assignments()
+    
+    def clear_assignments(self):
+        """Сбросить кэш назначений пользователей (в базе они остаются)"""
+        self._assignments.clear()
+    
+    @staticmethod
+    def _delete_test_data(cursor):
+        cursor.execute('DELETE FROM user_variant_assignments')
+        cursor.execute('DELETE FROM ab_test_results')
+        cursor.execute('DELETE FROM ab_variant_aggregates')
+
+    def _rebuild_aggregates(self, cursor):
+        """Пересчитать агрегаты по всем результатам"""
+        sums = ', '.join(
+            f'COUNT({source}), COALESCE(SUM({source}), 0), COALESCE(SUM({source} * {source}), 0)'
+            for source in ('user_feedback', 'response_quality', 'user_engagement')
+        )
+        cursor.execute('DELETE FROM ab_variant_aggregates')
+        cursor.execute(f'''
+            INSERT INTO ab_variant_aggregates
+            (prompt_variant_id, prompt_type, uses, conversions, {', '.join(_aggregate_columns())})
+            SELECT prompt_variant_id, prompt_type, COUNT(*),
+                   SUM(CASE WHEN conversion = 1 THEN 1 ELSE 0 END), {sums}
+            FROM ab_test_results
+            GROUP BY prompt_variant_id, prompt_type
+        ''')
+
+    def rebuild_aggregates(self):
+        """Пересчитать агрегаты заново из ab_test_results (после ручных правок результатов)"""
+        self.flush_results()
+        with self.db.transaction() as cursor:
+            self._rebuild_aggregates(cursor)
+
+    def flush_results(self) -> int:
+        """Немедленно записать накопленные результаты тестов"""
+        return self.result_writer.flush()
+
+    def close(self):
+        """Дописать результаты и остановить фоновую запись"""
+        self.result_writer.close()
 
     def get_test_statistics(self, prompt_type: Optional[PromptType] = None) -> Dict:
         """Получить статистику A/B тестов"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self.flush_results()
         
-        # Базовый запрос
-        base_query = '''
+        # Агрегаты по вариантам: строк столько, сколько вариантов, независимо от истории
+        base_query = f'''
             SELECT 
-                r.prompt_variant_id,
+                a.prompt_variant_id,
                 p.name,
-                COUNT(*) as total_uses,
-                AVG(r.user_feedback) as avg_feedback,
-                AVG(r.response_quality) as avg_quality,
-                AVG(r.user_engagement) as avg_engagement,
-                SUM(CASE WHEN r.conversion = 1 THEN 1 ELSE 0 END) as conversions,
-                CAST(SUM(CASE WHEN r.conversion = 1 THEN 1 ELSE 0 END) AS FLOAT) / COUNT(*) as conversion_rate
-            FROM ab_test_results r
-            JOIN prompt_variants p ON r.prompt_variant_id = p.id
+                SUM(a.uses),
+                SUM(a.conversions),
+                {', '.join(f'SUM(a.{column})' for column in _aggregate_columns())}
+            FROM ab_variant_aggregates a
+            JOIN prompt_variants p ON a.prompt_variant_id = p.id
         '''
         
         if prompt_type:
-            cursor.execute(base_query + ' WHERE r.prompt_type = ? GROUP BY r.prompt_variant_id', 
-                         (prompt_type.value,))
+            results = self.db.fetchall(base_query + ' WHERE a.prompt_type = ? GROUP BY a.prompt_variant_id', 
+                                       (prompt_type.value,))
         else:
-            cursor.execute(base_query + ' GROUP BY r.prompt_variant_id')
-        
-        results = cursor.fetchall()
+            results = self.db.fetchall(base_query + ' GROUP BY a.prompt_variant_id')
         
         statistics = {}
         for row in results:
-            variant_id = row[0]
+            variant_id, name, total_uses, conversions = row[:4]
+            if not total_uses:
+                continue
+            
+            # Среднее и стандартное отклонение по непустым значениям (как AVG в SQL)
+            moments = {}
+            for position, metric in enumerate(AGGREGATED_METRICS):
+                count, total, total_sq = row[4 + position * 3:7 + position * 3]
+                mean = total / count if count else 0
+                variance = total_sq / count - mean * mean if count else 0
+                moments[metric] = (mean, max(variance, 0) ** 0.5)
+            
             statistics[variant_id] = {
-                'name': row[1],
-                'total_uses': row[2],
-                'avg_feedback': row[3] or 0,
-                'avg_quality': row[4] or 0,
-                'avg_engagement': row[5] or 0,
-                'conversions': row[6],
-                'conversion_rate': row[7] or 0
+                'name': name,
+                'total_uses': total_uses,
+                'avg_feedback': moments['feedback'][0],
+                'avg_quality': moments['quality'][0],
+                'quality_stddev': moments['quality'][1],
+                'avg_engagement': moments['engagement'][0],
+                'conversions': conversions,
+                'conversion_rate': conversions / total_uses
             }
         
-        conn.close()
         return statistics
 
     def get_winning_variant(self, prompt_type: PromptType) -> Optional[str]:
@@ -444,9 +887,14 @@ class PromptABTesting:
             logger.error(f"Error evaluating response quality: {e}")
             return 0.5
 
-def get_ab_testing_manager(db_path: str = 'psychoanalyst.db') -> PromptABTesting:
+def get_ab_testing_manager(
+    db_path: str = DEFAULT_DB_PATH,
+    batch_size: int = 100,
+    flush_interval: float = 0.5,
+    max_pending: int = 10000
+) -> PromptABTesting:
     """Фабричная функция для получения менеджера A/B тестирования"""
-    return PromptABTesting(db_path)
+    return PromptABTesting(db_path, batch_size, flush_interval, max_pending=max_pending)
 
 # Пример использования
 if __name__ == "__main__":
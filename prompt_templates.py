@@ -0,0 +1,92 @@
+"""
+Модуль компилируемых шаблонов промптов
+Шаблон разбирается один раз на статические сегменты и поля подстановки,
+при рендеринге остается только заполнить поля и проверить, что все они переданы
+"""
+
+import string
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+class TemplateError(ValueError):
+    """Ошибка в шаблоне промпта"""
+
+class MissingTemplateFieldsError(TemplateError):
+    """Для рендеринга не переданы обязательные поля"""
+
+    def __init__(self, missing: Iterable[str]):
+        self.missing = sorted(missing)
+        super().__init__(f"Не заполнены поля шаблона: {', '.join(self.missing)}")
+
+class CompiledTemplate:
+    """Шаблон, разобранный на статические сегменты и поля"""
+
+    __slots__ = ('source', 'fields', '_segments')
+
+    def __init__(self, source: str):
+        self.source = source
+        # (текст перед полем, имя поля или None, преобразование, формат)
+        self._segments: List[Tuple[str, Optional[str], Optional[str], str]] = []
+
+        fields = set()
+        literal_buffer = ""
+        try:
+            parsed = list(string.Formatter().parse(source))
+        except ValueError as e:
+            raise TemplateError(f"Некорректный шаблон: {e}") from e
+
+        for literal, field_name, format_spec, conversion in parsed:
+            literal_buffer += literal
+            if field_name is None:
+                continue
+            if not field_name.isidentifier():
+                raise TemplateError(f"Поддерживаются только простые имена полей: {{{field_name}}}")
+            if format_spec and '{' in format_spec:
+                raise TemplateError(f"Вложенные поля не поддерживаются: {{{field_name}:{format_spec}}}")
+
+            self._segments.append((literal_buffer, field_name, conversion, format_spec or ""))
+            literal_buffer = ""
+            fields.add(field_name)
+
+        if literal_buffer:
+            self._segments.append((literal_buffer, None, None, ""))
+
+        self.fields = frozenset(fields)
+
+    def missing_fields(self, available: Iterable[str]) -> frozenset:
+        """Поля шаблона, которые не входят в доступный набор"""
+        return self.fields.difference(available)
+
+    def render(self, **values) -> str:
+        """Подставить значения; лишние значения игнорируются"""
+        missing = self.fields.difference(values)
+        if missing:
+            raise MissingTemplateFieldsError(missing)
+
+        parts = []
+        for literal, field_name, conversion, format_spec in self._segments:
+            parts.append(literal)
+            if field_name is None:
+                continue
+
+            value = values[field_name]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            elif conversion == 's':
+                value = str(value)
+
+            if format_spec or not isinstance(value, str):
+                value = format(value, format_spec)
+            parts.append(value)
+
+        return "".join(parts)
+
+    def __repr__(self) -> str:
+        return f"CompiledTemplate(fields={sorted(self.fields)})"
+
+@lru_cache(maxsize=256)
+def compile_template(source: str) -> CompiledTemplate:
+    """Скомпилировать шаблон (результат кэшируется по тексту шаблона)"""
+    return CompiledTemplate(source)
@@ -0,0 +1,266 @@
+"""
+Модуль семантического кэша ответов ИИ
+Похожие первые сообщения ("мне грустно", "мне очень грустно") получают готовый ответ
+без обращения к GPT-4. Поиск ближайшего соседа по локальным векторам символьных n-грамм.
+scikit-learn и сохраненные записи загружаются при первом обращении или в warm_up()
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from scipy import sparse
+    from sklearn.feature_extraction.text import HashingVectorizer
+
+logger = logging.getLogger(__name__)
+
+# Слова-отрицания: "мне грустно" и "мне не грустно" не должны считаться одним вопросом
+NEGATION_WORDS = frozenset({'не', 'нет', 'ни', 'никогда', 'ничего', 'никто'})
+
+@dataclass
+class CacheEntry:
+    """Запись кэша"""
+    message: str  # нормализованное сообщение
+    variant_id: str
+    response: str
+    created_at: float
+    vector: 'sparse.csr_matrix'
+
+class SemanticResponseCache:
+    """LRU/TTL кэш ответов с поиском по косинусной близости"""
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl: float = 7 * 24 * 3600,
+        threshold: float = 0.8,
+        persist_path: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.persist_path = persist_path
+
+        self._vectorizer: Optional['HashingVectorizer'] = None
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self._index: Dict[str, Tuple[List[Tuple[str, str]], 'sparse.csr_matrix']] = {}
+        self._lock = threading.Lock()
+        # Сохраненные записи читаются при первом обращении (или в warm_up)
+        self._load_lock = threading.Lock()
+        self._loaded = not persist_path
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def vectorizer(self) -> 'HashingVectorizer':
+        """Векторизация без обучения: хэширование символьных n-грамм внутри слов"""
+        if self._vectorizer is None:
+            with self._load_lock:
+                if self._vectorizer is None:
+                    from sklearn.feature_extraction.text import HashingVectorizer
+                    self._vectorizer = HashingVectorizer(
+                        analyzer='char_wb',
+                        ngram_range=(2, 4),
+                        n_features=2 ** 18,
+                        alternate_sign=False,
+                        norm='l2',
+                    )
+        return self._vectorizer
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            # До загрузки: load() добавляет записи через put()
+            self._loaded = True
+        self.load()
+
+    def warm_up(self) -> None:
+        """Загрузить scikit-learn и сохраненные записи заранее"""
+        self.vectorizer
+        self._ensure_loaded()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Нормализация сообщения: регистр, ё, пунктуация, пробелы"""
+        text = text.lower().replace('ё', 'е')
+        text = re.sub(r'[^\w\s]', ' ', text)
+        return ' '.join(text.split())
+
+    @staticmethod
+    def _negations(message: str) -> frozenset:
+        return NEGATION_WORDS.intersection(message.split())
+
+    def _vectorize(self, message: str) -> 'sparse.csr_matrix':
+        return self.vectorizer.transform([message]).tocsr()
+
+    def get(self, message: str, variant_id: str) -> Optional[str]:
+        """Найти сохраненный ответ на похожее сообщение"""
+        normalized = self.normalize(message)
+        if not normalized:
+            return None
+
+        self._ensure_loaded()
+        with self._lock:
+            self._expire(time.time())
+
+            key = (variant_id, normalized)
+            entry = self._entries.get(key)
+
+            if entry is None:
+                entry = self._nearest(normalized, variant_id)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end((entry.variant_id, entry.message))
+            self.hits += 1
+            return entry.response
+
+    def _nearest(self, normalized: str, variant_id: str) -> Optional[CacheEntry]:
+        """Ближайший сосед среди записей того же варианта промпта"""
+        import numpy as np
+
+        index = self._get_index(variant_id)
+        if index is None:
+            return None
+
+        keys, matrix = index
+        vector = self._vectorize(normalized)
+        similarities = np.asarray((matrix @ vector.T).todense()).ravel()
+
+        negations = self._negations(normalized)
+        for position in np.argsort(-similarities):
+            if similarities[position] < self.threshold:
+                break
+            entry = self._entries[keys[position]]
+            if self._negations(entry.message) == negations:
+                return entry
+
+        return None
+
+    def _get_index(self, variant_id: str) -> Optional[Tuple[List[Tuple[str, str]], 'sparse.csr_matrix']]:
+        """Матрица векторов для варианта промпта (перестраивается после изменений)"""
+        from scipy import sparse
+
+        if variant_id not in self._index:
+            keys = [key for key in self._entries if key[0] == variant_id]
+            if not keys:
+                return None
+            matrix = sparse.vstack([self._entries[key].vector for key in keys]).tocsr()
+            self._index[variant_id] = (keys, matrix)
+
+        return self._index[variant_id]
+
+    def put(self, message: str, variant_id: str, response: str, created_at: Optional[float] = None) -> None:
+        """Сохранить ответ в кэш"""
+        normalized = self.normalize(message)
+        if not normalized or not response:
+            return
+
+        self._ensure_loaded()
+        vector = self._vectorize(normalized)
+        with self._lock:
+            key = (variant_id, normalized)
+            self._entries[key] = CacheEntry(
+                message=normalized,
+                variant_id=variant_id,
+                response=response,
+                created_at=created_at or time.time(),
+                vector=vector,
+            )
+            self._entries.move_to_end(key)
+            self._index.pop(variant_id, None)
+
+            while len(self._entries) > self.max_entries:
+                (evicted_variant, _), _ = self._entries.popitem(last=False)
+                self._index.pop(evicted_variant, None)
+                self.evictions += 1
+
+    def _expire(self, now: float) -> None:
+        """Удалить записи старше TTL"""
+        expired = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl]
+        for key in expired:
+            del self._entries[key]
+            self._index.pop(key[0], None)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Очистить кэш"""
+        # Сохраненные записи тоже считаются удаленными
+        self._loaded = True
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def save(self) -> None:
+        """Сохранить кэш на диск (если задан путь)"""
+        if not self.persist_path or not self._loaded:
+            # Незагруженный кэш не менялся - файл на диске актуален
+            return
+
+        with self._lock:
+            data = [
+                {
+                    'message': entry.message,
+                    'variant_id': entry.variant_id,
+                    'response': entry.response,
+                    'created_at': entry.created_at,
+                }
+                for entry in self._entries.values()
+            ]
+
+        temp_path = self.persist_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, self.persist_path)
+        logger.info(f"Response cache saved: {len(data)} entries")
+
+    def load(self) -> None:
+        """Загрузить кэш с диска"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+
+        try:
+            with open(self.persist_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading response cache: {e}")
+            return
+
+        for item in data:
+            self.put(item['message'], item['variant_id'], item['response'], item['created_at'])
+        logger.info(f"Response cache loaded: {len(self._entries)} entries")
+
+    def get_stats(self) -> Dict:
+        """Статистика кэша"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+def get_response_cache(
+    max_entries: int = 1000,
+    ttl: float = 7 * 24 * 3600,
+    threshold: float = 0.8,
+    persist_path: Optional[str] = None,
+) -> SemanticResponseCache:
+    """Фабричная функция для получения кэша ответов"""
+    return SemanticResponseCache(max_entries, ttl, threshold, persist_path)
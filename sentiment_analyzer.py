@@ -1,32 +1,327 @@
 """
 Модуль для анализа эмоций и настроений пользователей
-Использует VADER Sentiment и TextBlob для русского языка
+Использует VADER Sentiment и словари русского языка. VADER и NumPy/SciPy
+(только для пакетного анализа) загружаются при первом использовании или в warm_up()
 """
 
 import re
+import time
+import hashlib
 import logging
-from typing import Dict, List, Tuple
-from dataclasses import dataclass
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
-from textblob import TextBlob
-import numpy as np
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from dataclasses import dataclass, field
+
+if TYPE_CHECKING:
+    import numpy as np
+    from scipy import sparse
+    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+# Токены - последовательности букв/цифр; "ё" приводится к "е"
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Категории словарей в порядке столбцов индекса
+LEXICON_CATEGORIES = (
+    'positive', 'negative',
+    'stress', 'depression', 'anxiety', 'support',
+    'joy', 'sadness', 'anger', 'fear',
+)
+
+# Окончания (длинные первыми): у слов словаря отбрасываются, а токен совпадает
+# со словом, если после основы идет одно из них ("стресс" - "стрессом", но не
+# "боль" - "больше")
+INFLECTION_ENDINGS = (
+    'иями', 'ями', 'ами', 'иям', 'иях', 'ией', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ия', 'ие', 'ий', 'ию', 'ии', 'ья', 'ье', 'ью', 'ей', 'ой', 'ый', 'ая', 'яя', 'ое', 'ее', 'ые',
+    'ую', 'юю', 'ою', 'ею', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев',
+    'а', 'я', 'о', 'е', 'и', 'ы', 'у', 'ю', 'ь', 'й',
+)
+_ENDINGS = frozenset(INFLECTION_ENDINGS)
+# Более короткие основы ("не") должны совпасть с токеном целиком
+MIN_STEM_LENGTH = 4
+
+# Словоформы, которые должны распознаваться (проверка: python sentiment_analyzer.py)
+INFLECTION_CHECKS = (
+    ("Я не справляюсь со стрессом на работе", ('stress_level', 'need_support')),
+    ("Я испытываю страхи и боли каждый день", ('anxiety_level', 'fear')),
+    ("У меня признаки депрессии, тревоги и апатии", ('depression_risk', 'anxiety_level')),
+    ("Постоянное напряжение и нервы, меня мучают сомнения", ('stress_level', 'anxiety_level')),
+    ("Чувствую тоску и печаль, нет сил", ('depression_risk', 'sadness')),
+    ("Я в ярости от постоянного раздражения", ('anger',)),
+    ("Мне нужна ваша помощь и поддержка", ('need_support',)),
+    ("Паника и беспокойство не отпускают", ('stress_level', 'anxiety_level', 'fear')),
+)
+
+# Однокоренные по написанию, но другие слова - попаданий быть не должно
+FALSE_HIT_CHECKS = (
+    "Я получил большую премию",
+    "Я хочу больше денег",
+    "У меня большой дом",
+    "Принес справку из больницы",
+    "Оформил страховку на машину",
+)
+
+EMOTION_NAMES = ('joy', 'sadness', 'anger', 'fear', 'surprise', 'disgust')
+INDICATOR_NAMES = ('stress_level', 'depression_risk', 'anxiety_level', 'emotional_stability', 'need_support')
+
+@dataclass(frozen=True)
 class SentimentResult:
-    """Результат анализа настроения"""
+    """Результат анализа настроения (неизменяемый, безопасно разделяется через кэш)"""
     overall_sentiment: str  # positive, negative, neutral
     confidence: float  # 0.0 - 1.0
-    emotions: Dict[str, float]  # specific emotions with scores
-    psychological_indicators: Dict[str, float]  # stress, anxiety, etc.
+    emotions: Mapping[str, float]  # specific emotions with scores
+    psychological_indicators: Mapping[str, float]  # stress, anxiety, etc.
     recommendation: str  # how to respond
+    token_hits: Mapping[str, int] = field(default_factory=dict)  # попадания по словам словаря
+
+    def __post_init__(self):
+        for name in ('emotions', 'psychological_indicators', 'token_hits'):
+            value = getattr(self, name)
+            if not isinstance(value, MappingProxyType):
+                object.__setattr__(self, name, MappingProxyType(dict(value)))
+
+def lexicon_stem(word: str) -> str:
+    """Основа слова словаря: без окончания, если остается хотя бы MIN_STEM_LENGTH букв"""
+    for ending in INFLECTION_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+def is_inflection(token: str, stem_length: int) -> bool:
+    """После основы в токене нет ничего, кроме окончания"""
+    return stem_length == len(token) or token[stem_length:] in _ENDINGS
+
+def stem_matches(token: str, stem: str) -> bool:
+    """Токен - словоформа основы (короткие основы - только точное совпадение)"""
+    if len(stem) < MIN_STEM_LENGTH:
+        return token == stem
+    return token.startswith(stem) and is_inflection(token, len(stem))
+
+class StemTrie:
+    """Префиксное дерево основ: за один проход по токену находит все основы,
+    словоформой которых он является"""
+
+    __slots__ = ('_root',)
+
+    _PREFIX = ''  # ключи узла - буквы, пустая строка с ними не пересекается
+    _EXACT = '$$'
+
+    def __init__(self):
+        self._root: Dict[str, Dict] = {}
+
+    def add(self, stem: str, value: int) -> None:
+        node = self._root
+        for char in stem:
+            node = node.setdefault(char, {})
+        key = self._EXACT if len(stem) < MIN_STEM_LENGTH else self._PREFIX
+        node.setdefault(key, []).append(value)
+
+    def match(self, token: str) -> List[int]:
+        """Значения всех основ, подходящих к токену"""
+        found: List[int] = []
+        node = self._root
+        for depth, char in enumerate(token, 1):
+            node = node.get(char)
+            if node is None:
+                return found
+            values = node.get(self._PREFIX)
+            if values and is_inflection(token, depth):
+                found.extend(values)
+        found.extend(node.get(self._EXACT, ()))
+        return found
+
+# Показатели, по которым отслеживается динамика разговора
+TREND_INDICATORS = ('stress_level', 'anxiety_level', 'depression_risk', 'need_support')
+TREND_LABELS = {
+    'stress_level': 'стресс',
+    'anxiety_level': 'тревога',
+    'depression_risk': 'риск депрессии',
+    'need_support': 'потребность в поддержке',
+}
+
+class EmotionalTrend:
+    """Накопитель эмоционального состояния пользователя (экспоненциальное скользящее среднее)
+
+    Обновление - O(1) на сообщение, история разговора повторно не анализируется.
+    """
+
+    __slots__ = ('alpha', 'levels', 'deltas', 'messages')
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.levels = [0.0] * len(TREND_INDICATORS)
+        self.deltas = [0.0] * len(TREND_INDICATORS)
+        self.messages = 0
+
+    def update(self, result: SentimentResult) -> None:
+        """Учесть результат анализа очередного сообщения"""
+        indicators = result.psychological_indicators
+        if not indicators:
+            return
+
+        for position, name in enumerate(TREND_INDICATORS):
+            value = indicators.get(name, 0.0)
+            previous = self.levels[position]
+            # Первое сообщение задает начальный уровень
+            current = value if self.messages == 0 else previous + self.alpha * (value - previous)
+            self.levels[position] = current
+            self.deltas[position] = current - previous if self.messages else 0.0
+        self.messages += 1
+
+    def as_dict(self) -> Dict[str, float]:
+        return dict(zip(TREND_INDICATORS, self.levels))
+
+    def to_dict(self) -> Dict:
+        """Состояние для сохранения"""
+        return {'alpha': self.alpha, 'levels': self.levels, 'deltas': self.deltas, 'messages': self.messages}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'EmotionalTrend':
+        """Восстановить сохраненное состояние"""
+        trend = cls(data.get('alpha', 0.3))
+        trend.levels = [float(value) for value in data['levels']]
+        trend.deltas = [float(value) for value in data['deltas']]
+        trend.messages = int(data['messages'])
+        return trend
+
+    def describe(self, threshold: float = 0.05) -> str:
+        """Текстовое описание динамики для промпта"""
+        if self.messages == 0:
+            return "Данных об эмоциональном состоянии пока нет."
+
+        parts = []
+        for name, level, delta in zip(TREND_INDICATORS, self.levels, self.deltas):
+            if delta > threshold:
+                direction = "растет"
+            elif delta < -threshold:
+                direction = "снижается"
+            else:
+                direction = "стабильно"
+            parts.append(f"{TREND_LABELS[name]}={level:.2f} ({direction})")
+
+        return f"По {self.messages} сообщениям: " + ", ".join(parts)
+
+class SentimentCache:
+    """Потокобезопасный LRU/TTL кэш результатов анализа по хэшу нормализованного текста"""
+
+    def __init__(self, max_entries: int = 2048, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries: "OrderedDict[bytes, Tuple[float, SentimentResult]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        """Ключ кэша: хэш текста без учета регистра, "ё" и лишних пробелов"""
+        normalized = ' '.join(text.lower().replace('ё', 'е').split())
+        return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[SentimentResult]:
+        """Найти результат; просроченная запись удаляется"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, result = entry
+                if time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self._entries[key]
+                self.evictions += 1
+
+            self.misses += 1
+            return None
+
+    def put(self, key: bytes, result: SentimentResult) -> None:
+        """Сохранить результат"""
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Очистить кэш"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict:
+        """Статистика кэша"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+@dataclass
+class SentimentBatch:
+    """Результаты пакетного анализа в колоночном виде (по строке на текст)"""
+    overall_sentiment: 'np.ndarray'  # строки positive/negative/neutral
+    confidence: 'np.ndarray'
+    emotions: Dict[str, 'np.ndarray']
+    psychological_indicators: Dict[str, 'np.ndarray']
+    recommendation: 'np.ndarray'
+    term_counts: 'sparse.csr_matrix'  # документ x словарный термин
+    terms: Tuple[str, ...]
+    empty: 'np.ndarray'  # пустые тексты (для них результат как в analyze_text)
+
+    def __len__(self) -> int:
+        return len(self.confidence)
+
+    def to_results(self) -> List[SentimentResult]:
+        """Преобразовать в список SentimentResult"""
+        results = []
+        indptr, indices, data = self.term_counts.indptr, self.term_counts.indices, self.term_counts.data
+        for row in range(len(self)):
+            if self.empty[row]:
+                results.append(SentimentResult(
+                    overall_sentiment='neutral',
+                    confidence=0.0,
+                    emotions={},
+                    psychological_indicators={},
+                    recommendation='neutral'
+                ))
+                continue
+            
+            start, end = indptr[row], indptr[row + 1]
+            results.append(SentimentResult(
+                overall_sentiment=str(self.overall_sentiment[row]),
+                confidence=float(self.confidence[row]),
+                emotions={name: float(values[row]) for name, values in self.emotions.items()},
+                psychological_indicators={
+                    name: float(values[row]) for name, values in self.psychological_indicators.items()
+                },
+                recommendation=str(self.recommendation[row]),
+                token_hits={self.terms[j]: int(count) for j, count in zip(indices[start:end], data[start:end])}
+            ))
+        return results
 
 class RussianSentimentAnalyzer:
     """Анализатор настроений для русского языка"""
     
-    def __init__(self):
-        self.vader = SentimentIntensityAnalyzer()
+    def __init__(self, cache_size: int = 2048, cache_ttl: float = 3600.0):
+        self._vader: Optional['SentimentIntensityAnalyzer'] = None
+        self._lexicon_matrix: Optional['sparse.csr_matrix'] = None
+        self._load_lock = threading.Lock()
+        self.cache = SentimentCache(cache_size, cache_ttl)
         
         # Словари для русского языка
         self.positive_words = {
@@ -55,9 +350,128 @@ class RussianSentimentAnalyzer:
             'тревога', 'беспокойство', 'волнение', 'страх', 'паника',
             'нервозность', 'неуверенность', 'сомнения', 'опасения'
         }
+        
+        self.support_words = {'помощь', 'поддержка', 'помоги', 'трудно', 'сложно', 'не справляюсь'}
+        
+        # Словари эмоций
+        self.joy_words = {'радость', 'счастье', 'веселье', 'восторг', 'эйфория', 'блаженство'}
+        self.sadness_words = {'грусть', 'печаль', 'тоска', 'уныние', 'меланхолия'}
+        self.anger_words = {'злость', 'гнев', 'ярость', 'бешенство', 'раздражение'}
+        self.fear_words = {'страх', 'ужас', 'паника', 'боязнь', 'фобия'}
+        
+        self._build_index()
+
+    def _build_index(self):
+        """Построить индекс основ слов словарей (один раз при создании)"""
+        lexicons = {
+            'positive': self.positive_words,
+            'negative': self.negative_words,
+            'stress': self.stress_indicators,
+            'depression': self.depression_indicators,
+            'anxiety': self.anxiety_indicators,
+            'support': self.support_words,
+            'joy': self.joy_words,
+            'sadness': self.sadness_words,
+            'anger': self.anger_words,
+            'fear': self.fear_words,
+        }
+        
+        # Термин - слово или фраза словаря ("не справляюсь") -> столбцы категорий
+        columns: Dict[str, List[int]] = {}
+        for column, category in enumerate(LEXICON_CATEGORIES):
+            for phrase in lexicons[category]:
+                tokens = self._tokenize(phrase)
+                if tokens:
+                    columns.setdefault(' '.join(tokens), []).append(column)
+        
+        self._terms: Tuple[str, ...] = tuple(columns)
+        self._term_columns = tuple(tuple(columns[term]) for term in self._terms)
+        # Основы слов термина; в дерево попадает основа первого слова
+        self._term_stems = tuple(tuple(lexicon_stem(token) for token in term.split()) for term in self._terms)
+        self._stems = StemTrie()
+        for term_id, stems in enumerate(self._term_stems):
+            self._stems.add(stems[0], term_id)
+
+    @property
+    def vader(self) -> 'SentimentIntensityAnalyzer':
+        """VADER (словарь загружается при первом обращении)"""
+        if self._vader is None:
+            with self._load_lock:
+                if self._vader is None:
+                    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+                    self._vader = SentimentIntensityAnalyzer()
+        return self._vader
+
+    def _get_lexicon_matrix(self) -> 'sparse.csr_matrix':
+        """Матрица термин x категория для пакетного анализа (строится при первом вызове)"""
+        if self._lexicon_matrix is None:
+            import numpy as np
+            from scipy import sparse
+            
+            rows, cols = [], []
+            for term_id, columns in enumerate(self._term_columns):
+                rows.extend([term_id] * len(columns))
+                cols.extend(columns)
+            self._lexicon_matrix = sparse.csr_matrix(
+                (np.ones(len(rows), dtype=np.float64), (rows, cols)),
+                shape=(len(self._terms), len(LEXICON_CATEGORIES))
+            )
+        return self._lexicon_matrix
+
+    def warm_up(self, batch: bool = False) -> None:
+        """Загрузить отложенные зависимости заранее (batch=True - и для analyze_batch)"""
+        self.vader
+        if batch:
+            self._get_lexicon_matrix()
+
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        """Разбить текст на нормализованные токены"""
+        return TOKEN_PATTERN.findall(text.lower().replace('ё', 'е'))
+
+    def _match_terms(self, tokens: List[str]) -> List[int]:
+        """Термины словарей, найденные в тексте (по одному на вхождение)"""
+        found = []
+        term_stems = self._term_stems
+        for position, token in enumerate(tokens):
+            for term_id in self._stems.match(token):
+                stems = term_stems[term_id]
+                # Остальные слова фразы должны идти следом
+                if len(stems) > 1 and not (
+                    position + len(stems) <= len(tokens)
+                    and all(stem_matches(tokens[position + offset], stem) for offset, stem in enumerate(stems[1:], 1))
+                ):
+                    continue
+                found.append(term_id)
+        return found
+
+    def _score_tokens(self, tokens: List[str]) -> Tuple[List[int], Dict[str, int]]:
+        """Подсчитать попадания токенов в словари за один проход"""
+        counts = [0] * len(LEXICON_CATEGORIES)
+        token_hits: Dict[str, int] = {}
+        
+        for term_id in self._match_terms(tokens):
+            for column in self._term_columns[term_id]:
+                counts[column] += 1
+            term = self._terms[term_id]
+            token_hits[term] = token_hits.get(term, 0) + 1
+        
+        return counts, token_hits
 
     def analyze_text(self, text: str) -> SentimentResult:
-        """Основной метод анализа текста"""
+        """Основной метод анализа текста (повторные тексты берутся из кэша)"""
+        if not text or not text.strip():
+            return self._analyze_text(text)
+        
+        key = self.cache.key(text)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._analyze_text(text)
+            self.cache.put(key, result)
+        return result
+
+    def _analyze_text(self, text: str) -> SentimentResult:
+        """Анализ текста без кэша"""
         if not text or not text.strip():
             return SentimentResult(
                 overall_sentiment='neutral',
@@ -69,14 +483,19 @@ class RussianSentimentAnalyzer:
         
         text_lower = text.lower()
         
+        # Токенизация и подсчет попаданий в словари - один раз на текст
+        tokens = self._tokenize(text_lower)
+        counts, token_hits = self._score_tokens(tokens)
+        total_words = len(tokens)
+        
         # Базовый анализ настроения
-        sentiment_scores = self._analyze_sentiment(text_lower)
+        sentiment_scores = self._analyze_sentiment(text_lower, counts, total_words)
         
         # Анализ эмоций
-        emotions = self._analyze_emotions(text_lower)
+        emotions = self._analyze_emotions(counts, total_words)
         
         # Психологические индикаторы
-        psychological_indicators = self._analyze_psychological_state(text_lower)
+        psychological_indicators = self._analyze_psychological_state(counts, total_words)
         
         # Определение общего настроения
         overall_sentiment = self._determine_overall_sentiment(sentiment_scores)
@@ -94,23 +513,132 @@ class RussianSentimentAnalyzer:
             confidence=confidence,
             emotions=emotions,
             psychological_indicators=psychological_indicators,
-            recommendation=recommendation
+            recommendation=recommendation,
+            token_hits=token_hits
+        )
+
+    def analyze_batch(
+        self, texts: Sequence[str], columnar: bool = False
+    ) -> Union[List[SentimentResult], SentimentBatch]:
+        """Пакетный анализ: одна разреженная матрица документ x словарь и операции NumPy
+        
+        Результаты совпадают с analyze_text для каждого текста; columnar=True
+        возвращает SentimentBatch с массивами вместо списка объектов.
+        """
+        import numpy as np
+        from scipy import sparse
+        
+        n_texts = len(texts)
+        empty = np.zeros(n_texts, dtype=bool)
+        total_words = np.zeros(n_texts, dtype=np.float64)
+        vader = np.zeros((n_texts, 4), dtype=np.float64)  # pos, neg, neu, compound
+        
+        # Токенизация и VADER остаются поштучными, весь подсчет - матричный
+        indptr, indices = [0], []
+        for row, text in enumerate(texts):
+            if not text or not text.strip():
+                empty[row] = True
+                indptr.append(len(indices))
+                continue
+            
+            text_lower = text.lower()
+            tokens = self._tokenize(text_lower)
+            total_words[row] = len(tokens)
+            
+            indices.extend(self._match_terms(tokens))
+            indptr.append(len(indices))
+            
+            scores = self.vader.polarity_scores(text_lower)
+            vader[row] = (scores['pos'], scores['neg'], scores['neu'], scores['compound'])
+        
+        term_counts = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int64), np.asarray(indices, dtype=np.int64), np.asarray(indptr)),
+            shape=(n_texts, len(self._terms))
         )
+        term_counts.sum_duplicates()
+        counts = np.asarray((term_counts @ self._get_lexicon_matrix()).todense())
+        
+        def column(category: str) -> 'np.ndarray':
+            return counts[:, LEXICON_CATEGORIES.index(category)]
+        
+        has_words = total_words > 0
+        denominator = np.where(has_words, total_words, 1.0)
+        
+        # Настроение
+        russian_positive = column('positive') / denominator
+        russian_negative = column('negative') / denominator
+        compound = vader[:, 3]
+        russian_balance = russian_positive - russian_negative
+        final_score = (compound + russian_balance) / 2
+        overall = np.select([final_score >= 0.1, final_score <= -0.1], ['positive', 'negative'], 'neutral')
+        
+        # Эмоции
+        emotions = {name: np.zeros(n_texts) for name in EMOTION_NAMES}
+        for name in ('joy', 'sadness', 'anger', 'fear'):
+            emotions[name] = column(name) / denominator
+        
+        # Психологические индикаторы
+        indicators = {
+            'stress_level': np.minimum(column('stress') / denominator * 10, 1.0),
+            'depression_risk': np.minimum(column('depression') / denominator * 10, 1.0),
+            'anxiety_level': np.minimum(column('anxiety') / denominator * 10, 1.0),
+        }
+        total_negative = indicators['stress_level'] + indicators['depression_risk'] + indicators['anxiety_level']
+        indicators['emotional_stability'] = np.where(has_words, np.maximum(0.1, 1.0 - total_negative / 3), 0.5)
+        indicators['need_support'] = np.minimum(column('support') / denominator * 10, 1.0)
+        indicators = {name: indicators[name] for name in INDICATOR_NAMES}
+        
+        # Уверенность
+        emotion_strength = sum(emotions[name] for name in EMOTION_NAMES)
+        confidence = np.minimum((emotion_strength + np.abs(compound) + np.abs(russian_balance)) / 3, 1.0)
+        confidence = np.maximum(confidence, 0.1)
+        
+        # Рекомендация (порядок условий как в _get_response_recommendation)
+        negative = overall == 'negative'
+        recommendation = np.select(
+            [
+                indicators['need_support'] > 0.3,
+                (indicators['stress_level'] > 0.4) | (indicators['anxiety_level'] > 0.4),
+                indicators['depression_risk'] > 0.3,
+                (overall == 'positive') & (emotions['joy'] > 0.2),
+                negative & (emotions['anger'] > 0.2),
+                negative & (emotions['sadness'] > 0.2),
+                negative,
+            ],
+            ['supportive', 'calming', 'empathetic', 'encouraging', 'understanding', 'comforting', 'supportive'],
+            'balanced'
+        )
+        
+        # Пустые тексты
+        overall[empty] = 'neutral'
+        confidence[empty] = 0.0
+        recommendation[empty] = 'neutral'
+        
+        batch = SentimentBatch(
+            overall_sentiment=overall,
+            confidence=confidence,
+            emotions=emotions,
+            psychological_indicators=indicators,
+            recommendation=recommendation,
+            term_counts=term_counts,
+            terms=self._terms,
+            empty=empty
+        )
+        return batch if columnar else batch.to_results()
 
-    def _analyze_sentiment(self, text: str) -> Dict[str, float]:
+    @staticmethod
+    def _count(counts: List[int], category: str) -> int:
+        return counts[LEXICON_CATEGORIES.index(category)]
+
+    def _analyze_sentiment(self, text: str, counts: List[int], total_words: int) -> Dict[str, float]:
         """Анализ базового настроения"""
         # VADER анализ (работает с транслитерацией)
         vader_scores = self.vader.polarity_scores(text)
         
-        # Подсчет положительных и отрицательных слов
-        positive_count = sum(1 for word in self.positive_words if word in text)
-        negative_count = sum(1 for word in self.negative_words if word in text)
-        
-        # Нормализация
-        total_words = len(text.split())
+        # Нормализация по числу токенов
         if total_words > 0:
-            positive_ratio = positive_count / total_words
-            negative_ratio = negative_count / total_words
+            positive_ratio = self._count(counts, 'positive') / total_words
+            negative_ratio = self._count(counts, 'negative') / total_words
         else:
             positive_ratio = negative_ratio = 0
         
@@ -123,7 +651,7 @@ class RussianSentimentAnalyzer:
             'russian_negative': negative_ratio
         }
 
-    def _analyze_emotions(self, text: str) -> Dict[str, float]:
+    def _analyze_emotions(self, counts: List[int], total_words: int) -> Dict[str, float]:
         """Анализ конкретных эмоций"""
         emotions = {
             'joy': 0.0,
@@ -134,25 +662,15 @@ class RussianSentimentAnalyzer:
             'disgust': 0.0
         }
         
-        # Радость
-        joy_words = {'радость', 'счастье', 'веселье', 'восторг', 'эйфория', 'блаженство'}
-        emotions['joy'] = sum(1 for word in joy_words if word in text) / len(text.split())
-        
-        # Грусть
-        sadness_words = {'грусть', 'печаль', 'тоска', 'уныние', 'меланхолия'}
-        emotions['sadness'] = sum(1 for word in sadness_words if word in text) / len(text.split())
-        
-        # Злость
-        anger_words = {'злость', 'гнев', 'ярость', 'бешенство', 'раздражение'}
-        emotions['anger'] = sum(1 for word in anger_words if word in text) / len(text.split())
+        if total_words == 0:
+            return emotions
         
-        # Страх
-        fear_words = {'страх', 'ужас', 'паника', 'боязнь', 'фобия'}
-        emotions['fear'] = sum(1 for word in fear_words if word in text) / len(text.split())
+        for emotion in ('joy', 'sadness', 'anger', 'fear'):
+            emotions[emotion] = self._count(counts, emotion) / total_words
         
         return emotions
 
-    def _analyze_psychological_state(self, text: str) -> Dict[str, float]:
+    def _analyze_psychological_state(self, counts: List[int], total_words: int) -> Dict[str, float]:
         """Анализ психологического состояния"""
         indicators = {
             'stress_level': 0.0,
@@ -162,26 +680,20 @@ class RussianSentimentAnalyzer:
             'need_support': 0.0
         }
         
-        total_words = len(text.split())
         if total_words == 0:
             return indicators
         
         # Уровень стресса
-        stress_count = sum(1 for word in self.stress_indicators if word in text)
-        indicators['stress_level'] = min(stress_count / total_words * 10, 1.0)
+        indicators['stress_level'] = min(self._count(counts, 'stress') / total_words * 10, 1.0)
         
         # Риск депрессии
-        depression_count = sum(1 for word in self.depression_indicators if word in text)
-        indicators['depression_risk'] = min(depression_count / total_words * 10, 1.0)
+        indicators['depression_risk'] = min(self._count(counts, 'depression') / total_words * 10, 1.0)
         
         # Уровень тревожности
-        anxiety_count = sum(1 for word in self.anxiety_indicators if word in text)
-        indicators['anxiety_level'] = min(anxiety_count / total_words * 10, 1.0)
+        indicators['anxiety_level'] = min(self._count(counts, 'anxiety') / total_words * 10, 1.0)
         
         # Потребность в поддержке
-        support_words = {'помощь', 'поддержка', 'помоги', 'трудно', 'сложно', 'не справляюсь'}
-        support_count = sum(1 for word in support_words if word in text)
-        indicators['need_support'] = min(support_count / total_words * 10, 1.0)
+        indicators['need_support'] = min(self._count(counts, 'support') / total_words * 10, 1.0)
         
         # Эмоциональная стабильность (обратная к общему негативу)
         total_negative = indicators['stress_level'] + indicators['depression_risk'] + indicators['anxiety_level']
@@ -250,9 +762,24 @@ class RussianSentimentAnalyzer:
         # По умолчанию
         return 'balanced'
 
-def get_sentiment_analyzer() -> RussianSentimentAnalyzer:
+def get_sentiment_analyzer(cache_size: int = 2048, cache_ttl: float = 3600.0) -> RussianSentimentAnalyzer:
     """Фабричная функция для получения анализатора"""
-    return RussianSentimentAnalyzer()
+    return RussianSentimentAnalyzer(cache_size=cache_size, cache_ttl=cache_ttl)
+
+def check_inflections(analyzer: RussianSentimentAnalyzer) -> List[str]:
+    """Проверить INFLECTION_CHECKS и FALSE_HIT_CHECKS; возвращает описания несработавших примеров"""
+    failures = []
+    for text, expected in INFLECTION_CHECKS:
+        result = analyzer.analyze_text(text)
+        scores = {**result.emotions, **result.psychological_indicators}
+        missing = [name for name in expected if not scores.get(name)]
+        if missing:
+            failures.append(f"{text!r}: {', '.join(missing)} = 0")
+    for text in FALSE_HIT_CHECKS:
+        hits = analyzer.analyze_text(text).token_hits
+        if hits:
+            failures.append(f"{text!r}: лишние попадания {dict(hits)}")
+    return failures
 
 # Пример использования
 if __name__ == "__main__":
@@ -270,4 +797,10 @@ if __name__ == "__main__":
         print(f"\nТекст: {text}")
         print(f"Настроение: {result.overall_sentiment} ({result.confidence:.2f})")
         print(f"Рекомендация: {result.recommendation}")
-        print(f"Психологические показатели: {result.psychological_indicators}")
\ No newline at end of file
+        print(f"Психологические показатели: {result.psychological_indicators}")
+    
+    failures = check_inflections(analyzer)
+    for failure in failures:
+        print(f"\nПроверка словоформ не пройдена: {failure}")
+    if failures:
+        raise SystemExit(1)
\ No newline at end of file
@@ -0,0 +1,533 @@
+"""
+Модуль хранения пользовательских сессий
+История разговора, состояние полного анализа и эмоциональная динамика пользователя
+в одном объекте. Хранилище ограничено по числу сессий и памяти (LRU),
+неактивные сессии удаляются по истечении времени простоя.
+Сессии могут сохраняться в SQLite и переживать перезапуск бота
+"""
+
+import sys
+import json
+import time
+import logging
+import threading
+import weakref
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Tuple
+
+from database import get_database
+from sentiment_analyzer import EmotionalTrend
+
+logger = logging.getLogger(__name__)
+
+# Примерный размер сессии без сообщений и ответов, байт
+SESSION_OVERHEAD_BYTES = 1024
+
+# Как часто фоновый поток удаляет из базы просроченные сессии, секунд
+SESSION_PURGE_INTERVAL = 3600.0
+
+class UserSession:
+    """Сессия пользователя"""
+
+    __slots__ = (
+        'user_id', 'history', 'message_count', 'summary', 'summary_upto',
+        'state', 'answers', 'current_question',
+        'emotional_trend', 'created_at', 'last_seen', 'size_bytes', 'removed',
+        '__weakref__',
+    )
+
+    def __init__(self, user_id: int, max_history: int = 15):
+        self.user_id = user_id
+        # Кольцевой буфер: старые сообщения вытесняются без копирования списка
+        self.history: Deque[str] = deque(maxlen=max_history)
+        self.message_count = 0  # всего сообщений за сессию
+        # Краткое содержание первых summary_upto сообщений
+        self.summary = ""
+        self.summary_upto = 0
+        self.state: Optional[str] = None
+        self.answers: List[str] = []
+        self.current_question = 0
+        self.emotional_trend: Optional[EmotionalTrend] = None
+        self.created_at = time.time()
+        self.last_seen = time.monotonic()
+        self.size_bytes = SESSION_OVERHEAD_BYTES
+        self.removed = False  # сессия удалена (/clear), изменения больше не сохраняются
+
+    def add_message(self, text: str) -> None:
+        """Добавить сообщение в историю"""
+        self.history.append(text)
+        self.message_count += 1
+
+    def recent_messages(self, count: int, skip_last: int = 0) -> List[str]:
+        """Последние count сообщений истории, без skip_last самых новых"""
+        end = max(len(self.history) - skip_last, 0)
+        return list(islice(self.history, max(end - count, 0), end))
+
+    def unsummarized_messages(self, skip_last: int = 0) -> List[str]:
+        """Сообщения, которые еще не вошли в краткое содержание, без skip_last самых новых"""
+        unsummarized = min(self.message_count - self.summary_upto, len(self.history))
+        return self.recent_messages(max(unsummarized - skip_last, 0), skip_last)
+
+    def start_full_analysis(self) -> None:
+        """Начать полный анализ"""
+        self.state = 'full_analysis'
+        self.answers = []
+        self.current_question = 0
+
+    def reset_full_analysis(self) -> None:
+        """Сбросить состояние полного анализа (история разговора сохраняется)"""
+        self.state = None
+        self.answers = []
+        self.current_question = 0
+
+    def to_dict(self) -> Dict:
+        """Состояние сессии для сохранения"""
+        return {
+            'history': list(self.history),
+            'message_count': self.message_count,
+            'summary': self.summary,
+            'summary_upto': self.summary_upto,
+            'state': self.state,
+            'answers': self.answers,
+            'current_question': self.current_question,
+            'emotional_trend': self.emotional_trend.to_dict() if self.emotional_trend else None,
+            'created_at': self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, user_id: int, data: Dict, max_history: int = 15) -> 'UserSession':
+        """Восстановить сессию из сохраненного состояния"""
+        session = cls(user_id, max_history)
+        session.history.extend(data.get('history', []))
+        session.message_count = data.get('message_count', len(session.history))
+        session.summary = data.get('summary', "")
+        session.summary_upto = data.get('summary_upto', 0)
+        session.state = data.get('state')
+        session.answers = list(data.get('answers', []))
+        session.current_question = data.get('current_question', 0)
+        if data.get('emotional_trend'):
+            session.emotional_trend = EmotionalTrend.from_dict(data['emotional_trend'])
+        session.created_at = data.get('created_at', session.created_at)
+        session.size_bytes = session.estimate_size()
+        return session
+
+    def estimate_size(self) -> int:
+        """Приблизительный объем памяти сессии, байт"""
+        return (
+            SESSION_OVERHEAD_BYTES
+            + sum(sys.getsizeof(message) for message in self.history)
+            + sum(sys.getsizeof(answer) for answer in self.answers)
+            + sys.getsizeof(self.summary)
+        )
+
+class SQLiteSessionBackend:
+    """Хранение сессий в SQLite с отложенной пакетной записью изменений
+
+    Измененная сессия только помечается для записи; сериализуется она в фоновом
+    потоке и попадает в базу одной транзакцией раз в flush_interval секунд,
+    поэтому несколько изменений одной сессии за интервал дают одну запись.
+    Если сессию изменят во время сериализации, update() снова пометит ее,
+    и следующая запись сохранит актуальное состояние.
+    Раз в purge_interval секунд тот же поток удаляет просроченные сессии.
+    """
+
+    def __init__(
+        self,
+        db,
+        flush_interval: float = 1.0,
+        ttl: float = 30 * 24 * 3600,
+        purge_interval: float = SESSION_PURGE_INTERVAL,
+    ):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+
+        # user_id -> (измененная сессия, время изменения) или None для удаления
+        self._pending: Dict[int, Optional[Tuple[UserSession, float]]] = {}
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._next_purge_at = time.monotonic() + purge_interval
+
+        # Метрики
+        self.loads = 0
+        self.load_hits = 0
+        self.saved_rows = 0
+        self.deleted_rows = 0
+        self.flushes = 0
+        self.failures = 0
+
+        self._create_tables()
+        self.purge_expired()
+
+    def _create_tables(self):
+        """Создание таблицы сессий"""
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions(updated_at)')
+
+    def purge_expired(self) -> int:
+        """Удалить сессии, которые не менялись дольше ttl"""
+        deleted = self.db.execute('DELETE FROM sessions WHERE updated_at < ?', (time.time() - self.ttl,))
+        if deleted > 0:
+            logger.info(f"Purged {deleted} expired sessions")
+        return deleted
+
+    def load(self, user_id: int) -> Optional[Dict]:
+        """Прочитать сессию пользователя (одно чтение по первичному ключу)"""
+        self.loads += 1
+        with self._condition:
+            if user_id in self._pending:
+                entry = self._pending[user_id]
+                if entry is None:
+                    return None
+                self.load_hits += 1
+                return entry[0].to_dict()
+
+        row = self.db.fetchone('SELECT data, updated_at FROM sessions WHERE user_id = ?', (user_id,))
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+
+        self.load_hits += 1
+        return json.loads(row[0])
+
+    def save(self, session: UserSession) -> None:
+        """Пометить сессию для записи (сериализуется в фоновом потоке)"""
+        self._enqueue(session.user_id, (session, time.time()))
+
+    def delete(self, user_id: int) -> None:
+        """Поставить удаление сессии в очередь"""
+        self._enqueue(user_id, None)
+
+    def delete_all(self) -> None:
+        """Удалить все сессии (сразу)"""
+        with self._flush_lock:
+            with self._condition:
+                self._pending.clear()
+            self.db.execute('DELETE FROM sessions')
+
+    def _enqueue(self, user_id: int, entry: Optional[Tuple[UserSession, float]]) -> None:
+        with self._condition:
+            self._pending[user_id] = entry
+            closed = self._closed
+            if not closed:
+                self._ensure_thread()
+                self._condition.notify()
+
+        # После остановки фонового потока пишем синхронно
+        if closed:
+            self.flush()
+
+    def _ensure_thread(self):
+        """Запустить фоновый поток записи при первом использовании"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Цикл фонового потока: копим изменения flush_interval секунд и пишем пакетом"""
+        while True:
+            with self._condition:
+                if not self._pending and not self._closed:
+                    self._condition.wait(max(self._next_purge_at - time.monotonic(), 0))
+
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                closed = self._closed
+
+            self.flush()
+            if closed:
+                return
+
+            if time.monotonic() >= self._next_purge_at:
+                self._next_purge_at = time.monotonic() + self.purge_interval
+                try:
+                    self.purge_expired()
+                except Exception as e:
+                    logger.error(f"Error purging expired sessions: {e}")
+
+    def flush(self) -> int:
+        """Записать накопленные изменения одной транзакцией"""
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, {}
+
+            if not batch:
+                return 0
+
+            deletes = [(user_id,) for user_id, entry in batch.items() if entry is None]
+            try:
+                saves = [
+                    (user_id, json.dumps(entry[0].to_dict(), ensure_ascii=False), entry[1])
+                    for user_id, entry in batch.items() if entry is not None
+                ]
+                with self.db.transaction() as cursor:
+                    if saves:
+                        cursor.executemany(
+                            'INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)',
+                            saves
+                        )
+                    if deletes:
+                        cursor.executemany('DELETE FROM sessions WHERE user_id = ?', deletes)
+            except Exception as e:
+                logger.error(f"Error flushing sessions: {e}")
+                self.failures += 1
+                with self._condition:
+                    # Более свежие изменения, пришедшие во время записи, важнее
+                    for user_id, entry in batch.items():
+                        self._pending.setdefault(user_id, entry)
+                return 0
+
+            self.flushes += 1
+            self.saved_rows += len(saves)
+            self.deleted_rows += len(deletes)
+            return len(batch)
+
+    def close(self):
+        """Остановить фоновый поток, дописав все оставшиеся изменения"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+
+        if thread is not None and thread.is_alive():
+            thread.join(timeout=10)
+        self.flush()
+
+    def get_stats(self) -> Dict:
+        """Метрики хранения сессий"""
+        return {
+            'pending': len(self._pending),
+            'loads': self.loads,
+            'load_hits': self.load_hits,
+            'saved_rows': self.saved_rows,
+            'deleted_rows': self.deleted_rows,
+            'flushes': self.flushes,
+            'failures': self.failures,
+        }
+
+class SessionStore:
+    """Хранилище сессий с LRU-вытеснением и удалением неактивных сессий
+
+    Если задан backend, вытесненные из памяти сессии остаются в базе
+    и загружаются обратно при следующем обращении пользователя.
+    Вытесненная сессия, с которой еще работает обработчик, не теряется:
+    следующее обращение вернет тот же объект, а update() вернет его в хранилище.
+    """
+
+    def __init__(
+        self,
+        max_history: int = 15,
+        idle_ttl: float = 24 * 3600,
+        max_entries: int = 10000,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+        backend: Optional[SQLiteSessionBackend] = None,
+    ):
+        self.max_history = max_history
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.backend = backend
+
+        # Порядок - от давно активных к недавно активным
+        self._sessions: "OrderedDict[int, UserSession]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.RLock()
+        # Вытесненные сессии, на которые еще ссылаются обработчики
+        self._detached: "weakref.WeakValueDictionary[int, UserSession]" = weakref.WeakValueDictionary()
+
+        self.created = 0
+        self.loaded = 0
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+
+    def get(self, user_id: int) -> Optional[UserSession]:
+        """Сессия пользователя, если она есть"""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            session = self._sessions.get(user_id)
+            if session is not None:
+                session.last_seen = now
+                self._sessions.move_to_end(user_id)
+            else:
+                session = self._detached.pop(user_id, None)
+                if session is not None:
+                    session.last_seen = now
+                    self._insert(session)
+                elif self.backend is not None:
+                    session = self._load(user_id)
+            return session
+
+    def _load(self, user_id: int) -> Optional[UserSession]:
+        """Загрузить сессию из базы (ленивая загрузка при первом обращении)"""
+        try:
+            data = self.backend.load(user_id)
+        except Exception as e:
+            logger.error(f"Error loading session {user_id}: {e}")
+            return None
+        if data is None:
+            return None
+
+        session = UserSession.from_dict(user_id, data, self.max_history)
+        self._insert(session)
+        self.loaded += 1
+        return session
+
+    def _insert(self, session: UserSession) -> None:
+        self._sessions[session.user_id] = session
+        self._memory_bytes += session.size_bytes
+        self._enforce_limits()
+
+    def get_or_create(self, user_id: int) -> UserSession:
+        """Сессия пользователя; создается при первом обращении"""
+        with self._lock:
+            session = self.get(user_id)
+            if session is None:
+                session = UserSession(user_id, self.max_history)
+                self._insert(session)
+                self.created += 1
+            return session
+
+    def append_message(self, user_id: int, text: str) -> UserSession:
+        """Добавить сообщение в историю пользователя"""
+        with self._lock:
+            session = self.get_or_create(user_id)
+            session.add_message(text)
+            self.update(session)
+            return session
+
+    def update(self, session: UserSession) -> None:
+        """Пересчитать объем сессии после изменения, проверить лимиты и сохранить ее
+
+        Сессию, вытесненную пока обработчик ждал ответа ИИ, возвращаем в хранилище.
+        """
+        with self._lock:
+            if session.removed:
+                return
+
+            current = self._sessions.get(session.user_id)
+            if current is None:
+                self._detached.pop(session.user_id, None)
+                session.last_seen = time.monotonic()
+                self._sessions[session.user_id] = session
+                self._memory_bytes += session.size_bytes
+            elif current is not session:
+                logger.warning(f"Session {session.user_id} was replaced, update skipped")
+                return
+
+            size = session.estimate_size()
+            self._memory_bytes += size - session.size_bytes
+            session.size_bytes = size
+            self._enforce_limits()
+
+            if self.backend is not None:
+                self.backend.save(session)
+
+    def discard(self, user_id: int) -> None:
+        """Удалить сессию пользователя"""
+        with self._lock:
+            session = self._sessions.pop(user_id, None)
+            if session is not None:
+                self._memory_bytes -= session.size_bytes
+                session.removed = True
+            detached = self._detached.pop(user_id, None)
+            if detached is not None:
+                detached.removed = True
+
+            if self.backend is not None:
+                self.backend.delete(user_id)
+
+    def clear(self) -> None:
+        """Удалить все сессии"""
+        with self._lock:
+            for session in list(self._sessions.values()) + list(self._detached.values()):
+                session.removed = True
+            self._sessions.clear()
+            self._detached.clear()
+            self._memory_bytes = 0
+
+            if self.backend is not None:
+                self.backend.delete_all()
+
+    def close(self) -> None:
+        """Дописать несохраненные изменения (при остановке бота)"""
+        if self.backend is not None:
+            self.backend.close()
+
+    def _expire(self, now: float) -> None:
+        """Удалить неактивные сессии (они в начале очереди)"""
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.last_seen <= self.idle_ttl:
+                break
+            self._evict(user_id)
+            self.evicted_idle += 1
+
+    def _enforce_limits(self) -> None:
+        """Вытеснить давно неактивные сессии при превышении лимитов"""
+        # Самую свежую сессию не вытесняем - с ней сейчас работают
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_entries or self._memory_bytes > self.max_memory_bytes
+        ):
+            self._evict(next(iter(self._sessions)))
+            self.evicted_lru += 1
+
+    def _evict(self, user_id: int) -> None:
+        # Из базы сессия не удаляется - ее можно будет загрузить снова
+        session = self._sessions.pop(user_id)
+        self._memory_bytes -= session.size_bytes
+        self._detached[user_id] = session
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._sessions
+
+    def get_stats(self) -> Dict:
+        """Статистика хранилища"""
+        return {
+            'entries': len(self._sessions),
+            'max_entries': self.max_entries,
+            'memory_bytes': self._memory_bytes,
+            'max_memory_bytes': self.max_memory_bytes,
+            'created': self.created,
+            'loaded': self.loaded,
+            'evicted_idle': self.evicted_idle,
+            'evicted_lru': self.evicted_lru,
+            'backend': self.backend.get_stats() if self.backend is not None else None,
+        }
+
+def get_session_store(
+    max_history: int = 15,
+    idle_ttl: float = 24 * 3600,
+    max_entries: int = 10000,
+    max_memory_bytes: int = 64 * 1024 * 1024,
+    backend: Optional[SQLiteSessionBackend] = None,
+) -> SessionStore:
+    """Фабричная функция для получения хранилища сессий"""
+    return SessionStore(max_history, idle_ttl, max_entries, max_memory_bytes, backend)
+
+def get_session_backend(
+    db_path: str,
+    flush_interval: float = 1.0,
+    ttl: float = 30 * 24 * 3600,
+    purge_interval: float = SESSION_PURGE_INTERVAL,
+) -> SQLiteSessionBackend:
+    """Фабричная функция для получения SQLite-хранилища сессий"""
+    return SQLiteSessionBackend(get_database(db_path), flush_interval, ttl, purge_interval)
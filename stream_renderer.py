@@ -0,0 +1,217 @@
+"""
+Модуль потокового вывода ответов ИИ в Telegram
+Показывает ответ по мере генерации, редактируя одно сообщение порциями
+"""
+
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram - 4096 символов, оставляем запас под закрывающую разметку
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+def close_markdown(text: str) -> str:
+    """Закрыть незавершенную Markdown-разметку (legacy Markdown Telegram)"""
+    closing = ""
+
+    # Блоки кода: внутри них остальная разметка не действует
+    if text.count("```") % 2 == 1:
+        return text + "\n```"
+
+    plain = text.replace("```", "")
+    if plain.count("`") % 2 == 1:
+        return text + "`"
+
+    # Незавершенная ссылка [текст](url - отрезаем, чтобы не сломать разбор
+    last_open = text.rfind("[")
+    if last_open != -1:
+        label_end = text.find("]", last_open)
+        unfinished_label = label_end == -1
+        unfinished_url = text.startswith("(", label_end + 1) and ")" not in text[label_end:]
+        if unfinished_label or (label_end != -1 and unfinished_url):
+            text = text[:last_open]
+        plain = text.replace("```", "")
+
+    if plain.count("*") % 2 == 1:
+        closing += "*"
+    if plain.count("_") % 2 == 1:
+        closing += "_"
+
+    return text + closing
+
+def split_for_rollover(text: str, max_length: int) -> int:
+    """Найти позицию разбиения текста, не превышающую max_length"""
+    if len(text) <= max_length:
+        return len(text)
+
+    # Предпочитаем границу абзаца, затем строки, затем слова
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, max_length // 2, max_length)
+        if position != -1:
+            return position + len(separator)
+
+    return max_length
+
+class StreamingMessageRenderer:
+    """Отрисовка потокового ответа через редактирование сообщения Telegram"""
+
+    def __init__(
+        self,
+        message: Message,
+        send_message: Callable[..., Awaitable[Message]],
+        error_message: str,
+        parse_mode: Optional[str] = None,
+        max_length: int = TELEGRAM_MESSAGE_LIMIT,
+        min_interval: float = 1.0,
+        min_chars: int = 20,
+        part_prefix: str = "",
+    ):
+        self.message: Optional[Message] = message  # None - новое сообщение отправить не удалось
+        self.send_message = send_message
+        self.error_message = error_message  # показывается, если ответ пустой
+        self.parse_mode = parse_mode
+        self.max_length = max_length
+        self.min_interval = min_interval
+        self.min_chars = min_chars
+        self.part_prefix = part_prefix
+
+        self.parts: List[str] = []  # завершенные сообщения
+        self.buffer = ""  # текст текущего сообщения
+        self.rendered = ""  # последний отправленный в Telegram текст
+        self.next_edit_at = 0.0
+
+    @property
+    def text(self) -> str:
+        """Полный накопленный текст ответа"""
+        return "".join(self.parts) + self.buffer
+
+    async def feed(self, delta: str) -> None:
+        """Добавить очередную порцию токенов"""
+        if not delta:
+            return
+
+        self.buffer += delta
+        await self._fit()
+
+        now = time.monotonic()
+        if now < self.next_edit_at:
+            return
+        if len(self.buffer) - len(self.rendered) < self.min_chars and self.rendered:
+            return
+
+        await self._edit(close_markdown(self._decorate(self.buffer, len(self.parts))), final=False)
+
+    async def finish(self, error: Optional[str] = None) -> str:
+        """Завершить вывод и вернуть полный текст ответа
+
+        error - сообщение об обрыве генерации, дописывается после уже показанного текста
+        """
+        if not self.text.strip():
+            self.buffer = error or self.error_message
+        elif error:
+            self.buffer = self.buffer.rstrip() + "\n\n" + error
+            await self._fit()
+
+        final_text = self._decorate(self.buffer.strip(), len(self.parts))
+        await self._edit(final_text, final=True)
+        return self.text.strip()
+
+    def _decorate(self, text: str, part_index: int) -> str:
+        """Добавить заголовок части для продолжений длинного ответа"""
+        if part_index > 0 and self.part_prefix:
+            return self.part_prefix.format(part=part_index + 1) + text
+        return text
+
+    async def _fit(self) -> None:
+        """Перейти на новое сообщение, если текущее превысило лимит"""
+        while len(self._decorate(self.buffer, len(self.parts))) > self.max_length:
+            await self._rollover()
+
+    async def _rollover(self) -> None:
+        """Завершить текущее сообщение и начать новое"""
+        prefix_length = len(self._decorate("", len(self.parts)))
+        cut = split_for_rollover(self.buffer, self.max_length - prefix_length)
+        head, tail = self.buffer[:cut], self.buffer[cut:]
+
+        await self._edit(self._decorate(head.rstrip(), len(self.parts)), final=True)
+        self.parts.append(head)
+        self.buffer = tail.lstrip()
+
+        placeholder = self._decorate("…", len(self.parts))
+        self.message = await self._send(placeholder)
+        self.rendered = ""
+        self.next_edit_at = time.monotonic() + self.min_interval
+
+    @staticmethod
+    def _retry_seconds(error: RetryAfter) -> float:
+        retry_after = error.retry_after
+        if hasattr(retry_after, "total_seconds"):
+            retry_after = retry_after.total_seconds()
+        return retry_after
+
+    async def _send(self, text: str) -> Optional[Message]:
+        """Отправить новое сообщение с учетом лимитов Telegram; None - не удалось"""
+        parse_mode = self.parse_mode
+        for _ in range(3):
+            try:
+                return await self.send_message(text, parse_mode=parse_mode)
+            except RetryAfter as e:
+                await asyncio.sleep(self._retry_seconds(e))
+            except BadRequest as e:
+                if parse_mode and "parse" in str(e).lower():
+                    parse_mode = None
+                    continue
+                logger.warning(f"Streaming send failed: {e}")
+                return None
+            except TelegramError as e:
+                logger.warning(f"Streaming send failed: {e}")
+                return None
+        return None
+
+    async def _edit(self, text: str, final: bool) -> None:
+        """Отредактировать текущее сообщение с учетом лимитов Telegram"""
+        if not text or text == self.rendered:
+            return
+
+        if self.message is None:
+            # Продолжение не удалось отправить при переходе - пробуем снова
+            self.message = await self._send(text)
+            if self.message is not None:
+                self.rendered = text
+            self.next_edit_at = time.monotonic() + self.min_interval
+            return
+
+        for _ in range(3):
+            try:
+                await self._edit_with_fallback(text)
+                self.rendered = text
+                self.next_edit_at = time.monotonic() + self.min_interval
+                return
+            except RetryAfter as e:
+                retry_after = self._retry_seconds(e)
+                self.next_edit_at = time.monotonic() + retry_after
+                if not final:
+                    return
+                await asyncio.sleep(retry_after)
+            except TelegramError as e:
+                logger.warning(f"Streaming edit failed: {e}")
+                return
+
+    async def _edit_with_fallback(self, text: str) -> None:
+        """Отредактировать с разметкой, при ошибке разбора - простым текстом"""
+        try:
+            await self.message.edit_text(text, parse_mode=self.parse_mode)
+        except BadRequest as e:
+            error = str(e).lower()
+            if "not modified" in error:
+                return
+            if self.parse_mode and "parse" in error:
+                await self.message.edit_text(text)
+                return
+            raise
@@ -0,0 +1,273 @@
+"""
+Модуль многопроцессного режима (supervisor)
+Главный процесс принимает обновления и распределяет их по процессам-воркерам
+по хэшу пользователя: история и состояние пользователя живут в одном процессе,
+общей памяти между воркерами нет. Главный процесс - единственный писатель SQLite,
+воркеры пересылают ему изменения через WriteForwarder
+"""
+
+import os
+import queue
+import signal
+import asyncio
+import logging
+import multiprocessing
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram import Update
+
+from database import DatabaseWriter, WriteForwarder, set_write_forwarder
+from webhook_server import raw_update_key
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class WorkerContext:
+    """Параметры процесса-воркера"""
+    index: int
+    processes: int
+    updates: Any  # очередь JSON обновлений; None - команда остановки
+    forwarder: WriteForwarder
+    supervisor_pid: int
+    clear_generation: Any  # общий счетчик команд /clear (multiprocessing.Value)
+    seen_generation: int = 0  # последняя учтенная этим процессом команда
+
+_current_worker: Optional[WorkerContext] = None
+
+def get_worker_context() -> Optional[WorkerContext]:
+    """Контекст текущего процесса-воркера (None - процесс не воркер)"""
+    return _current_worker
+
+def _worker_entry(target: Callable[[WorkerContext], None], context: WorkerContext) -> None:
+    global _current_worker
+    _current_worker = context
+    # Сигналы остановки получает главный процесс, воркер завершается по команде из очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    set_write_forwarder(context.forwarder)
+    target(context)
+
+def broadcast_clear() -> None:
+    """Попросить остальные воркеры сбросить свои кэши (после /clear в этом процессе)"""
+    context = _current_worker
+    if context is None:
+        return
+    with context.clear_generation.get_lock():
+        context.clear_generation.value += 1
+        context.seen_generation = context.clear_generation.value
+
+class WorkerPool:
+    """Процессы-воркеры с распределением обновлений по пользователю"""
+
+    def __init__(
+        self,
+        target: Callable[[WorkerContext], None],
+        processes: int,
+        queue_size: int = 1000,
+        write_timeout: float = 30.0,
+    ):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("Многопроцессный режим требует fork (Linux)")
+
+        self.target = target
+        self.processes = max(processes, 1)
+        self.write_timeout = write_timeout
+        self._mp = multiprocessing.get_context('fork')
+
+        # Общий лимит делится между очередями воркеров
+        per_worker = max(queue_size // self.processes, 1)
+        self._queues = [self._mp.Queue(maxsize=per_worker) for _ in range(self.processes)]
+        self._capacity = per_worker * self.processes
+
+        write_requests = self._mp.Queue()
+        self._write_responses = [self._mp.Queue() for _ in range(self.processes)]
+        self.writer = DatabaseWriter(write_requests, self._write_responses)
+        self._clear_generation = self._mp.Value('i', 0)
+
+        self._workers: List[multiprocessing.process.BaseProcess] = []
+        self._draining = False
+
+        # Метрики
+        self.received = [0] * self.processes
+        self.rejected = 0
+
+    def fork(self) -> None:
+        """Запустить процессы-воркеры
+
+        Вызывается до запуска потоков и цикла событий: дочерние процессы
+        получают копию памяти главного процесса
+        """
+        supervisor_pid = os.getpid()
+        for index in range(self.processes):
+            context = WorkerContext(
+                index=index,
+                processes=self.processes,
+                updates=self._queues[index],
+                forwarder=WriteForwarder(
+                    index, self.writer.requests, self._write_responses[index], self.write_timeout
+                ),
+                supervisor_pid=supervisor_pid,
+                clear_generation=self._clear_generation,
+            )
+            process = self._mp.Process(
+                target=_worker_entry,
+                args=(self.target, context),
+                name=f"bot-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._workers.append(process)
+        logger.info(f"Started {self.processes} worker processes")
+
+    def start(self) -> None:
+        """Запустить писателя базы (после fork)"""
+        self.writer.start()
+
+    def _partition(self, data: Dict) -> int:
+        return raw_update_key(data) % self.processes
+
+    def submit(self, data: Dict) -> bool:
+        """Передать обновление воркеру пользователя; False - очередь заполнена"""
+        index = self._partition(data)
+        try:
+            self._queues[index].put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.received[index] += 1
+        return True
+
+    async def put(self, data: Dict) -> None:
+        """Передать обновление воркеру, дождавшись места в очереди"""
+        index = self._partition(data)
+        await asyncio.get_running_loop().run_in_executor(None, self._queues[index].put, data)
+        self.received[index] += 1
+
+    async def wait_failed(self, interval: float = 1.0) -> int:
+        """Дождаться неожиданного завершения воркера; возвращает его номер"""
+        while True:
+            await asyncio.sleep(interval)
+            if self._draining:
+                continue
+            for index, process in enumerate(self._workers):
+                if not process.is_alive():
+                    logger.error(f"Worker process {index} exited with code {process.exitcode}")
+                    return index
+
+    async def drain(self, timeout: float = 30.0) -> bool:
+        """Передать воркерам команду остановки и дождаться их завершения"""
+        self._draining = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        # Команда встает в очередь после уже принятых обновлений
+        for index, update_queue in enumerate(self._queues):
+            try:
+                await loop.run_in_executor(None, update_queue.put, None, True, max(deadline - loop.time(), 0.1))
+            except queue.Full:
+                logger.warning(f"Worker process {index} queue is full, stop command not delivered")
+
+        for process in self._workers:
+            await loop.run_in_executor(None, process.join, max(deadline - loop.time(), 0))
+
+        alive = [process.name for process in self._workers if process.is_alive()]
+        if alive:
+            logger.warning(f"Worker drain timed out: {', '.join(alive)} still running")
+        return not alive
+
+    async def stop(self) -> None:
+        """Завершить оставшиеся процессы и остановить писателя"""
+        loop = asyncio.get_running_loop()
+        for process in self._workers:
+            if process.is_alive():
+                process.terminate()
+            await loop.run_in_executor(None, process.join, 5)
+        # Писатель останавливается последним: воркеры дописывают данные при выходе
+        await loop.run_in_executor(None, self.writer.stop)
+
+    @property
+    def queue_depth(self) -> int:
+        try:
+            return sum(update_queue.qsize() for update_queue in self._queues)
+        except NotImplementedError:  # macOS
+            return -1
+
+    def get_stats(self) -> Dict:
+        """Метрики распределения обновлений"""
+        return {
+            'processes': self.processes,
+            'alive': sum(process.is_alive() for process in self._workers),
+            'queue_depth': self.queue_depth,
+            'queue_capacity': self._capacity,
+            'received': sum(self.received),
+            'received_per_worker': list(self.received),
+            'rejected': self.rejected,
+            'writer': self.writer.get_stats(),
+        }
+
+async def consume_updates(
+    context: WorkerContext,
+    handle: Callable[[Dict], Awaitable[None]],
+    poll_interval: float = 1.0,
+    on_clear: Optional[Callable[[], None]] = None,
+) -> None:
+    """Читать обновления из очереди воркера до команды остановки
+
+    on_clear вызывается, если /clear выполнил другой воркер (broadcast_clear)
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        generation = context.clear_generation.value
+        if generation != context.seen_generation:
+            context.seen_generation = generation
+            if on_clear is not None:
+                on_clear()
+        try:
+            data = await loop.run_in_executor(None, context.updates.get, True, poll_interval)
+        except queue.Empty:
+            if os.getppid() != context.supervisor_pid:
+                logger.error("Supervisor process is gone, stopping worker")
+                return
+            continue
+        if data is None:
+            return
+        await handle(data)
+
+async def poll_updates(bot, pool: WorkerPool, stop_event: asyncio.Event, timeout: int = 30) -> None:
+    """Получение обновлений через getUpdates и передача воркерам"""
+    await bot.delete_webhook()
+    offset = None
+    backoff = 1.0
+
+    stop_waiter = asyncio.ensure_future(stop_event.wait())
+    while not stop_event.is_set():
+        # Долгий опрос прерывается сразу по сигналу остановки
+        fetch = asyncio.ensure_future(
+            bot.get_updates(offset=offset, timeout=timeout, allowed_updates=Update.ALL_TYPES)
+        )
+        await asyncio.wait({fetch, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        if not fetch.done():
+            fetch.cancel()
+            break
+        try:
+            updates = fetch.result()
+        except Exception as e:
+            logger.error(f"Error fetching updates: {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = 1.0
+
+        for update in updates:
+            await pool.put(update.to_dict())
+            offset = update.update_id + 1
+
+    stop_waiter.cancel()
+
+    if offset is not None:
+        # Подтвердить полученные обновления, чтобы после перезапуска они не пришли снова
+        try:
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+        except Exception as e:
+            logger.warning(f"Error confirming updates: {e}")
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from http_server import HTTPServer, Response
+
+async def exchange(requests, max_headers=5, max_body_size=1024):
+    """Отправить сырые запросы и вернуть статусы ответов"""
+    server = HTTPServer('127.0.0.1', 0, max_body_size=max_body_size, max_headers=max_headers)
+
+    async def echo(request):
+        return Response.text(request.body.decode())
+
+    server.add_route('POST', '/echo', echo)
+    await server.start()
+    try:
+        statuses = []
+        for data in requests:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(data)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            statuses.append(int(response.split(b' ', 2)[1]))
+        return statuses
+    finally:
+        await server.stop()
+
+def status(data: bytes, **kwargs) -> int:
+    return asyncio.run(exchange([data], **kwargs))[0]
+
+def test_valid_request():
+    assert status(b'POST /echo HTTP/1.1\r\nConnection: close\r\nContent-Length: 2\r\n\r\nok') == 200
+
+@pytest.mark.parametrize('length', [b'-1', b'abc', b''])
+def test_invalid_content_length(length):
+    assert status(b'POST /echo HTTP/1.1\r\nContent-Length: ' + length + b'\r\n\r\n') == 400
+
+def test_body_over_limit():
+    assert status(b'POST /echo HTTP/1.1\r\nContent-Length: 2048\r\n\r\n', max_body_size=1024) == 413
+
+def test_oversized_header_line():
+    assert status(b'POST /echo HTTP/1.1\r\nX-Long: ' + b'a' * 70000 + b'\r\n\r\n') == 431
+
+def test_too_many_headers():
+    headers = b''.join(b'X-Header-%d: 1\r\n' % index for index in range(10))
+    assert status(b'POST /echo HTTP/1.1\r\n' + headers + b'\r\n', max_headers=5) == 431
+
+def test_headers_within_limit():
+    headers = b''.join(b'X-Header-%d: 1\r\n' % index for index in range(3))
+    request = b'POST /echo HTTP/1.1\r\nConnection: close\r\n' + headers + b'Content-Length: 0\r\n\r\n'
+    assert status(request, max_headers=5) == 200
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from llm_scheduler import (
+    LLMDeadlineExceededError,
+    LLMPriority,
+    LLMQueueFullError,
+    LLMScheduler,
+)
+
+async def hold_slot(scheduler, priority, started, release, order):
+    async with scheduler.slot(priority):
+        order.append(priority)
+        started.set()
+        await release.wait()
+
+def test_queue_is_served_by_priority():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1)
+        order = []
+        release = asyncio.Event()
+        release.set()
+
+        blocker_release = asyncio.Event()
+        blocker = asyncio.create_task(hold_slot(scheduler, LLMPriority.SMALL_TALK, asyncio.Event(), blocker_release, []))
+        await asyncio.sleep(0)
+
+        waiters = [
+            asyncio.create_task(hold_slot(scheduler, priority, asyncio.Event(), release, order))
+            for priority in (LLMPriority.BACKGROUND, LLMPriority.SMALL_TALK, LLMPriority.FULL_ANALYSIS)
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()['queue_depth'] == 3
+
+        blocker_release.set()
+        await asyncio.gather(blocker, *waiters)
+        return order, scheduler.get_stats()
+
+    order, stats = asyncio.run(scenario())
+    assert order == [LLMPriority.FULL_ANALYSIS, LLMPriority.SMALL_TALK, LLMPriority.BACKGROUND]
+    assert stats['active'] == 0
+    assert stats['queue_depth'] == 0
+
+def test_full_queue_evicts_less_important_request():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(hold_slot(scheduler, LLMPriority.CONSULTATION, asyncio.Event(), release, []))
+        await asyncio.sleep(0)
+
+        background = asyncio.create_task(hold_slot(scheduler, LLMPriority.BACKGROUND, asyncio.Event(), release, []))
+        await asyncio.sleep(0)
+        express = asyncio.create_task(hold_slot(scheduler, LLMPriority.EXPRESS_ANALYSIS, asyncio.Event(), release, []))
+        await asyncio.sleep(0)
+
+        with pytest.raises(LLMQueueFullError):
+            await background
+
+        # Равный или более важный запрос в полной очереди не вытесняется
+        with pytest.raises(LLMQueueFullError):
+            async with scheduler.slot(LLMPriority.SMALL_TALK):
+                pass
+
+        release.set()
+        await asyncio.gather(blocker, express)
+        return scheduler.get_stats()
+
+    stats = asyncio.run(scenario())
+    assert stats['lanes']['BACKGROUND']['rejected'] == 1
+    assert stats['lanes']['SMALL_TALK']['rejected'] == 1
+    assert stats['lanes']['EXPRESS_ANALYSIS']['admitted'] == 1
+
+def test_queue_timeout_is_shorter_than_deadline():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, queue_timeouts={LLMPriority.SMALL_TALK: 0.05})
+        release = asyncio.Event()
+        blocker = asyncio.create_task(hold_slot(scheduler, LLMPriority.FULL_ANALYSIS, asyncio.Event(), release, []))
+        await asyncio.sleep(0)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        with pytest.raises(LLMDeadlineExceededError):
+            async with scheduler.slot(LLMPriority.SMALL_TALK):
+                pass
+        waited = loop.time() - started
+
+        release.set()
+        await blocker
+        return waited, scheduler.get_stats()
+
+    waited, stats = asyncio.run(scenario())
+    assert waited < 1.0
+    assert stats['lanes']['SMALL_TALK']['expired'] == 1
+    assert stats['queue_depth'] == 0
+    assert stats['active'] == 0
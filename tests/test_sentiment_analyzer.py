@@ -0,0 +1,50 @@
+import pytest
+
+from sentiment_analyzer import (
+    FALSE_HIT_CHECKS,
+    INFLECTION_CHECKS,
+    check_inflections,
+    get_sentiment_analyzer,
+    lexicon_stem,
+    stem_matches,
+)
+
+@pytest.fixture(scope='module')
+def analyzer():
+    return get_sentiment_analyzer(cache_size=0)
+
+@pytest.mark.parametrize('text, expected', INFLECTION_CHECKS)
+def test_inflected_forms_are_detected(analyzer, text, expected):
+    result = analyzer.analyze_text(text)
+    scores = {**result.emotions, **result.psychological_indicators}
+    for name in expected:
+        assert scores[name] > 0, name
+
+@pytest.mark.parametrize('text', FALSE_HIT_CHECKS)
+def test_words_sharing_a_prefix_are_not_hits(analyzer, text):
+    result = analyzer.analyze_text(text)
+    assert dict(result.token_hits) == {}
+    assert result.psychological_indicators['anxiety_level'] == 0.0
+
+def test_check_inflections_passes(analyzer):
+    assert check_inflections(analyzer) == []
+
+@pytest.mark.parametrize('token, word, matches', [
+    ('стрессом', 'стресс', True),
+    ('депрессии', 'депрессия', True),
+    ('болью', 'боль', True),
+    ('больше', 'боль', False),
+    ('страховку', 'страх', False),
+    ('нет', 'не', False),
+    ('не', 'не', True),
+])
+def test_stem_matches(token, word, matches):
+    assert stem_matches(token, lexicon_stem(word)) is matches
+
+def test_batch_matches_single_text_analysis(analyzer):
+    texts = [text for text, _ in INFLECTION_CHECKS] + list(FALSE_HIT_CHECKS) + ["", "не справляюсь, не справляюсь"]
+    for text, batch_result in zip(texts, analyzer.analyze_batch(texts)):
+        result = analyzer.analyze_text(text)
+        assert dict(batch_result.token_hits) == dict(result.token_hits)
+        assert dict(batch_result.psychological_indicators) == pytest.approx(dict(result.psychological_indicators))
+        assert batch_result.recommendation == result.recommendation
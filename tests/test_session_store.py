@@ -0,0 +1,111 @@
+import gc
+import time
+
+from database import Database
+from sentiment_analyzer import EmotionalTrend
+from session_store import SQLiteSessionBackend, SessionStore, UserSession
+
+def make_session() -> UserSession:
+    session = UserSession(42, max_history=3)
+    for text in ("первое", "второе", "третье", "четвертое"):
+        session.add_message(text)
+    session.summary = "краткое содержание"
+    session.summary_upto = 1
+    session.start_full_analysis()
+    session.answers.append("ответ")
+    session.current_question = 1
+    session.emotional_trend = EmotionalTrend()
+    return session
+
+def test_to_dict_from_dict_round_trip():
+    session = make_session()
+    restored = UserSession.from_dict(42, session.to_dict(), max_history=3)
+
+    assert restored.to_dict() == session.to_dict()
+    assert list(restored.history) == ["второе", "третье", "четвертое"]
+    assert restored.message_count == 4
+    assert restored.history.maxlen == 3
+    assert restored.size_bytes == restored.estimate_size()
+
+def test_from_dict_copies_mutable_state():
+    session = make_session()
+    restored = UserSession.from_dict(42, session.to_dict(), max_history=3)
+    restored.answers.append("еще ответ")
+    restored.add_message("пятое")
+
+    assert session.answers == ["ответ"]
+    assert list(session.history) == ["второе", "третье", "четвертое"]
+
+def make_backend(tmp_path, **kwargs) -> SQLiteSessionBackend:
+    return SQLiteSessionBackend(Database(str(tmp_path / "sessions.db")), flush_interval=60, **kwargs)
+
+def test_backend_serializes_latest_state_on_flush(tmp_path):
+    backend = make_backend(tmp_path)
+    store = SessionStore(backend=backend)
+
+    session = store.append_message(1, "первое")
+    session.add_message("второе")
+    store.update(session)
+    assert backend.flush() == 1
+
+    reloaded = SessionStore(backend=make_backend(tmp_path)).get(1)
+    assert list(reloaded.history) == ["первое", "второе"]
+    backend.close()
+
+def test_update_reinserts_session_evicted_during_await():
+    store = SessionStore(max_entries=1)
+    session = store.get_or_create(1)
+    store.get_or_create(2)
+    assert 1 not in store
+
+    session.add_message("ответ после ожидания")
+    store.update(session)
+
+    assert store.get(1) is session
+    assert len(store) == 1
+
+def test_get_returns_evicted_session_still_in_use():
+    store = SessionStore(max_entries=1)
+    session = store.get_or_create(1)
+    store.get_or_create(2)
+
+    assert store.get(1) is session
+
+def test_evicted_session_is_released_when_unused():
+    store = SessionStore(max_entries=1)
+    store.append_message(1, "первое")
+    store.get_or_create(2)
+    gc.collect()
+
+    assert store.get(1) is None
+
+def test_update_does_not_restore_discarded_session():
+    store = SessionStore(max_entries=1)
+    session = store.get_or_create(1)
+    store.get_or_create(2)
+    store.clear()
+
+    store.update(session)
+    assert 1 not in store
+
+    other = store.get_or_create(3)
+    store.discard(3)
+    store.update(other)
+    assert 3 not in store
+
+def test_writer_thread_purges_expired_sessions(tmp_path):
+    backend = make_backend(tmp_path, ttl=3600, purge_interval=0.05)
+    backend.db.execute(
+        'INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)', (7, '{}', time.time() - 7200)
+    )
+    backend.flush_interval = 0.01
+    backend.save(UserSession(8))
+
+    for _ in range(100):
+        if backend.db.fetchone('SELECT 1 FROM sessions WHERE user_id = 7') is None:
+            break
+        time.sleep(0.02)
+
+    assert backend.db.fetchone('SELECT 1 FROM sessions WHERE user_id = 7') is None
+    assert backend.db.fetchone('SELECT 1 FROM sessions WHERE user_id = 8') is not None
+    backend.close()
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from telegram.error import NetworkError, RetryAfter
+
+from stream_renderer import StreamingMessageRenderer, close_markdown, split_for_rollover
+
+@pytest.mark.parametrize('text, expected', [
+    ("просто текст", "просто текст"),
+    ("*жирный", "*жирный*"),
+    ("_курсив", "_курсив_"),
+    ("*жирный* и _курсив", "*жирный* и _курсив_"),
+    ("код `x", "код `x`"),
+    ("```\nблок *кода", "```\nблок *кода\n```"),
+    ("ссылка [текст](http://exa", "ссылка "),
+    ("ссылка [текст", "ссылка "),
+    ("ссылка [текст](http://example.com)", "ссылка [текст](http://example.com)"),
+    ("список [1] и *важное", "список [1] и *важное*"),
+])
+def test_close_markdown(text, expected):
+    assert close_markdown(text) == expected
+
+def test_split_for_rollover_keeps_short_text():
+    assert split_for_rollover("короткий", 100) == len("короткий")
+
+def test_split_for_rollover_prefers_paragraph_then_line_then_word():
+    paragraph = "а" * 60 + "\n\n" + "б" * 60
+    assert split_for_rollover(paragraph, 100) == 62
+
+    line = "а" * 60 + "\n" + "б" * 60
+    assert split_for_rollover(line, 100) == 61
+
+    words = "слово " * 30
+    cut = split_for_rollover(words, 100)
+    assert cut <= 100 and words[:cut].endswith(" ")
+
+def test_split_for_rollover_cuts_hard_without_separators():
+    assert split_for_rollover("а" * 300, 100) == 100
+
+class FakeMessage:
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+
+    async def edit_text(self, text, parse_mode=None):
+        self.log.append((self.name, text))
+
+def test_renderer_recovers_when_continuation_send_fails():
+    log = []
+    failures = [RetryAfter(0), NetworkError("network")]
+    sent = []
+
+    async def send_message(text, parse_mode=None):
+        if failures:
+            raise failures.pop(0)
+        message = FakeMessage(log, f"part{len(sent) + 2}")
+        sent.append(text)
+        return message
+
+    async def scenario():
+        renderer = StreamingMessageRenderer(
+            FakeMessage(log, "part1"), send_message, error_message="ошибка", max_length=100, min_interval=0,
+        )
+        await renderer.feed("слово " * 30)
+        await renderer.feed("конец")
+        return await renderer.finish()
+
+    text = asyncio.run(scenario())
+    assert text.endswith("конец")
+    assert sent, "продолжение ответа должно быть отправлено новым сообщением"
+    assert log[-1][0] == "part2" and log[-1][1].endswith("конец")
+
+def test_renderer_uses_error_message_for_empty_answer():
+    log = []
+
+    async def scenario():
+        renderer = StreamingMessageRenderer(
+            FakeMessage(log, "part1"), None, error_message="ошибка", min_interval=0,
+        )
+        return await renderer.finish()
+
+    assert asyncio.run(scenario()) == "ошибка"
+    assert log == [("part1", "ошибка")]
+
+def test_renderer_appends_error_after_partial_answer():
+    log = []
+
+    async def scenario():
+        renderer = StreamingMessageRenderer(
+            FakeMessage(log, "part1"), None, error_message="ошибка", min_interval=0,
+        )
+        await renderer.feed("Начало ответа")
+        return await renderer.finish(error="оборвалось")
+
+    assert asyncio.run(scenario()) == "Начало ответа\n\nоборвалось"
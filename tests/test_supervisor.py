@@ -0,0 +1,38 @@
+import pytest
+from telegram import Update
+
+from supervisor import WorkerPool
+from webhook_server import raw_update_key, update_key
+
+USER = {'id': 1001, 'is_bot': False, 'first_name': 'Анна'}
+CHAT = {'id': -2002, 'type': 'group', 'title': 'HR'}
+CHANNEL = {'id': -3003, 'type': 'channel', 'title': 'Новости'}
+MESSAGE = {'message_id': 1, 'date': 0, 'chat': CHAT, 'from': USER, 'text': 'привет'}
+
+UPDATES = [
+    {'update_id': 1, 'message': MESSAGE},
+    {'update_id': 2, 'edited_message': dict(MESSAGE, edit_date=1)},
+    {'update_id': 3, 'callback_query': {'id': 'q', 'from': USER, 'chat_instance': 'c', 'message': MESSAGE, 'data': 'x'}},
+    {'update_id': 4, 'channel_post': {'message_id': 2, 'date': 0, 'chat': CHANNEL, 'text': 'пост'}},
+]
+
+@pytest.mark.parametrize('data', UPDATES, ids=lambda data: next(key for key in data if key != 'update_id'))
+def test_raw_update_key_matches_parsed_update(data):
+    assert raw_update_key(data) == update_key(Update.de_json(data, None))
+
+def test_raw_update_key_falls_back_to_update_id():
+    assert raw_update_key({'update_id': 5, 'poll': {'id': 'p', 'question': 'Как дела?'}}) == 5
+
+def test_pool_routes_user_updates_to_one_worker():
+    pool = WorkerPool(lambda context: None, processes=3, queue_size=30)
+    for data in UPDATES[:3]:
+        assert pool.submit(data)
+
+    assert pool.received[USER['id'] % 3] == 3
+    assert sum(pool.received) == 3
+
+def test_pool_rejects_update_when_worker_queue_is_full():
+    pool = WorkerPool(lambda context: None, processes=2, queue_size=2)
+    assert pool.submit(UPDATES[0])
+    assert not pool.submit(UPDATES[1])
+    assert pool.rejected == 1
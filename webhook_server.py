@@ -0,0 +1,214 @@
+"""
+Модуль приема обновлений Telegram через вебхук
+Обновления проверяются по секретному токену, попадают в ограниченные очереди
+и обрабатываются пулом воркеров. Обновления одного пользователя всегда идут
+в одну очередь, поэтому обрабатываются строго по порядку
+"""
+
+import hmac
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram import Update
+
+from http_server import HTTPServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+
+def update_key(update: Update) -> int:
+    """Ключ распределения обновления: пользователь, иначе чат"""
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return update.update_id
+
+def raw_update_key(data: Dict) -> int:
+    """Ключ распределения для обновления в виде JSON (без разбора в Update)"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return int(user['id'])
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return int(chat['id'])
+    return int(data.get('update_id', 0))
+
+class UpdateDispatcher:
+    """Ограниченные очереди обновлений с пулом обработчиков (очередь выбирается по ключу)"""
+
+    def __init__(
+        self,
+        process: Callable[[Any], Awaitable[None]],
+        queue_size: int = 1000,
+        workers: int = 8,
+        key: Callable[[Any], int] = update_key,
+    ):
+        self.process = process
+        self.key = key
+        self.workers = max(workers, 1)
+
+        # Общий лимит делится между очередями воркеров
+        per_worker = max(queue_size // self.workers, 1)
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self._worker_tasks: List[asyncio.Task] = []
+
+        # Метрики
+        self.received = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """Запустить воркеры"""
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(queue), name=f"update-worker-{index}")
+            for index, queue in enumerate(self._queues)
+        ]
+
+    def submit(self, update) -> bool:
+        """Поставить обновление в очередь; False - очередь заполнена"""
+        try:
+            self._queues[self.key(update) % self.workers].put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    async def put(self, update) -> None:
+        """Поставить обновление в очередь, дождавшись места"""
+        await self._queues[self.key(update) % self.workers].put(update)
+        self.received += 1
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        """Обработка обновлений одной очереди по порядку"""
+        while True:
+            update = await queue.get()
+            try:
+                await self.process(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing update {getattr(update, 'update_id', '?')}: {e}")
+            finally:
+                queue.task_done()
+
+    async def drain(self, timeout: float = 30.0) -> bool:
+        """Дождаться обработки принятых обновлений"""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)), timeout=timeout
+            )
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"Update drain timed out, {self.queue_depth} updates left unprocessed")
+            return False
+
+    async def stop(self) -> None:
+        """Остановить воркеры"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def get_stats(self) -> Dict:
+        """Метрики очередей обновлений"""
+        return {
+            'queue_depth': self.queue_depth,
+            'queue_capacity': sum(queue.maxsize for queue in self._queues),
+            'workers': self.workers,
+            'received': self.received,
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'failed': self.failed,
+        }
+
+class WebhookServer:
+    """Прием вебхуков Telegram с ограниченной очередью и плавной остановкой"""
+
+    def __init__(
+        self,
+        server: HTTPServer,
+        dispatcher,
+        parse: Callable[[Dict], Any],
+        path: str = "/telegram",
+        secret_token: Optional[str] = None,
+        health_path: str = "/healthz",
+    ):
+        self.server = server
+        # UpdateDispatcher или другой получатель с тем же интерфейсом (submit/drain/stop/get_stats)
+        self.dispatcher = dispatcher
+        self.parse = parse  # JSON -> обновление для dispatcher (None - некорректное)
+        self.path = path
+        self.secret_token = secret_token
+
+        self._draining = False
+        self._started_at = time.monotonic()
+        self.unauthorized = 0
+
+        server.add_route('POST', path, self.handle_update)
+        server.add_route('GET', health_path, self.handle_health)
+
+    async def start(self) -> None:
+        """Запустить обработчики и HTTP-сервер"""
+        self.dispatcher.start()
+        await self.server.start()
+
+    async def handle_update(self, request: Request) -> Response:
+        """POST от Telegram с обновлением"""
+        if self.secret_token:
+            received_token = request.headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(received_token, self.secret_token):
+                self.unauthorized += 1
+                return Response.text("Forbidden", 403)
+
+        if self._draining:
+            # Telegram повторит доставку после перезапуска
+            return Response.text("Shutting down", 503)
+
+        try:
+            update = self.parse(request.json())
+        except Exception as e:
+            logger.warning(f"Invalid webhook payload: {e}")
+            return Response.text("Bad Request", 400)
+        if update is None:
+            return Response.text("Bad Request", 400)
+
+        if not self.dispatcher.submit(update):
+            return Response.text("Queue is full", 503)
+        return Response.text("OK")
+
+    async def handle_health(self, request: Request) -> Response:
+        """Проверка работоспособности для балансировщика"""
+        stats = self.get_stats()
+        status = 503 if self._draining else 200
+        stats['status'] = 'draining' if self._draining else 'ok'
+        return Response.json(stats, status)
+
+    async def drain(self, timeout: float = 30.0) -> bool:
+        """Перестать принимать обновления и дождаться обработки принятых"""
+        self._draining = True
+        return await self.dispatcher.drain(timeout)
+
+    async def stop(self, drain_timeout: float = 30.0) -> None:
+        """Плавная остановка: дообработать очередь, затем остановить сервер и обработчики"""
+        await self.drain(drain_timeout)
+        await self.server.stop()
+        await self.dispatcher.stop()
+
+    def get_stats(self) -> Dict:
+        """Метрики приема обновлений"""
+        stats = {'uptime': time.monotonic() - self._started_at, 'unauthorized': self.unauthorized}
+        stats.update(self.dispatcher.get_stats())
+        return stats